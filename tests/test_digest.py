@@ -0,0 +1,69 @@
+# -*- coding: UTF-8 -*-
+# Copyright (c) 2014, Pascal Volk
+# See COPYING for distribution information.
+"""
+    tests.test_digest
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Known answer tests of the primitives from vmm.digest.
+"""
+
+import hashlib
+import struct
+import unittest
+
+from vmm.digest import MD4, MD5_IV, des_encrypt, md5_compress
+
+
+class MD4Test(unittest.TestCase):
+    # RFC 1320, appendix A.5
+    vectors = (
+        (b"", "31d6cfe0d16ae931b73c59d7e0c089c0"),
+        (b"a", "bde52cb31de33e46245e05fbdbd6fb24"),
+        (b"abc", "a448017aaf21d8525fc10ae87aa6729d"),
+        (b"message digest", "d9130a8164549fe818874806e1c7014b"),
+        (b"abcdefghijklmnopqrstuvwxyz", "d79e1c308aa5bbcdeea8ed63df412da9"),
+        (
+            b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789",
+            "043f8582f241db351ce627e153e7f0e4",
+        ),
+        (b"1234567890" * 8, "e33b4ddc9c38f2199c3e7b164fcc0536"),
+    )
+
+    def test_vectors(self):
+        for data, expected in self.vectors:
+            self.assertEqual(MD4(data).hexdigest(), expected, data)
+
+    def test_update(self):
+        md4 = MD4()
+        for chunk in (b"1234567890",) * 8:
+            md4.update(chunk)
+        self.assertEqual(md4.hexdigest(), "e33b4ddc9c38f2199c3e7b164fcc0536")
+
+
+class MD5CompressTest(unittest.TestCase):
+    def test_single_block(self):
+        # the state after the only (padded) block is the digest
+        data = b"The quick brown fox jumps over the lazy dog"
+        padding = b"\x80" + bytes(55 - len(data))
+        block = data + padding + struct.pack("<Q", len(data) * 8)
+        state = md5_compress(MD5_IV, block)
+        self.assertEqual(struct.pack("<4I", *state), hashlib.md5(data).digest())
+
+
+class DESTest(unittest.TestCase):
+    def test_encrypt(self):
+        key = bytes.fromhex("133457799bbcdff1")
+        block = bytes.fromhex("0123456789abcdef")
+        self.assertEqual(des_encrypt(key, block).hex(), "85e813540f0ab405")
+
+    def test_parity_bits_ignored(self):
+        key = bytes.fromhex("133457799bbcdff1")
+        block = bytes.fromhex("0123456789abcdef")
+        self.assertEqual(
+            des_encrypt(bytes(x ^ 1 for x in key), block), des_encrypt(key, block)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+# -*- coding: UTF-8 -*-
+# Copyright (c) 2014, Pascal Volk
+# See COPYING for distribution information.
+"""
+    tests.test_password
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Known answer tests of the password schemes, which vmm.password
+    generates without doveadm.  The expected hashes must match the output
+    of ``doveadm pw -s <scheme> -p <password>``.
+"""
+
+import builtins
+import hashlib
+import hmac
+import unittest
+from base64 import b64decode, b64encode
+from unittest import mock
+
+from vmm import password
+from vmm.password import pwhash
+
+OPTIONS = {"misc.dovecot_version": 0x20300F00}
+
+
+def setUpModule():
+    builtins.cfg_dget = OPTIONS.get
+
+
+def tearDownModule():
+    del builtins.cfg_dget
+
+
+class PasswordSchemeTest(unittest.TestCase):
+    # scheme: ((password, hash), ...)
+    vectors = {
+        "CRAM-MD5": (
+            (
+                "test",
+                "{CRAM-MD5}e02d374fde0dc75a17a557039a3a5338"
+                "c7743304777dccd376f332bee68d2cf6",
+            ),
+            (
+                "password",
+                "{CRAM-MD5}9186d855e11eba527a7a52ca82b313e1"
+                "80d62234f0acc9051b527243d41e2740",
+            ),
+        ),
+        "LANMAN": (
+            ("test", "{LANMAN}01fc5a6be7bc6929aad3b435b51404ee"),
+            ("password", "{LANMAN}e52cac67419a9a224a3b108f3fa6cb6d"),
+        ),
+        "NTLM": (
+            ("test", "{NTLM}0cb6948805f797bf2a82807973b89537"),
+            ("password", "{NTLM}8846f7eaee8fb117ad06bdd830b7586c"),
+        ),
+        "PLAIN-MD4": (
+            ("test", "{PLAIN-MD4}db346d691d7acc4dc2625db19f9e3f52"),
+            ("password", "{PLAIN-MD4}8a9d093f14f8701df17732b2bb182c74"),
+        ),
+        "PLAIN-MD4.B64": (("test", "{PLAIN-MD4.B64}2zRtaR16zE3CYl2xn54/Ug=="),),
+        "RPA": (
+            ("test", "{RPA}f89cb77d46507afe985d80822b6b6c39"),
+            ("password", "{RPA}2bf3023f1259b0c2f607e4302556bd72"),
+        ),
+    }
+
+    def test_vectors(self):
+        for scheme, vectors in self.vectors.items():
+            for plain, expected in vectors:
+                self.assertEqual(pwhash(plain, scheme), expected, scheme)
+
+    def test_cram_md5_long_password(self):
+        # passwords longer than the block are replaced by their MD5 digest
+        plain = "x" * 65
+        digest = hashlib.md5(plain.encode()).digest()
+        self.assertEqual(
+            pwhash(plain, "CRAM-MD5"),
+            password._cram_md5_hash(digest, "CRAM-MD5", None),
+        )
+
+
+class ScramSHA1Test(unittest.TestCase):
+    # the example of RFC 5802, section 5
+    salt = b64decode("QSXCR+Q6sek8bf92")
+    auth_message = (
+        b"n=user,r=fyko+d2lbbFgONRv9qkxdawL,"
+        b"r=fyko+d2lbbFgONRv9qkxdawL3rfcNHYJY1ZVvWVs7j,s=QSXCR+Q6sek8bf92,i=4096,"
+        b"c=biws,r=fyko+d2lbbFgONRv9qkxdawL3rfcNHYJY1ZVvWVs7j"
+    )
+    client_proof = b64decode("v0X8v3Bz2T0CJGbJQyF0X+HI4Ts=")
+    server_signature = b64decode("rmF9pqV8S7suAoZWja4dJRkFsKQ=")
+
+    def test_rfc5802(self):
+        with mock.patch.object(password._sys_rand, "randbytes", return_value=self.salt):
+            hashed = pwhash("pencil", "SCRAM-SHA-1")
+        self.assertTrue(hashed.startswith("{SCRAM-SHA-1}"))
+        iterations, salt, stored_key, server_key = hashed[13:].split(",")
+        self.assertEqual(iterations, "4096")
+        self.assertEqual(salt, b64encode(self.salt).decode())
+        stored_key, server_key = b64decode(stored_key), b64decode(server_key)
+        self.assertEqual(
+            hmac.new(server_key, self.auth_message, hashlib.sha1).digest(),
+            self.server_signature,
+        )
+        client_signature = hmac.new(stored_key, self.auth_message, hashlib.sha1)
+        client_key = bytes(
+            x ^ y for x, y in zip(self.client_proof, client_signature.digest())
+        )
+        self.assertEqual(hashlib.sha1(client_key).digest(), stored_key)
+
+
+if __name__ == "__main__":
+    unittest.main()
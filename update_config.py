@@ -54,10 +54,12 @@ def get_config_file():
 def update(cp):
     if VERSION == '0.5.2':
         upd_052(cp)
-    elif VERSION in ('0.6.0', '0.6.1'):
-        os.sys.stdout.write('info: vmm.cfg: nothing to do for version %s\n' %
-                            VERSION)
-        return
+        upd_06x(cp)
+    elif VERSION in ('0.6.0', '0.6.1', '0.6.2'):
+        upd_06x(cp)
+        if not had_bin_du:
+            os.sys.stdout.write('info: vmm.cfg: nothing to do for version '
+                                '%s\n' % VERSION)
     else:
         os.sys.stderr.write('error: the version %s is not supported by this '
                             'script\n' % VERSION)
@@ -150,11 +152,19 @@ def upd_052(cp):
     set_dovecot_version(cp)
 
 
+def upd_06x(cp):
+    global had_bin_du
+
+    # the disk usage is summarized without du(1)
+    had_bin_du = cp.has_section('bin') and cp.remove_option('bin', 'du')
+
+
 # def main():
 if __name__ == '__main__':
     sect_opt = []
     had_config = False
     had_gid_mail = False
+    had_bin_du = False
     cf = get_config_file()
     cp = get_cfg_parser(cf)
     update(cp)
@@ -170,11 +180,15 @@ if __name__ == '__main__':
         if had_gid_mail:
             print('\nRemoved option "gid_mail" from section "misc"',
                   '(obsolte)\n')
+        if had_bin_du:
+            print('\nRemoved option "du" from section "bin" (obsolete)\n')
         os.sys.exit(0)
-    if had_config or had_gid_mail:
+    if had_config or had_gid_mail or had_bin_du:
         update_cfg_file(cp, cf)
         if had_config:
             print('\nRemoved section "config" with option "done" (obsolte)')
         if had_gid_mail:
             print('\nRemoved option "gid_mail" from section "misc"',
                   '(obsolte)\n')
+        if had_bin_du:
+            print('\nRemoved option "du" from section "bin" (obsolete)\n')
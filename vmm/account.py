@@ -10,6 +10,8 @@
 
 from gettext import gettext as _
 
+from psycopg2.extras import execute_values
+
 from vmm.common import version_str, format_domain_default
 from vmm.constants import (
     ACCOUNT_EXISTS,
@@ -21,16 +23,34 @@ from vmm.constants import (
     NO_SUCH_DOMAIN,
 )
 from vmm.common import validate_transport
-from vmm.domain import Domain
+from vmm.domain import DOMAIN_COLUMNS, DOMAIN_JOINS, Domain
 from vmm.emailaddress import EmailAddress
 from vmm.errors import AccountError as AErr
 from vmm.maillocation import MailLocation
-from vmm.password import pwhash
+from vmm.password import pwhash, pwhash_many
 from vmm.quotalimit import QuotaLimit
 from vmm.transport import Transport
 from vmm.serviceset import ServiceSet
 
-__all__ = ("Account", "get_account_by_uid")
+__all__ = ("Account", "get_account_by_uid", "save_accounts", "update_passwords")
+
+# The columns of an account and its quota limit, service set, transport and
+# mail location, see Account._set_row().  ACCOUNT_JOINS joins the tables to
+# the users table, aliased as u.
+ACCOUNT_COLUMNS = (
+    "u.uid", "u.note",
+    "uq.qid", "uq.bytes", "uq.messages",
+    "us.ssid", "us.smtp", "us.pop3", "us.imap", "us.sieve",
+    "ut.tid", "ut.transport",
+    "ml.mid", "mf.format", "ml.directory",
+)  # fmt: skip
+ACCOUNT_JOINS = (
+    "LEFT JOIN quotalimit uq ON uq.qid = u.qid "
+    "LEFT JOIN service_set us ON us.ssid = u.ssid "
+    "LEFT JOIN transport ut ON ut.tid = u.tid "
+    "LEFT JOIN maillocation ml ON ml.mid = u.mid "
+    "LEFT JOIN mailboxformat mf ON mf.fid = ml.fid"
+)
 
 cfg_dget = lambda option: None
 
@@ -43,8 +63,10 @@ class Account:
         "_dbh",
         "_domain",
         "_mail",
+        "_name",
         "_new",
         "_passwd",
+        "_pwhash",
         "_qlimit",
         "_services",
         "_transport",
@@ -52,7 +74,7 @@ class Account:
         "_uid",
     )
 
-    def __init__(self, dbh, address):
+    def __init__(self, dbh, address, domain=None):
         """Creates a new Account instance.
 
         When an account with the given *address* could be found in the
@@ -64,66 +86,104 @@ class Account:
           A database connection for the database access.
         `address` : vmm.EmailAddress.EmailAddress
           The e-mail address of the (new) Account.
+        `domain` : vmm.domain.Domain
+          The already loaded Domain of the *address*; default None.
+          When many accounts of the same domain are processed, this
+          saves loading the Domain again for each Account.
         """
         if not isinstance(address, EmailAddress):
             raise TypeError("Argument 'address' is not an EmailAddress")
         self._addr = address
         self._dbh = dbh
-        self._domain = Domain(self._dbh, self._addr.domainname)
-        if not self._domain.gid:
-            # TP: Hm, what “quotation marks” should be used?
-            # If you are unsure have a look at:
-            # http://en.wikipedia.org/wiki/Quotation_mark,_non-English_usage
-            raise AErr(
-                _("The domain '%s' does not exist.") % self._addr.domainname,
-                NO_SUCH_DOMAIN,
-            )
         self._uid = 0
         self._mail = None
         self._qlimit = None
         self._services = None
         self._transport = None
         self._note = None
+        self._name = None
         self._passwd = None
+        self._pwhash = None
         self._new = True
-        self._load()
+        self._domain = domain
+        if domain is None:
+            # the domain and the account are loaded with a single query
+            row = self._load_with_domain()
+            if row is not None:
+                self._domain = Domain(self._dbh, self._addr.domainname, _row=row)
+        else:
+            assert isinstance(domain, Domain) and domain.name == address.domainname
+        if self._domain is None or not self._domain.gid:
+            # TP: Hm, what “quotation marks” should be used?
+            # If you are unsure have a look at:
+            # http://en.wikipedia.org/wiki/Quotation_mark,_non-English_usage
+            raise AErr(
+                _("The domain '%s' does not exist.") % self._addr.domainname,
+                NO_SUCH_DOMAIN,
+            )
+        if domain is not None:
+            self._load()
 
     def __bool__(self):
         """Returns `True` if the Account is known, `False` if it's new."""
         return not self._new
 
     def _load(self):
-        """Load 'uid', 'mid', 'qid', 'ssid', 'tid' and 'note' from the
-        database and set _new to `False` - if the user could be found. """
+        """Load 'uid', 'note', the quota limit, service set, transport and
+        mail location from the database and set _new to `False` - if the
+        user could be found."""
         dbc = self._dbh.cursor()
         # fmt: off
         dbc.execute(
-            "SELECT uid, mid, qid, ssid, tid, note "
-            "FROM users "
-            "WHERE gid = %s AND local_part = %s",
+            "SELECT %s FROM users u %s WHERE u.gid = %%s AND u.local_part = %%s"
+            % (", ".join(ACCOUNT_COLUMNS), ACCOUNT_JOINS),
             (self._domain.gid, self._addr.localpart),
         )
         # fmt: on
         result = dbc.fetchone()
         dbc.close()
         if result:
-            self._uid, _mid, _qid, _ssid, _tid, _note = result
-
-            def load_helper(ctor, own, field, dbresult):
-                cur = None if own is None else getattr(own, field)
-                if cur != dbresult:
-                    kwargs = {field: dbresult}
-                    if dbresult is None:
-                        return dbresult
-                    else:
-                        return ctor(self._dbh, **kwargs)
-
-            self._qlimit = load_helper(QuotaLimit, self._qlimit, "qid", _qid)
-            self._services = load_helper(ServiceSet, self._services, "ssid", _ssid)
-            self._transport = load_helper(Transport, self._transport, "tid", _tid)
-            self._mail = MailLocation(self._dbh, mid=_mid)
-            self._note = _note
-            self._new = False
+            self._set_row(result)
+
+    def _load_with_domain(self):
+        """Load the domain's DOMAIN_COLUMNS and the Account, like _load(),
+        with a single query.  Returns the domain's part of the row, or
+        `None` if the domain doesn't exist."""
+        dbc = self._dbh.cursor()
+        # fmt: off
+        dbc.execute(
+            "SELECT %s %s "
+            "LEFT JOIN users u ON u.gid = dd.gid AND u.local_part = %%s "
+            "%s "
+            "WHERE dn.domainname = %%s"
+            % (
+                ", ".join(DOMAIN_COLUMNS + ACCOUNT_COLUMNS),
+                DOMAIN_JOINS,
+                ACCOUNT_JOINS,
+            ),
+            (self._addr.localpart, self._addr.domainname),
+        )
+        # fmt: on
+        result = dbc.fetchone()
+        dbc.close()
+        if not result:
+            return None
+        domain_len = len(DOMAIN_COLUMNS)
+        if result[domain_len] is not None:
+            self._set_row(result[domain_len:])
+        return result[:domain_len]
+
+    def _set_row(self, row):
+        """Sets the attributes from the ACCOUNT_COLUMNS *row*."""
+        self._uid, self._note = row[0], row[1]
+        if row[2] is not None:
+            self._qlimit = QuotaLimit._from_row(self._dbh, *row[2:5])
+        if row[5] is not None:
+            self._services = ServiceSet._from_row(self._dbh, *row[5:10])
+        if row[10] is not None:
+            self._transport = Transport._from_row(self._dbh, *row[10:12])
+        self._mail = MailLocation._from_row(self._dbh, *row[12:15])
+        self._new = False
 
     def _set_uid(self):
         """Set the unique ID for the new Account."""
@@ -133,10 +193,13 @@ class Account:
         self._uid = dbc.fetchone()[0]
         dbc.close()
 
-    def _prepare(self, maillocation):
+    def prepare(self, maillocation):
         """Check and set different attributes - before we store the
         information in the database.
-        """
+
+        Called by `save()` and `save_accounts()`.  It may be called before,
+        in order to check the new Account with the MailLocation
+        *maillocation* in advance."""
         if maillocation.dovecot_version > cfg_dget("misc.dovecot_version"):
             raise AErr(
                 _("The mailbox format '%(mbfmt)s' requires Dovecot " ">= v%(version)s.")
@@ -149,7 +212,22 @@ class Account:
         transport = self._transport or self._domain.transport
         validate_transport(transport, maillocation)
         self._mail = maillocation
-        self._set_uid()
+
+    def _get_row(self):
+        """Returns a tuple with the values of the new Account's row in the
+        users table."""
+        return (
+            self._addr.localpart,
+            self._pwhash or pwhash(self._passwd, user=self._addr),
+            self._uid,
+            self._domain.gid,
+            self._mail.mid,
+            self._qlimit.qid if self._qlimit else None,
+            self._services.ssid if self._services else None,
+            self._transport.tid if self._transport else None,
+            self._name,
+            self._note,
+        )
 
     def _update_tables(self, column, value):
         """Update various columns in the users table.
@@ -263,6 +341,84 @@ class Account:
             )
         self._passwd = password
 
+    def set_pwhash(self, pwhash):
+        """Set an already hashed password for the new Account.
+
+        Argument:
+
+        `pwhash` : str
+          The password hash, including the {SCHEME} prefix.
+        """
+        if not self._new:
+            raise AErr(
+                _("The account '%s' already exists.") % self._addr, ACCOUNT_EXISTS
+            )
+        if not isinstance(pwhash, str) or not pwhash:
+            raise AErr(
+                _("Could not accept password hash: '%s'") % pwhash,
+                ACCOUNT_MISSING_PASSWORD,
+            )
+        self._pwhash = pwhash
+
+    def set_name(self, name):
+        """Set the (optional) real name of the new Account.
+
+        Argument:
+
+        `name` : basestring or None
+          The user's real name
+        """
+        assert name is None or isinstance(name, str)
+        self._name = name
+
+    def set_quotalimit(self, quotalimit):
+        """Set the quota limit for the new Account.
+
+        Argument:
+
+        `quotalimit` : vmm.quotalimit.QuotaLimit or None
+          The quota limit, or None to use the domain's default.
+        """
+        if not self._new:
+            raise AErr(
+                _("The account '%s' already exists.") % self._addr, ACCOUNT_EXISTS
+            )
+        assert quotalimit is None or isinstance(quotalimit, QuotaLimit)
+        self._qlimit = quotalimit
+
+    def set_serviceset(self, serviceset):
+        """Set the services for the new Account.
+
+        Argument:
+
+        `serviceset` : vmm.serviceset.ServiceSet or None
+          The service set, or None to use the domain's default.
+        """
+        if not self._new:
+            raise AErr(
+                _("The account '%s' already exists.") % self._addr, ACCOUNT_EXISTS
+            )
+        assert serviceset is None or isinstance(serviceset, ServiceSet)
+        self._services = serviceset
+
+    def set_transport(self, transport):
+        """Set the transport for the new Account.
+
+        The transport will be validated against the mail location, when
+        the Account is saved.
+
+        Argument:
+
+        `transport` : vmm.transport.Transport or None
+          The transport, or None to use the domain's default.
+        """
+        if not self._new:
+            raise AErr(
+                _("The account '%s' already exists.") % self._addr, ACCOUNT_EXISTS
+            )
+        assert transport is None or isinstance(transport, Transport)
+        self._transport = transport
+
     def set_note(self, note):
         """Set the account's (optional) note.
 
@@ -280,18 +436,19 @@ class Account:
             raise AErr(
                 _("The account '%s' already exists.") % self._addr, ACCOUNT_EXISTS
             )
-        if not self._passwd:
+        if not (self._passwd or self._pwhash):
             raise AErr(
                 _("No password set for account: '%s'") % self._addr,
                 ACCOUNT_MISSING_PASSWORD,
             )
-        self._prepare(
+        self.prepare(
             MailLocation(
                 self._dbh,
                 mbfmt=cfg_dget("mailbox.format"),
                 directory=cfg_dget("mailbox.root"),
             )
         )
+        self._set_uid()
         dbc = self._dbh.cursor()
         # fmt: off
         dbc.execute(
@@ -304,20 +461,11 @@ class Account:
             "   qid, "
             "   ssid, "
             "   tid, "
+            "   name, "
             "   note"
             ") "
-            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
-            (
-                self._addr.localpart,
-                pwhash(self._passwd, user=self._addr),
-                self._uid,
-                self._domain.gid,
-                self._mail.mid,
-                self._qlimit.qid if self._qlimit else None,
-                self._services.ssid if self._services else None,
-                self._transport.tid if self._transport else None,
-                self._note,
-            ),
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+            self._get_row(),
         )
         # fmt: on
         self._dbh.commit()
@@ -588,6 +736,7 @@ class Account:
         self._new = True
         self._uid = 0
         self._addr = self._dbh = self._domain = self._passwd = None
+        self._name = self._pwhash = None
         self._mail = self._qlimit = self._services = self._transport = None
 
 
@@ -629,4 +778,116 @@ def get_account_by_uid(uid, dbh):
     return info
 
 
+def save_accounts(dbh, accounts):
+    """Save many new Accounts in the database within a single transaction.
+
+    All rows are sent with multi-row INSERT statements, the transaction
+    will be committed only once, after the last row has been inserted.
+    When an error occurs, nothing will be stored.
+
+    Arguments:
+
+    `dbh` : psycopg2._psycopg.connection
+      A database connection for the database access.
+    `accounts` : list
+      The new Account instances, each with a password or password hash.
+    """
+    if not accounts:
+        return
+    maillocation = MailLocation(
+        dbh, mbfmt=cfg_dget("mailbox.format"), directory=cfg_dget("mailbox.root")
+    )
+    for account in accounts:
+        if not account._new:
+            raise AErr(
+                _("The account '%s' already exists.") % account.address,
+                ACCOUNT_EXISTS,
+            )
+        if not (account._passwd or account._pwhash):
+            raise AErr(
+                _("No password set for account: '%s'") % account.address,
+                ACCOUNT_MISSING_PASSWORD,
+            )
+        account.prepare(maillocation)
+    plain = [account for account in accounts if not account._pwhash]
+    hashes = pwhash_many(
+        [account._passwd for account in plain],
+        users=[account.address for account in plain],
+        workers=cfg_dget("misc.password_hash_workers"),
+    )
+    for account, hashed in zip(plain, hashes):
+        account._pwhash = hashed
+    dbc = dbh.cursor()
+    dbc.execute(
+        "SELECT nextval('users_uid') FROM generate_series(1, %s)", (len(accounts),)
+    )
+    for account, (uid,) in zip(accounts, dbc.fetchall()):
+        account._uid = uid
+    try:
+        # fmt: off
+        execute_values(
+            dbc,
+            "INSERT INTO users ("
+            "   local_part, "
+            "   passwd, "
+            "   uid, "
+            "   gid, "
+            "   mid, "
+            "   qid, "
+            "   ssid, "
+            "   tid, "
+            "   name, "
+            "   note"
+            ") "
+            "VALUES %s",
+            [account._get_row() for account in accounts],
+            page_size=1000,
+        )
+        # fmt: on
+    except Exception:
+        dbh.rollback()
+        for account in accounts:
+            account._uid = 0
+        raise
+    finally:
+        dbc.close()
+    dbh.commit()
+    for account in accounts:
+        account._new = False
+
+
+def update_passwords(dbh, passwords):
+    """Update the password hashes of many Accounts within a single
+    transaction.
+
+    Arguments:
+
+    `dbh` : psycopg2._psycopg.connection
+      A database connection for the database access.
+    `passwords` : list
+      (uid, pwhash) tuples of the existing Accounts.
+    """
+    if not passwords:
+        return
+    dbc = dbh.cursor()
+    try:
+        # fmt: off
+        execute_values(
+            dbc,
+            "UPDATE users "
+            "SET passwd = v.passwd "
+            "FROM (VALUES %s) AS v (uid, passwd) "
+            "WHERE users.uid = v.uid",
+            passwords,
+            page_size=1000,
+        )
+        # fmt: on
+    except Exception:
+        dbh.rollback()
+        raise
+    finally:
+        dbc.close()
+    dbh.commit()
+
+
 del cfg_dget
@@ -0,0 +1,177 @@
+# -*- coding: UTF-8 -*-
+# Copyright (c) 2014, Pascal Volk
+# See COPYING for distribution information.
+"""
+    vmm.aio
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    An asyncio facade for the Handler.  The operations of the Handler are
+    run by a bounded pool of worker threads, each with its own Handler.
+    All Handlers share one connection pool (see database.pool_max_size),
+    so many concurrent requests need only a few database connections.
+
+    No async PostgreSQL driver is used: the Handler and the domain classes
+    are built on psycopg2 connections, units of work and the LookupCache,
+    and the filesystem work has to run in threads anyway.  So the threads
+    are bounded by the size of the connection pool instead of one thread
+    per request.
+"""
+
+import asyncio
+import contextvars
+import threading
+import types
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from vmm.config import Config
+from vmm.handler import Handler, find_cfg_file
+
+
+__all__ = ("AsyncHandler", "OPERATIONS")
+
+# Handler methods, which are available as coroutines of the AsyncHandler
+OPERATIONS = (
+    "address_list",
+    "alias_add",
+    "alias_delete",
+    "alias_info",
+    "aliasdomain_add",
+    "aliasdomain_delete",
+    "aliasdomain_info",
+    "aliasdomain_switch",
+    "bulk_user_add",
+    "bulk_user_password",
+    "catchall_add",
+    "catchall_delete",
+    "catchall_info",
+    "disk_usage_refresh",
+    "domain_add",
+    "domain_delete",
+    "domain_info",
+    "domain_list",
+    "domain_note",
+    "domain_quotalimit",
+    "domain_services",
+    "domain_transport",
+    "reap",
+    "relocated_add",
+    "relocated_delete",
+    "relocated_info",
+    "user_add",
+    "user_by_uid",
+    "user_delete",
+    "user_info",
+    "user_name",
+    "user_note",
+    "user_password",
+    "user_pwhash",
+    "user_quotalimit",
+    "user_services",
+    "user_transport",
+)
+
+# warnings of the last operation, per asyncio task
+_warnings = contextvars.ContextVar("vmm_aio_warnings", default=())
+
+
+class AsyncHandler:
+    """Runs the operations of the Handler in a pool of *workers* threads.
+
+    Each operation listed in `OPERATIONS` is available as a coroutine with
+    the same arguments, e.g. ``await ahdlr.user_info("user@example.com")``.
+    Streamed listings (``stream=True``) are read completely in the worker.
+    The warnings of the last operation of the current task are returned by
+    `get_warnings()`.
+
+    *workers* defaults to database.pool_max_size from the vmm.cfg found by
+    `vmm.handler.find_cfg_file()`, more threads would only wait for a
+    connection.  *handler_factory* is called without arguments
+    in each worker thread, in order to create its Handler."""
+
+    __slots__ = ("_executor", "_factory", "_local")
+
+    def __init__(self, workers=None, handler_factory=Handler):
+        self._factory = handler_factory
+        self._local = threading.local()
+        if workers is None:
+            cfg = Config(find_cfg_file())
+            cfg.load()
+            workers = cfg.dget("database.pool_max_size")
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(workers, 1), thread_name_prefix="vmm-aio"
+        )
+
+    def _handler(self):
+        """Returns the Handler of the current worker thread."""
+        hdlr = getattr(self._local, "handler", None)
+        if hdlr is None:
+            hdlr = self._local.handler = self._factory()
+        return hdlr
+
+    def _call(self, func, args, kwargs):
+        """Calls *func* with the worker's Handler in the worker thread and
+        returns a tuple (result, warnings)."""
+        hdlr = self._handler()
+        try:
+            result = func(hdlr, *args, **kwargs)
+            if isinstance(result, types.GeneratorType):
+                result = _read_stream(result)
+        except BaseException:
+            hdlr.get_warnings()
+            raise
+        return result, hdlr.get_warnings()
+
+    async def run(self, func, *args, **kwargs):
+        """Runs ``func(handler, *args, **kwargs)`` in a worker thread and
+        returns its result.
+
+        This allows to run several operations with the same Handler, e.g.
+        within one ``handler.transaction()``."""
+        loop = asyncio.get_running_loop()
+        result, warnings = await loop.run_in_executor(
+            self._executor, partial(self._call, func, args, kwargs)
+        )
+        _warnings.set(warnings)
+        return result
+
+    def get_warnings(self):
+        """Returns a list with the warnings of the last operation, which
+        has been awaited by the current task."""
+        return list(_warnings.get())
+
+    def close(self, wait=True):
+        """Shuts the worker threads down."""
+        self._executor.shutdown(wait=wait)
+
+
+def _read_stream(rows):
+    """Reads the streamed *rows* completely, including the nested groups
+    of e.g. `vmm.common.iter_addresses()`, which are only valid until the
+    next row is read."""
+    return [
+        tuple(list(value) if isinstance(value, Iterator) else value for value in row)
+        if isinstance(row, tuple)
+        else row
+        for row in rows
+    ]
+
+
+def _operation(name):
+    async def operation(self, *args, **kwargs):
+        return await self.run(
+            lambda hdlr, *args, **kwargs: getattr(hdlr, name)(*args, **kwargs),
+            *args,
+            **kwargs,
+        )
+
+    operation.__name__ = name
+    operation.__qualname__ = "AsyncHandler." + name
+    operation.__doc__ = "Coroutine version of Handler.%s()." % name
+    return operation
+
+
+for _name in OPERATIONS:
+    setattr(AsyncHandler, _name, _operation(_name))
+del _name
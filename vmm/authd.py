@@ -0,0 +1,197 @@
+# -*- coding: UTF-8 -*-
+# Copyright (c) 2014, Pascal Volk
+# See COPYING for distribution information.
+"""
+    vmm.authd
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    A dict server for Dovecot's passdb and userdb dict drivers, which
+    speaks the dict-proxy protocol on a Unix socket.  The lookups are
+    answered from a cache of the accounts, with the same fields as the
+    functions dovecotpassword() and dovecotquotauser() from
+    create_tables.pgsql.
+"""
+
+import json
+import socketserver
+
+import psycopg2
+
+from vmm.daemon import TTLCache, fetch, serve
+from vmm.serviceset import SERVICES
+
+
+__all__ = ("AuthIndex", "serve_auth")
+
+# the longest request line accepted
+MAX_REQUEST = 1024
+_ESCAPES = {"\x01": "\x011", "\t": "\x01t", "\r": "\x01r", "\n": "\x01n"}
+_UNESCAPES = {"1": "\x01", "t": "\t", "r": "\r", "n": "\n"}
+
+
+def _tab_escape(value):
+    """Escapes *value* like Dovecot's str_tabescape()."""
+    return "".join(_ESCAPES.get(char, char) for char in value)
+
+
+def _tab_unescape(value):
+    """Reverses `_tab_escape()`."""
+    if "\x01" not in value:
+        return value
+    parts = value.split("\x01")
+    return parts[0] + "".join(
+        _UNESCAPES.get(part[:1], part[:1]) + part[1:] for part in parts[1:]
+    )
+
+
+class AuthIndex:
+    """Answers the passdb and userdb lookups from a cache.
+
+    The accounts are loaded on their first lookup.  At most *max_size*
+    accounts, including unknown ones, are cached; the least recently used
+    are dropped.  Each account is reloaded *ttl* seconds after it has been
+    loaded, or when it has been invalidated.
+
+    The connections are checked out of the *pool* per query."""
+
+    __slots__ = ("_accounts", "_pool")
+
+    def __init__(self, pool, max_size=100000, ttl=60):
+        self._pool = pool
+        self._accounts = TTLCache(max_size, ttl)
+
+    def _load(self, key):
+        """Returns a tuple (gid, account) for the *key* (localpart,
+        domainname).  gid is `None` for unknown domains and account is
+        `None` for unknown accounts, otherwise a dict with the fields of
+        the account."""
+        # fmt: off
+        sql = (
+            "SELECT dn.gid, users.passwd, ss.smtp, ss.pop3, ss.imap, ss.sieve, "
+            "       users.uid, dd.domaindir || '/' || users.uid, "
+            "       mf.format || ':~/' || ml.directory, "
+            "       '*:bytes=' || ql.bytes || ':messages=' || ql.messages "
+            "FROM domain_name dn "
+            "JOIN domain_data dd USING (gid) "
+            "LEFT JOIN users ON users.gid = dn.gid AND users.local_part = %s "
+            "LEFT JOIN service_set ss ON ss.ssid = COALESCE(users.ssid, dd.ssid) "
+            "LEFT JOIN maillocation ml ON ml.mid = users.mid "
+            "LEFT JOIN mailboxformat mf ON mf.fid = ml.fid "
+            "LEFT JOIN quotalimit ql ON ql.qid = COALESCE(users.qid, dd.qid) "
+            "WHERE dn.domainname = %s"
+        )
+        # fmt: on
+        localpart, domainname = key
+        rows = fetch(self._pool, sql, key)
+        if not rows:
+            return None, None
+        gid, passwd, *services, uid, home, mail, quota_rule = rows[0]
+        if passwd is None:
+            return gid, None
+        return gid, {
+            "user": "%s@%s" % (localpart, domainname),
+            "password": passwd,
+            "services": dict(zip(SERVICES, services)),
+            "uid": uid,
+            "gid": gid,
+            "home": home,
+            "mail": mail,
+            "quota_rule": quota_rule,
+        }
+
+    def account(self, user):
+        """Returns the dict of the account *user* (localpart@domainname),
+        or `None`."""
+        localpart, _, domainname = user.lower().rpartition("@")
+        if not localpart:
+            return None
+        return self._accounts.get((localpart, domainname), self._load)[1]
+
+    def passdb(self, user, service=None):
+        """Returns the passdb fields of the account *user*, like function
+        dovecotpassword().  When a *service* is given, `None` will be
+        returned, unless the account may use the *service*."""
+        account = self.account(user)
+        if account is None:
+            return None
+        if service is not None and not account["services"].get(service.lower()):
+            return None
+        return {"user": account["user"], "password": account["password"]}
+
+    def userdb(self, user):
+        """Returns the userdb fields of the account *user*, like function
+        dovecotquotauser()."""
+        account = self.account(user)
+        if account is None:
+            return None
+        return {
+            field: account[field]
+            for field in ("home", "uid", "gid", "mail", "quota_rule")
+        }
+
+    def lookup(self, key):
+        """Returns the value for the dict *key*: ``passdb/<user>``,
+        ``passdb/<service>/<user>`` or ``userdb/<user>``, with an optional
+        ``shared/`` or ``priv/`` prefix.  Returns `None`, when there is no
+        such value."""
+        for prefix in ("shared/", "priv/"):
+            if key.startswith(prefix):
+                key = key[len(prefix) :]
+                break
+        kind, _, user = key.partition("/")
+        if kind == "userdb":
+            return self.userdb(user)
+        if kind == "passdb":
+            service, _, address = user.partition("/")
+            if address:
+                return self.passdb(address, service)
+            return self.passdb(user)
+        return None
+
+    def invalidate(self, gid=None, table=None, local_part=None):
+        """Forgets the accounts of the domain with the *gid*, or all
+        accounts, when *gid* is `None`.  The changed *table* and
+        *local_part* are not needed, see `vmm.changes.Change`."""
+        if gid is None:
+            self._accounts.clear()
+        else:
+            self._accounts.discard_if(lambda value: value[0] in (gid, None))
+
+
+class DictHandler(socketserver.StreamRequestHandler):
+    """Answers the requests of a Dovecot dict-proxy client.  Only
+    lookups are supported."""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_REQUEST + 1)
+            if not line:
+                return
+            line = line.rstrip(b"\r\n").decode("utf-8", "replace")
+            if not line or line[0] == "H":
+                # the handshake isn't answered
+                continue
+            if line[0] == "L":
+                reply = self._lookup(_tab_unescape(line[1:].split("\t")[0]))
+            elif line[0] == "I":
+                # empty iteration
+                reply = ""
+            else:
+                reply = "F" + _tab_escape("unsupported command: " + line[0])
+            self.wfile.write(reply.encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+    def _lookup(self, key):
+        try:
+            value = self.server.index.lookup(key)
+        except psycopg2.Error:
+            return "Fdatabase error"
+        if value is None:
+            return "N"
+        return "O" + _tab_escape(json.dumps(value))
+
+
+def serve_auth(index, path, group=None):
+    """Answers the lookups of Dovecot from the AuthIndex *index* on the
+    Unix socket *path*, accessible by the *group*."""
+    serve(path, DictHandler, group, index=index)
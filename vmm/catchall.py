@@ -21,7 +21,7 @@
 from gettext import gettext as _
 
 from vmm.domain import get_gid
-from vmm.emailaddress import EmailAddress, DestinationEmailAddress as DestAddr
+from vmm.emailaddress import EmailAddress, destination_addresses
 from vmm.errors import AliasError as AErr
 from vmm.ext.postconf import Postconf
 from vmm.constants import ALIAS_EXCEEDS_EXPANSION_LIMIT, NO_SUCH_ALIAS, NO_SUCH_DOMAIN
@@ -59,9 +59,11 @@ class CatchallAlias:
         )
         # fmt: on
         dests = dbc.fetchall()
-        if dbc.rowcount > 0:
-            self._dests.extend(DestAddr(dest[0], self._dbh) for dest in dests)
         dbc.close()
+        if dests:
+            self._dests.extend(
+                destination_addresses((dest[0] for dest in dests), self._dbh)
+            )
 
     def _check_expansion(self, count_new):
         """Checks the current expansion limit of the alias."""
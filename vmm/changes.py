@@ -0,0 +1,155 @@
+# -*- coding: UTF-8 -*-
+# Copyright (c) 2014, Pascal Volk
+# See COPYING for distribution information.
+"""
+    vmm.changes
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Subscriber of the change feed, which is sent by the triggers from
+    pgsql/notify_changes.pgsql on the channel vmm_changes.  Caches use it
+    in order to drop the changed entries, instead of waiting until they
+    expire.
+"""
+
+import select
+import threading
+import time
+
+import psycopg2
+
+
+__all__ = ("CHANNEL", "Change", "ChangeFeed", "follow")
+
+CHANNEL = "vmm_changes"
+
+
+class Change:
+    """A changed row of the *table* in the domain with the *gid*.
+
+    *local_part* is the local part of the address of a changed account,
+    alias or relocated user, otherwise `None`.  *gid* is `None` for the
+    tables quotalimit, service_set and transport, whose rows may be used
+    by every domain.  *table* is `None`, when changes may have been
+    missed, so everything should be considered changed."""
+
+    __slots__ = ("gid", "local_part", "table")
+
+    def __init__(self, table, gid=None, local_part=None):
+        self.table = table
+        self.gid = gid
+        self.local_part = local_part
+
+    @classmethod
+    def from_payload(cls, payload):
+        """Creates a Change from the *payload* of a notification."""
+        fields = payload.split(" ", 2)
+        table = fields[0]
+        gid = int(fields[1]) if len(fields) > 1 else None
+        local_part = fields[2] if len(fields) > 2 else None
+        return cls(table, gid, local_part)
+
+    def __eq__(self, other):
+        if not isinstance(other, self.__class__):
+            return NotImplemented
+        return (self.table, self.gid, self.local_part) == (
+            other.table,
+            other.gid,
+            other.local_part,
+        )
+
+    def __hash__(self):
+        return hash((self.table, self.gid, self.local_part))
+
+    def __repr__(self):
+        return "%s(%r, %r, %r)" % (
+            self.__class__.__name__,
+            self.table,
+            self.gid,
+            self.local_part,
+        )
+
+
+class ChangeFeed:
+    """Listens on the channel `CHANNEL` with its own connection, which is
+    opened by calling *connect* without arguments.
+
+    When the connection is lost, it will be reopened every *retry*
+    seconds.  Since notifications may have been missed in the meantime, a
+    `Change` with the table `None` is delivered after the reconnect."""
+
+    __slots__ = ("_connect", "_dbh", "_retry")
+
+    def __init__(self, connect, retry=5):
+        self._connect = connect
+        self._retry = retry
+        self._dbh = None
+        self._listen()
+
+    def _listen(self):
+        dbh = self._connect()
+        dbh.autocommit = True
+        dbc = dbh.cursor()
+        dbc.execute("LISTEN " + CHANNEL)
+        dbc.close()
+        self._dbh = dbh
+
+    def _reconnect(self):
+        self.close()
+        while True:
+            try:
+                self._listen()
+                return
+            except psycopg2.OperationalError:
+                time.sleep(self._retry)
+
+    def poll(self, timeout=None):
+        """Waits at most *timeout* seconds, or forever, when *timeout* is
+        `None`, for notifications and returns the list of Changes
+        received, in the order of their commits.  The list is empty, when
+        the time is up."""
+        if self._dbh is None:
+            self._reconnect()
+            return [Change(None)]
+        try:
+            if select.select([self._dbh], [], [], timeout)[0]:
+                self._dbh.poll()
+        except (OSError, ValueError, psycopg2.Error):
+            self._reconnect()
+            return [Change(None)]
+        changes = []
+        while self._dbh.notifies:
+            notify = self._dbh.notifies.pop(0)
+            if notify.channel == CHANNEL:
+                changes.append(Change.from_payload(notify.payload))
+        return changes
+
+    def __iter__(self):
+        """Yields the Changes, as they arrive."""
+        while True:
+            yield from self.poll()
+
+    def close(self):
+        """Closes the connection."""
+        if self._dbh is not None:
+            if not self._dbh.closed:
+                self._dbh.close()
+            self._dbh = None
+
+
+def _invalidate(feed, caches):
+    for change in feed:
+        for cache in caches:
+            cache.invalidate(change.gid, change.table, change.local_part)
+
+
+def follow(feed, *caches):
+    """Starts a daemon thread, which calls ``cache.invalidate(gid, table,
+    local_part)`` of each of the *caches*, when a row of the domain with
+    the gid has been changed according to the ChangeFeed *feed*, see
+    `Change`.  gid is `None`, when all domains may be affected.  Returns
+    the thread."""
+    thread = threading.Thread(
+        target=_invalidate, args=(feed, caches), name="vmm-changes", daemon=True
+    )
+    thread.start()
+    return thread
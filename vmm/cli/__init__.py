@@ -22,10 +22,14 @@ from vmm.errors import VMMError
 
 __all__ = ("get_winsize", "read_pass", "w_err", "w_std")
 
-_std_write = os.sys.stdout.write
 _err_write = os.sys.stderr.write
 
 
+def _std_write(data):
+    # looked up on each call, so stdout can be redirected, see: vmm batch
+    os.sys.stdout.write(data)
+
+
 def w_std(*args):
     """Writes a line for each arg of *args*, encoded in the current
     ENCODING, to stdout.
@@ -12,7 +12,7 @@ import os
 from gettext import gettext as _
 
 from vmm.errors import VMMError
-from vmm.handler import Handler
+from vmm.handler import Handler, _db_operation
 from vmm.cli import read_pass
 from vmm.cli.config import CliConfig as Cfg
 from vmm.constants import ACCOUNT_EXISTS, INVALID_SECTION, NO_SUCH_ACCOUNT, TYPE_ACCOUNT
@@ -62,6 +62,7 @@ class CliHandler(Handler):
         else:
             raise VMMError(_("Invalid section: '%s'") % section, INVALID_SECTION)
 
+    @_db_operation
     def user_add(self, emailaddress, password=None, note=None):
         """Override the parent user_add() - add the interactive password
         dialog.
@@ -87,6 +88,7 @@ class CliHandler(Handler):
         self._make_account_dirs(acc)
         return password if should_create_random_password else None
 
+    @_db_operation
     def user_password(self, emailaddress, password=None, scheme=None):
         """Override the parent user_password() - add the interactive
         password dialog."""
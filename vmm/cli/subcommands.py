@@ -9,8 +9,12 @@
 """
 
 from gettext import gettext as _
+import csv
+import json
 import locale
+import os
 import platform
+import shlex
 
 from argparse import (
     Action,
@@ -18,12 +22,18 @@ from argparse import (
     ArgumentTypeError,
     RawDescriptionHelpFormatter,
 )
+from configparser import NoOptionError, NoSectionError
+from contextlib import ExitStack, redirect_stdout
+from datetime import datetime
 from textwrap import TextWrapper
 from time import strftime, strptime
 
+import psycopg2
+
 from vmm import ENCODING
 from vmm.cli import get_winsize, w_err, w_std
 from vmm.common import human_size, size_in_bytes, version_str, format_domain_default
+from vmm.config import BadOptionError, ConfigValueError
 from vmm.constants import (
     __copyright__,
     __date__,
@@ -31,14 +41,18 @@ from vmm.constants import (
     ACCOUNT_EXISTS,
     ALIAS_EXISTS,
     ALIASDOMAIN_ISDOMAIN,
+    DATABASE_ERROR,
     DOMAIN_ALIAS_EXISTS,
+    EX_SUCCESS,
     INVALID_ARGUMENT,
     RELOCATED_EXISTS,
     TYPE_ACCOUNT,
     TYPE_ALIAS,
     TYPE_RELOCATED,
+    VMM_ERROR,
 )
 from vmm.errors import VMMError
+from vmm.lookupd import MAP_NAMES
 from vmm.password import list_schemes
 from vmm.serviceset import SERVICES
 
@@ -51,12 +65,15 @@ __all__ = (
     "aliasdomain_delete",
     "aliasdomain_info",
     "aliasdomain_switch",
+    "authd",
+    "batch",
     "catchall_add",
     "catchall_delete",
     "catchall_info",
     "config_get",
     "config_set",
     "configure",
+    "disk_usage_refresh",
     "domain_add",
     "domain_delete",
     "domain_info",
@@ -64,6 +81,7 @@ __all__ = (
     "domain_quota",
     "domain_services",
     "domain_transport",
+    "export_maps",
     "get_user",
     "list_addresses",
     "list_aliases",
@@ -71,16 +89,20 @@ __all__ = (
     "list_pwschemes",
     "list_relocated",
     "list_users",
+    "lookupd",
+    "reap",
     "relocated_add",
     "relocated_delete",
     "relocated_info",
     "setup_parser",
     "user_add",
     "user_delete",
+    "user_import",
     "user_info",
     "user_name",
     "user_note",
     "user_password",
+    "user_passwords",
     "user_quota",
     "user_services",
     "user_transport",
@@ -163,6 +185,48 @@ def aliasdomain_switch(ctx):
     ctx.hdlr.aliasdomain_switch(ctx.args.fqdn.lower(), ctx.args.destination.lower())
 
 
+def authd(ctx):
+    """answer Dovecot's passdb and userdb lookups on a Unix socket"""
+    ctx.hdlr.authd(ctx.args.socket, ctx.args.group)
+
+
+def batch(ctx):
+    """run many subcommands, read from a file or stdin, one per line"""
+    parser = setup_parser()
+    total = failed = 0
+    if ctx.args.file != "-":
+        with open(ctx.args.file, encoding=ENCODING) as fobj:
+            lines = fobj.readlines()
+    elif os.sys.stdin.isatty():
+        lines = _read_lines_interactive()
+    else:
+        lines = os.sys.stdin
+    # the output of the subcommands goes to stderr, stdout gets the status
+    # lines only
+    out = os.sys.stdout
+    with ExitStack() as stack:
+        if ctx.args.single_transaction:
+            stack.enter_context(ctx.hdlr.transaction())
+        for num, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            total += 1
+            with redirect_stdout(os.sys.stderr):
+                status = _run_batch_command(ctx, parser, line)
+            status["line"] = num
+            if status["code"]:
+                failed += 1
+            out.write(json.dumps(status, sort_keys=True) + "\n")
+            out.flush()
+    if failed:
+        w_err(
+            VMM_ERROR,
+            _("%(failed)d of %(total)d subcommands failed.")
+            % {"failed": failed, "total": total},
+        )
+
+
 def catchall_add(ctx):
     """create a new catchall alias e-mail address"""
     ctx.hdlr.catchall_add(ctx.args.fqdn.lower(), *ctx.args.destination)
@@ -204,6 +268,16 @@ def configure(ctx):
     ctx.hdlr.configure(ctx.args.section)
 
 
+def disk_usage_refresh(ctx):
+    """refresh the cached disk usage of all accounts or of one domain"""
+    fqdn = ctx.args.fqdn.lower() if ctx.args.fqdn else None
+    scanned, total = ctx.hdlr.disk_usage_refresh(fqdn, ctx.args.full)
+    w_std(
+        _("Summarized the disk usage of %(scanned)d of %(total)d accounts.")
+        % {"scanned": scanned, "total": total}
+    )
+
+
 def domain_add(ctx):
     """create a new domain"""
     fqdn = ctx.args.fqdn.lower()
@@ -240,7 +314,11 @@ def domain_info(ctx):
             raise
     else:
         q_limit = "Storage: %(bytes)s; Messages: %(messages)s"
-        if not details:
+        if details == "du":
+            info["disk usage"] = _format_disk_usage(
+                info["disk usage"], info["disk usage scanned"]
+            )
+        if details in (None, "du"):
             info["bytes"] = human_size(info["bytes"])
             info["messages"] = locale.format("%d", info["messages"], True)
             info["quota limit/user"] = q_limit % info
@@ -293,6 +371,15 @@ def domain_note(ctx):
     ctx.hdlr.domain_note(ctx.args.fqdn.lower(), ctx.args.note)
 
 
+def export_maps(ctx):
+    """write the Postfix lookup tables into static maps"""
+    exported = ctx.hdlr.export_maps(ctx.args.force)
+    if not exported:
+        w_std(_("All maps are up to date."))
+    for name in exported:
+        w_std(_("Exported map: %s") % name)
+
+
 def get_user(ctx):
     """get the address of the user with the given UID"""
     _print_info(ctx, ctx.hdlr.user_by_uid(ctx.args.uid), _("Account"))
@@ -302,8 +389,11 @@ def list_domains(ctx):
     """list all domains / search domains by pattern"""
     matching = True if ctx.args.pattern else False
     pattern = ctx.args.pattern.lower() if matching else None
-    gids, domains = ctx.hdlr.domain_list(pattern)
-    _print_domain_list(gids, domains, matching)
+    after = ctx.args.after.lower() if ctx.args.after else None
+    domains = ctx.hdlr.domain_list(
+        pattern, stream=True, after=after, limit=ctx.args.limit
+    )
+    _print_domain_list(domains, matching)
 
 
 def list_pwschemes(ctx_unused):
@@ -330,8 +420,11 @@ def list_addresses(ctx, limit=None):
         limit = TYPE_ACCOUNT | TYPE_ALIAS | TYPE_RELOCATED
     matching = True if ctx.args.pattern else False
     pattern = ctx.args.pattern.lower() if matching else None
-    gids, addresses = ctx.hdlr.address_list(limit, pattern)
-    _print_address_list(limit, gids, addresses, matching)
+    after = ctx.args.after.lower() if ctx.args.after else None
+    addresses = ctx.hdlr.address_list(
+        limit, pattern, stream=True, after=after, limit=ctx.args.limit
+    )
+    _print_address_list(limit, addresses, matching)
 
 
 def list_users(ctx):
@@ -349,6 +442,20 @@ def list_relocated(ctx):
     return list_addresses(ctx, TYPE_RELOCATED)
 
 
+def lookupd(ctx):
+    """answer Postfix' lookups on a Unix socket"""
+    ctx.hdlr.lookupd(ctx.args.socket, ctx.args.group, ctx.args.tcp_table)
+
+
+def reap(ctx):
+    """remove the directories, which have been moved into the trash"""
+    entries, removed = ctx.hdlr.reap(ctx.args.workers, ctx.args.rate)
+    w_std(
+        _("Removed %(entries)d trash entries (%(removed)d files and directories).")
+        % {"entries": entries, "removed": removed}
+    )
+
+
 def relocated_add(ctx):
     """create a new record for a relocated user"""
     ctx.hdlr.relocated_add(ctx.args.address.lower(), ctx.args.newaddress)
@@ -394,6 +501,17 @@ def user_delete(ctx):
     )
 
 
+def user_import(ctx):
+    """create many new e-mail users, read from a CSV or JSON Lines file"""
+    records = _read_records_file(ctx)
+    generated = ctx.hdlr.bulk_user_add(records)
+    w_std(_("Created %d accounts.") % len(records))
+    if generated:
+        msg = _("Generated passwords")
+        w_std(msg, "-" * len(msg))
+        w_std(*("\t%s: %s" % (address, password) for address, password in generated))
+
+
 def user_info(ctx):
     """display information about the given address"""
     address = ctx.args.address.lower()
@@ -412,6 +530,10 @@ def user_info(ctx):
             raise
     else:
         if ctx.args.details in (None, "du"):
+            if "disk usage" in info:
+                info["disk usage"] = _format_disk_usage(
+                    info["disk usage"], info["disk usage scanned"]
+                )
             info["quota storage"] = _format_quota_usage(
                 info["ql_bytes"], info["uq_bytes"], True, info["ql_domaindefault"]
             )
@@ -422,6 +544,10 @@ def user_info(ctx):
             )
             _print_info(ctx, info, _("Account"))
         else:
+            if "disk usage" in info[0]:
+                info[0]["disk usage"] = _format_disk_usage(
+                    info[0]["disk usage"], info[0]["disk usage scanned"]
+                )
             info[0]["quota storage"] = _format_quota_usage(
                 info[0]["ql_bytes"],
                 info[0]["uq_bytes"],
@@ -459,6 +585,18 @@ def user_note(ctx):
     ctx.hdlr.user_note(ctx.args.address.lower(), ctx.args.note)
 
 
+def user_passwords(ctx):
+    """update the passwords of many addresses, read from a CSV or JSON Lines
+    file"""
+    records = _read_records_file(ctx)
+    generated = ctx.hdlr.bulk_user_password(records, ctx.args.scheme)
+    w_std(_("Updated %d passwords.") % len(records))
+    if generated:
+        msg = _("Generated passwords")
+        w_std(msg, "-" * len(msg))
+        w_std(*("\t%s: %s" % (address, password) for address, password in generated))
+
+
 def user_quota(ctx):
     """update the quota limit for the given address"""
     ctx.hdlr.user_quotalimit(
@@ -525,6 +663,37 @@ def setup_parser():
             raise ArgumentTypeError(str(error))
         return storage
 
+    def positive_int(string):
+        try:
+            value = int(string)
+        except ValueError as error:
+            raise ArgumentTypeError(str(error))
+        if value < 1:
+            raise ArgumentTypeError(_("must be a positive number: '%s'") % string)
+        return value
+
+    def non_negative_int(string):
+        try:
+            value = int(string)
+        except ValueError as error:
+            raise ArgumentTypeError(str(error))
+        if value < 0:
+            raise ArgumentTypeError(_("must not be a negative number: '%s'") % string)
+        return value
+
+    def add_paging_arguments(parser, metavar):
+        parser.add_argument(
+            "--limit",
+            type=positive_int,
+            metavar="N",
+            help=_("list at most N entries"),
+        )
+        parser.add_argument(
+            "--after",
+            metavar=metavar,
+            help=_("list only the entries sorted after %s") % metavar,
+        )
+
     old_rw = txt_wrpr.replace_whitespace
     txt_wrpr.replace_whitespace = False
 
@@ -619,6 +788,209 @@ def setup_parser():
     )
     cf.set_defaults(func=configure, scmd="configure")
 
+    bt = a(
+        "batch",
+        aliases=("bt", "shell"),
+        help=_("run many subcommands, read from a file or stdin"),
+        epilog=fill(
+            _(
+                "Reads subcommands, one per line, from the given file or "
+                "from stdin and runs them all with the same configuration "
+                "and database connection. Empty lines and lines starting "
+                "with # are ignored. Arguments are split like in a shell.\n\n"
+                "After each subcommand, a status line will be written to "
+                "stdout. It is a JSON object with the keys: line, command, "
+                "status ('ok' or 'error'), code, message and warnings. The "
+                "output of the subcommands is written to stderr.\n\n"
+                "Each subcommand runs in its own transaction. When a "
+                "subcommand fails, all of its changes are rolled back and "
+                "the next subcommand will be run.\n\n"
+                "With the option --single-transaction the changes of all "
+                "successful subcommands are committed at once, after the "
+                "last subcommand. This is much faster for many small "
+                "subcommands."
+            )
+        ),
+        formatter_class=RawDescriptionHelpFormatter,
+    )
+    bt.add_argument(
+        "file",
+        nargs="?",
+        default="-",
+        help=_("the file with the subcommands; default: stdin"),
+    )
+    bt.add_argument(
+        "--single-transaction",
+        action="store_true",
+        help=_("commit the changes of all subcommands at once"),
+    )
+    bt.set_defaults(func=batch, scmd="batch")
+
+    dr = a(
+        "durefresh",
+        aliases=("dr", "du-refresh"),
+        help=_("refresh the cached disk usage of the accounts"),
+        epilog=fill(
+            _(
+                "This subcommand summarizes the disk usage of the accounts' "
+                "mail directories and stores it in the database, where it "
+                "is read from by the subcommands userinfo and domaininfo.\n\n"
+                "Only those mail directories will be summarized, whose "
+                "home, mail, new or cur directory has been modified since "
+                "the last run. Use the option --full in order to summarize "
+                "all mail directories."
+            )
+        ),
+        formatter_class=RawDescriptionHelpFormatter,
+    )
+    dr.add_argument(
+        "fqdn",
+        nargs="?",
+        help=_("refresh only the accounts of the given domain"),
+    )
+    dr.add_argument(
+        "--full",
+        action="store_true",
+        help=_("summarize all mail directories"),
+    )
+    dr.set_defaults(func=disk_usage_refresh, scmd="durefresh")
+
+    em = a(
+        "exportmaps",
+        aliases=("em",),
+        help=_("write the Postfix lookup tables into static maps"),
+        epilog=fill(
+            _(
+                "This subcommand writes the results of Postfix' lookup "
+                "tables virtual_alias_maps, virtual_mailbox_maps, "
+                "transport_maps, relocated_maps and smtpd_sender_login_maps "
+                "into static maps in the directory misc.map_directory. They "
+                "can be used instead of the pgsql lookup tables, so that "
+                "Postfix doesn't have to query the database for each "
+                "recipient.\n\n"
+                "Only those maps will be written, whose tables have been "
+                "modified since the last run. Use the option --force in "
+                "order to write all maps."
+            )
+        ),
+        formatter_class=RawDescriptionHelpFormatter,
+    )
+    em.add_argument(
+        "--force",
+        action="store_true",
+        help=_("write all maps"),
+    )
+    em.set_defaults(func=export_maps, scmd="exportmaps")
+
+    aud = a(
+        "authd",
+        aliases=("aud",),
+        help=_("answer Dovecot's passdb and userdb lookups on a Unix socket"),
+        epilog=fill(
+            _(
+                "This subcommand runs a dict server for Dovecot, which speaks "
+                "the dict-proxy protocol on a Unix socket, until it is "
+                "terminated. The keys passdb/SERVICE/USER and userdb/USER "
+                "are answered from memory, with the same fields as the "
+                "functions dovecotpassword() and dovecotquotauser(). The "
+                "accounts are loaded on demand and reloaded after "
+                "misc.authd_cache_ttl seconds."
+            )
+        ),
+        formatter_class=RawDescriptionHelpFormatter,
+    )
+    aud.add_argument(
+        "-s",
+        metavar="SOCKET",
+        dest="socket",
+        help=_("the path of the Unix socket; default: misc.authd_socket"),
+    )
+    aud.add_argument(
+        "-g",
+        metavar="GROUP",
+        dest="group",
+        default="dovecot",
+        help=_("the group, which may connect to the socket; default: dovecot"),
+    )
+    aud.set_defaults(func=authd, scmd="authd")
+
+    lkd = a(
+        "lookupd",
+        aliases=("lkd",),
+        help=_("answer Postfix' lookups on a Unix socket"),
+        epilog=fill(
+            _(
+                "This subcommand runs a lookup daemon for Postfix, which "
+                "speaks the socketmap protocol on a Unix socket, until it is "
+                "terminated. The maps virtual_alias, virtual_mailbox, uid, "
+                "gid, transport, relocated and sender_login are answered "
+                "from memory, with the same results as the pgsql lookup "
+                "tables, e.g.:\n\n"
+                "virtual_alias_maps = socketmap:unix:/run/vmm/lookupd:"
+                "virtual_alias\n\n"
+                "The domains are loaded on demand and reloaded after "
+                "misc.lookupd_cache_ttl seconds."
+            )
+        ),
+        formatter_class=RawDescriptionHelpFormatter,
+    )
+    lkd.add_argument(
+        "-s",
+        metavar="SOCKET",
+        dest="socket",
+        help=_("the path of the Unix socket; default: misc.lookupd_socket"),
+    )
+    lkd.add_argument(
+        "-g",
+        metavar="GROUP",
+        dest="group",
+        default="postfix",
+        help=_("the group, which may connect to the socket; default: postfix"),
+    )
+    lkd.add_argument(
+        "--tcp-table",
+        choices=sorted(MAP_NAMES),
+        metavar="MAP",
+        help=_("speak the tcp_table protocol and answer the lookups of MAP"),
+    )
+    lkd.set_defaults(func=lookupd, scmd="lookupd")
+
+    rp = a(
+        "reap",
+        aliases=("rp",),
+        help=_("remove the directories from the trash"),
+        epilog=fill(
+            _(
+                "When the setting misc.deferred_deletion is enabled, the "
+                "directories of deleted domains and accounts are moved into "
+                "the trash directory `.trash' in the base directory. This "
+                "subcommand removes them in the background, e.g. from a "
+                "cron job.\n\nThe number of worker threads and the number "
+                "of removed files per second can be limited, in order to "
+                "leave enough I/O capacity for the mail services."
+            )
+        ),
+        formatter_class=RawDescriptionHelpFormatter,
+    )
+    rp.add_argument(
+        "-w",
+        type=positive_int,
+        metavar="WORKERS",
+        dest="workers",
+        help=_("the number of worker threads; default: misc.reap_workers"),
+    )
+    rp.add_argument(
+        "-r",
+        type=non_negative_int,
+        metavar="RATE",
+        dest="rate",
+        help=_(
+            "remove at most RATE files per second, 0 means unlimited; "
+            "default: misc.reap_rate"
+        ),
+    )
+    rp.set_defaults(func=reap, scmd="reap")
+
     gu = a(
         "getuser",
         aliases=("gu",),
@@ -653,6 +1025,7 @@ def setup_parser():
     ll.add_argument(
         "-p", help=_("the pattern to search for"), metavar="PATTERN", dest="pattern"
     )
+    add_paging_arguments(ll, "ADDRESS")
     ll.set_defaults(func=list_addresses, scmd="listaddresses")
 
     la = a(
@@ -674,6 +1047,7 @@ def setup_parser():
     la.add_argument(
         "-p", help=_("the pattern to search for"), metavar="PATTERN", dest="pattern"
     )
+    add_paging_arguments(la, "ADDRESS")
     la.set_defaults(func=list_aliases, scmd="listaliases")
 
     ld = a(
@@ -695,6 +1069,7 @@ def setup_parser():
     ld.add_argument(
         "-p", help=_("the pattern to search for"), metavar="PATTERN", dest="pattern"
     )
+    add_paging_arguments(ld, "DOMAIN")
     ld.set_defaults(func=list_domains, scmd="listdomains")
 
     lr = a(
@@ -716,6 +1091,7 @@ def setup_parser():
     lr.add_argument(
         "-p", help=_("the pattern to search for"), metavar="PATTERN", dest="pattern"
     )
+    add_paging_arguments(lr, "ADDRESS")
     lr.set_defaults(func=list_relocated, scmd="listrelocated")
 
     lu = a(
@@ -737,6 +1113,7 @@ def setup_parser():
     lu.add_argument(
         "-p", help=_("the pattern to search for"), metavar="PATTERN", dest="pattern"
     )
+    add_paging_arguments(lu, "ADDRESS")
     lu.set_defaults(func=list_users, scmd="listusers")
 
     lp = a(
@@ -789,7 +1166,15 @@ def setup_parser():
     )
     da.set_defaults(func=domain_add, scmd="domainadd")
 
-    details = ("accounts", "aliasdomains", "aliases", "catchall", "relocated", "full")
+    details = (
+        "accounts",
+        "aliasdomains",
+        "aliases",
+        "catchall",
+        "du",
+        "relocated",
+        "full",
+    )
     di = a(
         "domaininfo",
         aliases=("di",),
@@ -799,7 +1184,7 @@ def setup_parser():
                 "This subcommand shows some information about the "
                 "given domain.\n\nFor a more detailed information about the "
                 "domain the optional argument details can be specified. A "
-                "possible details value can be one of the following six "
+                "possible details value can be one of the following seven "
                 "keywords:\n"
             )
             + mklst(details)
@@ -1048,6 +1433,40 @@ def setup_parser():
     )
     ua.set_defaults(func=user_add, scmd="useradd")
 
+    uim = a(
+        "userimport",
+        aliases=("uim",),
+        help=_("create many new e-mail users from a CSV or JSON Lines file"),
+        epilog=fill(
+            _(
+                "Use this subcommand to create many e-mail accounts at once. "
+                "Each record has the fields: address, password or pwhash, "
+                "name, note, quota, quota_messages, services and transport. "
+                "Only the address is required, empty fields select the "
+                "domain's defaults. CSV files need a header line with the "
+                "field names, JSON Lines files contain one object per line."
+                "\n\nAll records are checked before the first account is "
+                "created. All accounts are stored in a single transaction, "
+                "their directories are created afterwards.\n\nWhen a record "
+                "has no password and account.random_password is set to true, "
+                "vmm will generate a random password and print it to stdout "
+                "after the accounts have been created."
+            )
+        ),
+        formatter_class=RawDescriptionHelpFormatter,
+    )
+    uim.add_argument(
+        "file", help=_("the file with the account records, '-' reads stdin")
+    )
+    uim.add_argument(
+        "-f",
+        choices=("csv", "jsonl"),
+        metavar="FORMAT",
+        dest="format",
+        help=_("the file format: csv or jsonl; default: guessed from the file name"),
+    )
+    uim.set_defaults(func=user_import, scmd="userimport")
+
     details = ("aliases", "du", "full")
     ui = a(
         "userinfo",
@@ -1152,6 +1571,46 @@ def setup_parser():
     )
     up.set_defaults(func=user_password, scmd="userpassword")
 
+    ups = a(
+        "userpasswords",
+        aliases=("ups",),
+        help=_("update the passwords of many users from a CSV or JSON Lines file"),
+        epilog=fill(
+            _(
+                "Use this subcommand to update the passwords of many e-mail "
+                "accounts at once. Each record has the fields: address and "
+                "password or pwhash. CSV files need a header line with the "
+                "field names, JSON Lines files contain one object per line."
+                "\n\nAll records are checked before the first password is "
+                "updated. The passwords are hashed in parallel, by "
+                "misc.password_hash_workers processes, and stored in a single "
+                "transaction. When the scheme was omitted, vmm will use "
+                "misc.password_scheme from vmm.cfg.\n\nWhen a record has no "
+                "password and account.random_password is set to true, vmm will "
+                "generate a random password and print it to stdout after the "
+                "passwords have been updated."
+            )
+        ),
+        formatter_class=RawDescriptionHelpFormatter,
+    )
+    ups.add_argument(
+        "file", help=_("the file with the password records, '-' reads stdin")
+    )
+    ups.add_argument(
+        "-f",
+        choices=("csv", "jsonl"),
+        metavar="FORMAT",
+        dest="format",
+        help=_("the file format: csv or jsonl; default: guessed from the file name"),
+    )
+    ups.add_argument(
+        "-s",
+        metavar="SCHEME",
+        dest="scheme",
+        help=_("scheme used for password hashing"),
+    )
+    ups.set_defaults(func=user_passwords, scmd="userpasswords")
+
     uq = a(
         "userquota",
         aliases=("uq",),
@@ -1438,6 +1897,133 @@ def setup_parser():
     return parser
 
 
+def _read_lines_interactive():
+    """Yields the lines entered at the batch prompt, until EOF."""
+    while True:
+        try:
+            yield input("vmm> ")
+        except EOFError:
+            w_std("")
+            return
+
+
+def _run_batch_command(ctx, parser, line):
+    """Run the subcommand *line* with the handler of the batch *ctx*.
+
+    The subcommand runs in its own (nested) transaction.  When it fails,
+    all of its changes will be rolled back.  Returns a dict with the
+    status of the subcommand."""
+    status = {"command": line, "code": EX_SUCCESS, "message": None}
+    try:
+        args = parser.parse_args(shlex.split(line))
+    except ValueError as err:
+        status.update(code=INVALID_ARGUMENT, message=str(err))
+    except SystemExit as err:
+        # help was requested or argparse complained already on stderr
+        if err.code:
+            status.update(code=INVALID_ARGUMENT, message=_("Invalid arguments."))
+    else:
+        if args.scmd in ("authd", "batch", "configure", "lookupd"):
+            msg = _("The subcommand '%s' can't be used in batch mode.") % args.scmd
+            status.update(code=INVALID_ARGUMENT, message=msg)
+        else:
+            status["message"] = _run_batch_func(ctx, args, status)
+    status["status"] = "error" if status["code"] else "ok"
+    status["warnings"] = ctx.hdlr.get_warnings()
+    return status
+
+
+def _run_batch_func(ctx, args, status):
+    """Call the function of the parsed subcommand *args*, sets the error
+    code in *status* on failure and returns the error message."""
+    try:
+        with ctx.hdlr.transaction():
+            args.func(RunContext(args, ctx.hdlr))
+        return None
+    except VMMError as err:
+        status["code"], msg = err.code, err.msg
+    except (BadOptionError, ConfigValueError) as err:
+        status["code"], msg = INVALID_ARGUMENT, str(err)
+    except NoSectionError as err:
+        status["code"] = INVALID_ARGUMENT
+        msg = _("Unknown section: '%s'") % err.section
+    except NoOptionError as err:
+        status["code"] = INVALID_ARGUMENT
+        msg = _("No option '%(option)s' in section: '%(section)s'") % {
+            "option": err.option,
+            "section": err.section,
+        }
+    except psycopg2.Error as err:
+        status["code"], msg = DATABASE_ERROR, str(err).strip()
+    except Exception as err:
+        # e.g. an OSError, don't abort the remaining subcommands
+        status["code"] = VMM_ERROR
+        msg = "%s: %s" % (err.__class__.__name__, err)
+    return msg
+
+
+def _read_records_file(ctx):
+    """Read the records for userimport and userpasswords from the file
+    ctx.args.file, or from stdin if it is '-'."""
+    fmt = ctx.args.format
+    if fmt is None:
+        fmt = "jsonl" if ctx.args.file.endswith((".json", ".jsonl")) else "csv"
+    if ctx.args.file == "-":
+        return _read_records(os.sys.stdin, fmt)
+    with open(ctx.args.file, newline="", encoding=ENCODING) as fobj:
+        return _read_records(fobj, fmt)
+
+
+def _read_records(fobj, fmt):
+    """Read the account records for userimport and userpasswords from the
+    file object *fobj*.
+
+    *fmt* is either 'csv' (with a header line naming the fields) or 'jsonl'
+    (one JSON object per line).  Returns a list of dicts."""
+    records = []
+    if fmt == "csv":
+        reader = csv.DictReader(fobj, skipinitialspace=True)
+        try:
+            for record in reader:
+                if None in record:
+                    raise VMMError(
+                        _("Too many fields in line %d.") % reader.line_num,
+                        INVALID_ARGUMENT,
+                    )
+                records.append(
+                    {
+                        key.strip(): value.strip()
+                        for key, value in record.items()
+                        if value is not None
+                    }
+                )
+        except csv.Error as err:
+            raise VMMError(
+                _("Invalid CSV data in line %(num)d: %(reason)s")
+                % {"num": reader.line_num, "reason": err},
+                INVALID_ARGUMENT,
+            )
+    else:
+        for num, line in enumerate(fobj, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as err:
+                raise VMMError(
+                    _("Invalid JSON data in line %(num)d: %(reason)s")
+                    % {"num": num, "reason": err},
+                    INVALID_ARGUMENT,
+                )
+            if not isinstance(record, dict):
+                raise VMMError(
+                    _("Line %d does not contain a JSON object.") % num,
+                    INVALID_ARGUMENT,
+                )
+            records.append(record)
+    return records
+
+
 def _get_order(ctx):
     """returns a tuple with (key, 1||0) tuples. Used by functions, which
     get a dict from the handler."""
@@ -1456,6 +2042,8 @@ def _get_order(ctx):
             ("relocated", 0),
             ("catch-all dests", 0),
         )
+        if ctx.args.details == "du":
+            order += (("disk usage", 0),)
     elif ctx.args.scmd == "userinfo":
         if ctx.args.details in ("du", "full") or ctx.cget("account.disk_usage"):
             order = (
@@ -1516,6 +2104,30 @@ def _format_quota_usage(limit, used, human=False, domaindefault=False):
     return fmt(_("[%(percent)s%%] %(used)s/%(limit)s") % q_usage)
 
 
+def _format_disk_usage(size, scanned):
+    """Formats the disk usage *size* in bytes.  When the value has been
+    read from the cache, the age of the value will be appended."""
+    size = human_size(size)
+    if scanned is None:
+        return size
+    age = (datetime.now(scanned.tzinfo) - scanned).total_seconds()
+    # TP: abbreviations of days, hours, minutes and seconds
+    for unit, seconds in (
+        (_("d"), 86400),
+        (_("h"), 3600),
+        (_("min"), 60),
+        (_("s"), 1),
+    ):
+        if age >= seconds or seconds == 1:
+            break
+    # TP: e.g.: '%(size)s (%(age)d %(unit)s old)' -> '118.30 MiB (3 h old)'
+    return _("%(size)s (%(age)d %(unit)s old)") % {
+        "size": size,
+        "age": max(age, 0) // seconds,
+        "unit": unit,
+    }
+
+
 def _print_info(ctx, info, title):
     """Print info dicts."""
     # TP: used in e.g. 'Domain information' or 'Account information'
@@ -1599,23 +2211,30 @@ def _format_domain(domain, main=True):
     return "\t[-]     %s" % domain
 
 
-def _print_domain_list(dids, domains, matching):
-    """Print a list of (matching) domains/alias domains."""
+def _print_domain_list(domains, matching):
+    """Print a list of (matching) domains/alias domains.
+
+    *domains* is an iterable of (gid, names) tuples, as returned by
+    `Handler.domain_list()` in stream mode."""
     title = _("Matching domains") if matching else _("Existing domains")
     w_std(title, "-" * len(title))
-    if domains:
-        for did in dids:
-            if domains[did][0] is not None:
-                w_std(_format_domain(domains[did][0]))
-            if len(domains[did]) > 1:
-                w_std(*(_format_domain(a, False) for a in domains[did][1:]))
-    else:
+    found = False
+    for gid, names in domains:
+        found = True
+        if names[0] is not None:
+            w_std(_format_domain(names[0]))
+        if len(names) > 1:
+            w_std(*(_format_domain(a, False) for a in names[1:]))
+    if not found:
         w_std(_("\tNone"))
     print()
 
 
-def _print_address_list(which, dids, addresses, matching):
-    """Print a list of (matching) addresses."""
+def _print_address_list(which, addresses, matching):
+    """Print a list of (matching) addresses.
+
+    *addresses* is an iterable of (gid, addresses) tuples, as returned by
+    `Handler.address_list()` in stream mode."""
     _trans = {
         TYPE_ACCOUNT: _("user accounts"),
         TYPE_ALIAS: _("aliases"),
@@ -1635,26 +2254,27 @@ def _print_address_list(which, dids, addresses, matching):
         raise VMMError(
             _("Invalid address type for list: '%s'") % which, INVALID_ARGUMENT
         )
-    if addresses:
-        if which & (which - 1) == 0:
-            # only one type is requested, so no type indicator
-            _trans = {TYPE_ACCOUNT: "", TYPE_ALIAS: "", TYPE_RELOCATED: ""}
-        else:
-            _trans = {
-                # TP: the letters 'u', 'a' and 'r' are abbreviations of user,
-                # alias and relocated user
-                TYPE_ACCOUNT: _("u"),
-                TYPE_ALIAS: _("a"),
-                TYPE_RELOCATED: _("r"),
-            }
-        for did in dids:
-            for addr, atype, aliasdomain in addresses[did]:
-                if aliasdomain:
-                    leader = "[%s-]" % _trans[atype]
-                else:
-                    leader = "[%s+]" % _trans[atype]
-                w_std("\t%s %s" % (leader, addr))
+    if which & (which - 1) == 0:
+        # only one type is requested, so no type indicator
+        _trans = {TYPE_ACCOUNT: "", TYPE_ALIAS: "", TYPE_RELOCATED: ""}
     else:
+        _trans = {
+            # TP: the letters 'u', 'a' and 'r' are abbreviations of user,
+            # alias and relocated user
+            TYPE_ACCOUNT: _("u"),
+            TYPE_ALIAS: _("a"),
+            TYPE_RELOCATED: _("r"),
+        }
+    found = False
+    for gid, group in addresses:
+        for addr, atype, aliasdomain in group:
+            found = True
+            if aliasdomain:
+                leader = "[%s-]" % _trans[atype]
+            else:
+                leader = "[%s+]" % _trans[atype]
+            w_std("\t%s %s" % (leader, addr))
+    if not found:
         w_std(_("\tNone"))
     print()
 
@@ -13,6 +13,8 @@ import os
 import re
 import stat
 from gettext import gettext as _
+from itertools import count, groupby
+from operator import itemgetter
 
 from vmm import ENCODING
 from vmm.constants import (
@@ -29,6 +31,7 @@ VERSION_RE = re.compile(r"^(\d+)\.(\d+)\.(?:(\d+)|(alpha|beta|rc)(\d+))$")
 
 _version_level = dict(alpha=0xA, beta=0xB, rc=0xC)
 _version_cache = {}
+_cursor_ids = count(1)
 
 
 def expand_path(path):
@@ -233,64 +236,106 @@ def format_domain_default(domaindata):
     return _("%s [domain default]") % domaindata
 
 
-def _build_search_addresses_query(typelimit, lpattern, llike, dpattern, dlike):
+def named_cursor(dbh, fetch_size):
+    """Returns a new named (server-side) cursor of the connection *dbh*.
+
+    Iterating over the cursor will fetch *fetch_size* rows per round trip,
+    instead of transferring the whole result set at once.
+    """
+    dbc = dbh.cursor(name="vmm_cursor_%d" % next(_cursor_ids))
+    dbc.itersize = fetch_size
+    return dbc
+
+
+def _build_search_addresses_query(
+    typelimit, lpattern, llike, dpattern, dlike, after=None, limit=None
+):
     if typelimit is None:
         typelimit = TYPE_ACCOUNT | TYPE_ALIAS | TYPE_RELOCATED
-    selected_types = []
-    if typelimit & TYPE_ACCOUNT:
-        # fmt: off
-        selected_types.append(
-            "SELECT gid, local_part, %d AS type "
-            "FROM users" % TYPE_ACCOUNT
-        )
-        # fmt: on
-    if typelimit & TYPE_ALIAS:
-        # fmt: off
-        selected_types.append(
-            "SELECT DISTINCT gid, address AS local_part, %d AS type "
-            "FROM alias" % TYPE_ALIAS
-        )
-        # fmt: on
-    if typelimit & TYPE_RELOCATED:
-        # fmt: off
-        selected_types.append(
-            "SELECT gid, address AS local_part, %d AS type "
-            "FROM relocated" % TYPE_RELOCATED
-        )
-        # fmt: on
-    type_query = " UNION ".join(selected_types)
-
-    where = []
+    limit_query = "LIMIT %s" if limit else ""
+    branches = []
     sqlargs = []
-    for like, field, pattern in (
-        (dlike, "domainname", dpattern),
-        (llike, "local_part", lpattern),
+    for addrtype, table, column, distinct in (
+        (TYPE_ACCOUNT, "users", "local_part", ""),
+        (TYPE_ALIAS, "alias", "address", "DISTINCT"),
+        (TYPE_RELOCATED, "relocated", "address", ""),
     ):
-        if not like and not pattern:
+        if not typelimit & addrtype:
             continue
-        match = "LIKE" if like else "="
-        where.append(f"{field} {match} %s")
-        sqlargs.append(pattern)
-    where_query = f"WHERE ({' AND '.join(where)})" if where else ""
+        where = []
+        for like, field, pattern in (
+            (dlike, "dn.domainname", dpattern),
+            (llike, f"t.{column}", lpattern),
+        ):
+            if not like and not pattern:
+                continue
+            match = "LIKE" if like else "="
+            where.append(f"{field} {match} %s")
+            sqlargs.append(pattern)
+        if after:
+            # keyset pagination: continue after the last address of the
+            # previous page, instead of skipping the rows with OFFSET.  The
+            # condition and the LIMIT are applied within each type, so each
+            # page only reads its rows through the indexes on domain_name
+            # and (gid, local part) of the type's table.
+            # fmt: off
+            where.append(
+                f"(pn.domainname, dn.domainname, t.{column}) > ("
+                f"   COALESCE(("
+                f"       SELECT p.domainname "
+                f"       FROM domain_name d "
+                f"       JOIN domain_name p ON p.gid = d.gid AND p.is_primary "
+                f"       WHERE d.domainname = %s"
+                f"   ), %s), "
+                f"   %s, %s"
+                f")"
+            )
+            # fmt: on
+            sqlargs.extend((after[1], after[1], after[1], after[0]))
+        where_query = f"WHERE {' AND '.join(where)}" if where else ""
+        if limit:
+            sqlargs.append(limit)
+        # fmt: off
+        branches.append(
+            f"(SELECT {distinct} "
+            f"    pn.domainname AS primary_name, "
+            f"    dn.domainname, "
+            f"    t.{column} AS local_part, "
+            f"    t.gid, "
+            f"    t.{column} || '@' || dn.domainname AS address, "
+            f"    {addrtype} AS type, "
+            f"    NOT dn.is_primary AS from_aliasdomain "
+            f" FROM {table} t "
+            f" JOIN domain_name pn ON pn.gid = t.gid AND pn.is_primary "
+            f" JOIN domain_name dn ON dn.gid = t.gid "
+            f" {where_query} "
+            f" ORDER BY primary_name, domainname, local_part "
+            f" {limit_query})"
+        )
+        # fmt: on
+    if limit:
+        sqlargs.append(limit)
 
     # fmt: off
     sql = (
-        f"SELECT "
-        f"   gid, "
-        f"   local_part || '@' || domainname AS address, "
-        f"   type, "
-        f"   NOT is_primary AS from_aliasdomain "
-        f"FROM ({type_query}) a "
-        f"JOIN domain_name USING (gid) "
-        f"{where_query} "
-        f"ORDER BY domainname, local_part"
+        f"SELECT gid, address, type, from_aliasdomain "
+        f"FROM ({' UNION ALL '.join(branches)}) a "
+        f"ORDER BY primary_name, domainname, local_part "
+        f"{limit_query}"
     )
     # fmt: on
     return sql, sqlargs
 
 
 def search_addresses(
-    dbh, typelimit=None, lpattern=None, llike=False, dpattern=None, dlike=False
+    dbh,
+    typelimit=None,
+    lpattern=None,
+    llike=False,
+    dpattern=None,
+    dlike=False,
+    after=None,
+    limit=None,
 ):
     """'Search' for addresses by *pattern* in the database.
 
@@ -306,8 +351,18 @@ def search_addresses(
     *dpattern* and *dlike* behave analogously for the domain part of an
     address, allowing for separate pattern matching: testuser%@example.%
 
+    The addresses are sorted by the name of their primary domain, so the
+    addresses of alias domains follow those of their primary domain, then
+    by domain name and local part.
+
+    For keyset pagination, *after* may be a (local part, domain name) tuple
+    of the last address of the previous page, only the addresses sorted
+    after it will be returned.  *limit* restricts the number of returned
+    addresses.
+
     The return value of this function is a tuple. The first element is a list
-    of domain IDs sorted alphabetically by the corresponding domain names. The
+    of domain IDs sorted alphabetically by the corresponding primary domain
+    names. The
     second element is a dictionary indexed by domain ID, holding lists to
     associated addresses. Each address is itself actually a tuple of address,
     type, and boolean indicating whether the address stems from an alias
@@ -315,7 +370,7 @@ def search_addresses(
     """
     dbc = dbh.cursor()
     sql, sqlargs = _build_search_addresses_query(
-        typelimit, lpattern, llike, dpattern, dlike
+        typelimit, lpattern, llike, dpattern, dlike, after, limit
     )
     dbc.execute(sql, sqlargs)
     result = dbc.fetchall()
@@ -329,3 +384,84 @@ def search_addresses(
             daddrs[gid] = []
         daddrs[gid].append((address, addrtype, aliasdomain))
     return gids, daddrs
+
+
+def iter_addresses(
+    dbh,
+    typelimit=None,
+    lpattern=None,
+    llike=False,
+    dpattern=None,
+    dlike=False,
+    after=None,
+    limit=None,
+    fetch_size=1000,
+):
+    """Like `search_addresses()`, but the result is streamed through a
+    server-side cursor, which fetches *fetch_size* rows per round trip.
+
+    This generator yields the addresses grouped by domain ID, as
+    (gid, addresses) tuples, in the order of the primary domain names.  Each
+    *addresses* is an iterator over the (address, type, from_aliasdomain)
+    tuples of the group, it has to be consumed before the next group is
+    requested.  Each domain ID is yielded once, the addresses of its alias
+    domains are part of its group.
+    """
+    sql, sqlargs = _build_search_addresses_query(
+        typelimit, lpattern, llike, dpattern, dlike, after, limit
+    )
+    dbc = named_cursor(dbh, fetch_size)
+    try:
+        dbc.execute(sql, sqlargs)
+        for gid, rows in groupby(dbc, itemgetter(0)):
+            yield gid, (row[1:] for row in rows)
+    finally:
+        dbc.close()
+
+
+def classify_addresses(dbh, addresses):
+    """Classifies the EmailAddresses *addresses* with a single query.
+
+    Returns a dict, indexed by the addresses, with the types of each
+    address, combined with bitwise or, as value: `TYPE_ACCOUNT`,
+    `TYPE_ALIAS` and/or `TYPE_RELOCATED`.  The value of unknown addresses
+    is 0.  Addresses in alias domains belong to the domain's accounts,
+    aliases or relocated users."""
+    addresses = set(addresses)
+    types = dict.fromkeys(addresses, 0)
+    if not addresses:
+        return types
+    by_name = {(addr.domainname, addr.localpart): addr for addr in addresses}
+    dbc = dbh.cursor()
+    # fmt: off
+    dbc.execute(
+        "WITH addr AS ("
+        "   SELECT gid, domainname, local_part "
+        "   FROM unnest(%s::varchar[], %s::varchar[]) "
+        "        AS a (domainname, local_part) "
+        "   JOIN domain_name USING (domainname)"
+        ") "
+        "SELECT domainname, local_part, bit_or(type) "
+        "FROM ("
+        "   SELECT domainname, local_part, %s AS type "
+        "   FROM addr JOIN users USING (gid, local_part) "
+        "   UNION ALL "
+        "   SELECT domainname, local_part, %s "
+        "   FROM addr "
+        "   JOIN alias ON alias.gid = addr.gid AND address = local_part "
+        "   UNION ALL "
+        "   SELECT domainname, local_part, %s "
+        "   FROM addr "
+        "   JOIN relocated ON relocated.gid = addr.gid AND address = local_part"
+        ") AS found "
+        "GROUP BY domainname, local_part",
+        (
+            [name[0] for name in by_name], [name[1] for name in by_name],
+            TYPE_ACCOUNT, TYPE_ALIAS, TYPE_RELOCATED,
+        ),
+    )
+    # fmt: on
+    for domainname, localpart, found in dbc.fetchall():
+        types[by_name[(domainname, localpart)]] = found
+    dbc.close()
+    return types
@@ -33,9 +33,11 @@ from vmm.common import (
 from vmm.constants import CONF_ERROR, MIN_DOVECOT_VERSION
 from vmm.errors import ConfigError, VMMError
 from vmm.maillocation import known_format
+from vmm.maps import MAP_TYPES
 from vmm.password import verify_scheme as _verify_scheme
 
 DB_SSL_MODES = ("allow", "disabled", "prefer", "require", "verify-ca", "verify-full")
+DISK_USAGE_SOURCES = ("filesystem", "quota")
 
 
 class BadOptionError(Error):
@@ -318,20 +320,32 @@ class Config(LazyConfig):
                 "delete_directory": LCO(bool_t, False, self.getboolean),
                 "directory_mode": LCO(int, 448, self.getint),
                 "disk_usage": LCO(bool_t, False, self.getboolean),
+                "disk_usage_source": LCO(
+                    str, "filesystem", self.get_in_lower, check_disk_usage_source
+                ),
                 "password_length": LCO(int, 8, self.getint),
                 "random_password": LCO(bool_t, False, self.getboolean),
             },
             "bin": {
                 "doveadm": LCO(str, "/usr/bin/doveadm", self.get, exec_ok),
-                "du": LCO(str, "/usr/bin/du", self.get, exec_ok),
                 "postconf": LCO(str, "/usr/sbin/postconf", self.get, exec_ok),
+                "postmap": LCO(str, "/usr/sbin/postmap", self.get, exec_ok),
             },
             "database": {
+                "fetch_size": LCO(int, 1000, self.getint),
                 "host": LCO(str, "localhost", self.get),
                 "name": LCO(str, "mailsys", self.get),
                 "pass": LCO(str, None, self.get),
+                "pool_health_check": LCO(int, 30, self.getint),
+                "pool_idle_timeout": LCO(int, 300, self.getint),
+                "pool_max_size": LCO(int, 1, self.getint),
+                "pool_min_size": LCO(int, 0, self.getint),
                 "port": LCO(int, 5432, self.getint),
+                "replica_host": LCO(str, "", self.get),
+                "replica_max_lag": LCO(int, 30, self.getint),
+                "replica_port": LCO(int, 5432, self.getint),
                 "sslmode": LCO(str, "prefer", self.get, check_db_ssl_mode),
+                "statement_timeout": LCO(int, 0, self.getint),
                 "user": LCO(str, None, self.get),
             },
             "domain": {
@@ -354,14 +368,31 @@ class Config(LazyConfig):
                 "subscribe": LCO(bool_t, True, self.getboolean),
             },
             "misc": {
+                "authd_cache_size": LCO(int, 100000, self.getint),
+                "authd_cache_ttl": LCO(int, 60, self.getint),
+                "authd_socket": LCO(str, "/run/vmm/authd", self.get),
                 "base_directory": LCO(str, "/srv/mail", self.get, is_dir),
                 "crypt_blowfish_rounds": LCO(int, 5, self.getint),
+                "crypt_cache_file": LCO(
+                    str, "/var/cache/vmm/crypt_schemes.json", self.get
+                ),
                 "crypt_sha256_rounds": LCO(int, 5000, self.getint),
                 "crypt_sha512_rounds": LCO(int, 5000, self.getint),
+                "deferred_deletion": LCO(bool_t, False, self.getboolean),
+                "disk_usage_threads": LCO(int, 4, self.getint),
                 "dovecot_version": LCO(
                     str, None, self.hexversion, check_dovecot_version
                 ),
+                "listen_changes": LCO(bool_t, False, self.getboolean),
+                "lookupd_cache_size": LCO(int, 100000, self.getint),
+                "lookupd_cache_ttl": LCO(int, 60, self.getint),
+                "lookupd_socket": LCO(str, "/run/vmm/lookupd", self.get),
+                "map_directory": LCO(str, "/etc/postfix/vmm", self.get),
+                "map_type": LCO(str, "hash", self.get, check_map_type),
+                "password_hash_workers": LCO(int, 0, self.getint),
                 "password_scheme": LCO(str, "CRAM-MD5", self.get, verify_scheme),
+                "reap_rate": LCO(int, 0, self.getint, check_non_negative),
+                "reap_workers": LCO(int, 2, self.getint),
             },
         }
 
@@ -426,6 +457,11 @@ class Config(LazyConfig):
         value to a integer"""
         return size_in_bytes(self.get(section, option))
 
+    def get_in_lower(self, section, option):
+        """Returns the value of the `option` from `section`, converted
+        to lower case."""
+        return self.get(section, option).lower()
+
     def str(self, section, option):
         """Returns the value of the `option` from `section`, converted
         to Unicode."""
@@ -453,6 +489,17 @@ class Config(LazyConfig):
                 check_dovecot_version(value)
             except ConfigValueError as err:
                 self._missing["misc"] = ["dovecot_version: %s" % str(err)]
+        value = self.dget("misc.reap_rate")
+        try:
+            check_non_negative(value)
+        except ConfigValueError as err:
+            self._missing.setdefault("misc", []).append("reap_rate: %s" % err)
+        # section account
+        value = self.dget("account.disk_usage_source")
+        if value not in DISK_USAGE_SOURCES:
+            self._missing["account"] = [
+                "disk_usage_source: " + _("Unknown disk usage source: '%s'") % value
+            ]
         # section database
         db_err = []
         value = self.dget("database.sslmode")
@@ -491,6 +538,14 @@ def check_db_ssl_mode(ssl_mode):
     raise ConfigValueError(_("Unknown pgsql SSL mode: '%s'") % get_unicode(ssl_mode))
 
 
+def check_disk_usage_source(source):
+    """Check if the disk usage *source* is one of the DISK_USAGE_SOURCES."""
+    source = source.lower()
+    if source in DISK_USAGE_SOURCES:
+        return source
+    raise ConfigValueError(_("Unknown disk usage source: '%s'") % get_unicode(source))
+
+
 def check_mailbox_format(format):
     """
     Check if the mailbox format *format* is supported.  When the *format*
@@ -503,6 +558,23 @@ def check_mailbox_format(format):
     raise ConfigValueError(_("Unsupported mailbox format: '%s'") % get_unicode(format))
 
 
+def check_map_type(map_type):
+    """Check if the *map_type* is one of the types supported by
+    vmm.maps.export_maps()."""
+    map_type = map_type.lower()
+    if map_type in MAP_TYPES:
+        return map_type
+    raise ConfigValueError(_("Unsupported map type: '%s'") % get_unicode(map_type))
+
+
+def check_non_negative(value):
+    """Check if the int *value* is not negative.  Returns the *value* or
+    raises a `ConfigValueError`."""
+    if value < 0:
+        raise ConfigValueError(_("Not a non-negative number: '%s'") % value)
+    return value
+
+
 def check_size_value(value):
     """Check if the size value *value* has the proper format, e.g.: 1024k.
     Returns the validated value string if it has the expected format.
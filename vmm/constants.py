@@ -68,6 +68,7 @@ LOCALPART_INVALID = 47
 LOCALPART_TOO_LONG = 48
 MAILDIR_PERM_MISMATCH = 49
 MAILLOCATION_INIT = 50
+MAP_EXPORT_ERROR = 72
 NOT_EXECUTABLE = 51
 NO_SUCH_ACCOUNT = 52
 NO_SUCH_ALIAS = 53
@@ -78,6 +79,7 @@ NO_SUCH_DOMAIN = 57
 NO_SUCH_RELOCATED = 58
 RELOCATED_ADDR_DEST_IDENTICAL = 59
 RELOCATED_EXISTS = 60
+REAPER_RUNNING = 71
 UNKNOWN_SERVICE = 65
 VMM_ERROR = 67
 VMM_TOO_MANY_FAILURES = 68
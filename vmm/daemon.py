@@ -0,0 +1,145 @@
+# -*- coding: UTF-8 -*-
+# Copyright (c) 2014, Pascal Volk
+# See COPYING for distribution information.
+"""
+    vmm.daemon
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Building blocks of the lookup daemons: a bounded cache with expiring
+    entries, queries through a connection pool and a threading server
+    listening on a Unix socket.
+"""
+
+import grp
+import os
+import signal
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from gettext import gettext as _
+
+from vmm.constants import INVALID_ARGUMENT, NO_SUCH_DIRECTORY
+from vmm.errors import VMMError
+
+
+__all__ = ("TTLCache", "UnixServer", "fetch", "serve")
+
+
+class TTLCache:
+    """A thread safe cache of at most *max_size* entries, which expire
+    *ttl* seconds after they have been loaded.  When the cache is full,
+    the least recently used entry will be dropped.  A *ttl* of 0 keeps the
+    entries until they are dropped or discarded."""
+
+    __slots__ = ("_entries", "_generation", "_lock", "_max_size", "_ttl")
+
+    def __init__(self, max_size, ttl):
+        self._entries = OrderedDict()
+        # incremented by each discard, so that values, which have been
+        # loaded before, are not cached
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._max_size = max(max_size, 1)
+        self._ttl = ttl
+
+    def get(self, key, load):
+        """Returns the value cached for *key*.  When there is no such
+        value, or it has expired, `load(key)` will be called and its
+        result cached.  The result is not cached, when entries have been
+        discarded while it was loaded, since it may be outdated already."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (not self._ttl or now - entry[0] < self._ttl):
+                self._entries.move_to_end(key)
+                return entry[1]
+            generation = self._generation
+        value = load(key)
+        with self._lock:
+            if generation != self._generation:
+                return value
+            self._entries[key] = (now, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def discard(self, key):
+        """Removes the entry for *key*, if any."""
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+
+    def discard_if(self, predicate):
+        """Removes the entries, whose value satisfies the *predicate*."""
+        with self._lock:
+            self._generation += 1
+            for key in [k for k, v in self._entries.items() if predicate(v[1])]:
+                del self._entries[key]
+
+    def clear(self):
+        """Removes all entries."""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+def fetch(pool, sql, params=None):
+    """Executes the query *sql* with a connection from the *pool* and
+    returns all rows."""
+    dbh = pool.getconn()
+    try:
+        dbc = dbh.cursor()
+        dbc.execute(sql, params)
+        rows = dbc.fetchall()
+        dbc.close()
+    finally:
+        pool.putconn(dbh)
+    return rows
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves each client connection by its own thread."""
+
+    daemon_threads = True
+
+
+def _terminate(signum, frame):
+    raise SystemExit(0)
+
+
+def serve(path, handler_class, group=None, **attributes):
+    """Serves requests on the Unix socket *path* with the *handler_class*
+    until the process is terminated.  The socket is accessible by root
+    and the members of the *group* only.  The *attributes* are set on the
+    server, so the handlers can access them through `self.server`."""
+    if group:
+        try:
+            gid = grp.getgrnam(group).gr_gid
+        except KeyError:
+            raise VMMError(_("Unknown group: '%s'") % group, INVALID_ARGUMENT)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        raise VMMError(_("No such directory: %s") % directory, NO_SUCH_DIRECTORY)
+    if os.path.exists(path):
+        # left behind by a previous instance
+        os.unlink(path)
+    old_umask = os.umask(0o077)
+    try:
+        server = UnixServer(path, handler_class)
+    finally:
+        os.umask(old_umask)
+    try:
+        if group:
+            os.chown(path, 0, gid)
+            os.chmod(path, 0o660)
+        for name, value in attributes.items():
+            setattr(server, name, value)
+        if threading.current_thread() is threading.main_thread():
+            # leave through the finally clause
+            signal.signal(signal.SIGTERM, _terminate)
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
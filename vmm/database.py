@@ -0,0 +1,400 @@
+# -*- coding: UTF-8 -*-
+# Copyright (c) 2014, Pascal Volk
+# See COPYING for distribution information.
+"""
+    vmm.database
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    The database connection class used by the Handler, with units of work,
+    which share a single commit, an identity map for the small lookup
+    tables quotalimit, service_set, transport and maillocation, and a
+    thread safe connection pool.  Connections to a replica are checked
+    with `replication_lag()`.  The rows of the lookup tables are loaded
+    once per table and answered from memory afterwards.
+"""
+
+import threading
+import time
+
+import psycopg2.extensions
+
+
+__all__ = (
+    "Connection",
+    "ConnectionPool",
+    "LookupCache",
+    "get_pool",
+    "lookup_cache",
+    "replication_lag",
+)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# table: query, which returns (id, value...) rows
+_LOOKUP_QUERIES = {
+    "maillocation": (
+        "SELECT mid, format, directory "
+        "FROM maillocation "
+        "JOIN mailboxformat USING (fid)"
+    ),
+    "quotalimit": "SELECT qid, bytes, messages FROM quotalimit",
+    "service_set": "SELECT ssid, smtp, pop3, imap, sieve FROM service_set",
+    "transport": "SELECT tid, transport FROM transport",
+}
+
+
+class LookupCache:
+    """Identity map for the rows of the lookup tables.
+
+    The value of a row is the tuple of its columns, without the id: e.g.
+    (bytes, messages) for quotalimit.  Each table is loaded completely on
+    first use.  When an id or a value is not found, the table will be
+    reloaded once, since it may have been extended by another process.
+    A LookupCache may be shared by many connections and threads.
+
+    Rows inserted through a connection are only visible to that
+    connection, until its transaction has been committed."""
+
+    __slots__ = ("_by_id", "_by_value", "_lock")
+
+    def __init__(self):
+        self._by_id = {}
+        self._by_value = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _pending(dbh, table):
+        """Returns the list of (key, value) pairs of the uncommitted rows,
+        which have been added to the *table* through the connection
+        *dbh*."""
+        return [
+            (key, value)
+            for pending_table, key, value in getattr(dbh, "lookup_pending", ())
+            if pending_table == table
+        ]
+
+    def _load(self, dbh, table):
+        """(Re)loads all rows of the *table*.  The uncommitted rows of the
+        connection *dbh* are left out."""
+        dbc = dbh.cursor()
+        dbc.execute(_LOOKUP_QUERIES[table])
+        by_id = {row[0]: tuple(row[1:]) for row in dbc.fetchall()}
+        dbc.close()
+        for key, _ in self._pending(dbh, table):
+            by_id.pop(key, None)
+        with self._lock:
+            self._by_id[table] = by_id
+            self._by_value[table] = {value: key for key, value in by_id.items()}
+
+    def get(self, dbh, table, key):
+        """Returns the value of the row with the id *key* from the *table*,
+        or `None` if there is no such row."""
+        for pending_key, value in self._pending(dbh, table):
+            if pending_key == key:
+                return value
+        if table in self._by_id and key in self._by_id[table]:
+            return self._by_id[table][key]
+        self._load(dbh, table)
+        return self._by_id[table].get(key)
+
+    def find(self, dbh, table, value):
+        """Returns the id of the row with the *value* from the *table*, or
+        `None` if there is no such row."""
+        for key, pending_value in self._pending(dbh, table):
+            if pending_value == value:
+                return key
+        if table in self._by_value and value in self._by_value[table]:
+            return self._by_value[table][value]
+        self._load(dbh, table)
+        return self._by_value[table].get(value)
+
+    def add(self, dbh, table, key, value):
+        """Adds the new row *key*, *value*, which has been inserted through
+        the connection *dbh*, to the *table*.  The row is kept with the
+        connection, until it is published by the connection's commit, or
+        dropped by its rollback."""
+        dbh.lookup_pending.append((table, key, value))
+
+    def publish(self, entries):
+        """Adds the committed rows *entries*, a list of (table, key,
+        value) tuples, to the loaded tables."""
+        with self._lock:
+            for table, key, value in entries:
+                if table in self._by_id:
+                    self._by_id[table][key] = value
+                    self._by_value[table][value] = key
+
+    def clear(self):
+        """Forgets all loaded tables."""
+        with self._lock:
+            self._by_id.clear()
+            self._by_value.clear()
+
+
+class Connection(psycopg2.extensions.connection):
+    """A psycopg2 connection with a `LookupCache` and units of work.
+
+    Between `begin()` and `end()` the commits of vmm's classes are
+    deferred, so that all changes are committed at once, when the
+    outermost unit of work ends.  Each unit of work is guarded by a
+    savepoint: a rollback within a unit, or a failed unit, only discards
+    the changes made since the unit began.
+
+    Rows, which have been added to the cache, are published to the shared
+    cache after the transaction has been committed, and dropped, when they
+    are rolled back."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lookup_cache = LookupCache()
+        # (table, key, value) of the rows added to the cache, which have not
+        # been committed yet
+        self.lookup_pending = []
+        # (savepoint name, len(lookup_pending)) of each active unit of work
+        self._units = []
+
+    @property
+    def in_unit(self):
+        """`True` while a unit of work is active."""
+        return bool(self._units)
+
+    def _execute(self, sql):
+        dbc = self.cursor()
+        dbc.execute(sql)
+        dbc.close()
+
+    def _discard_pending(self, mark):
+        del self.lookup_pending[mark:]
+
+    def _commit(self):
+        """Commits the transaction and publishes the pending rows, when the
+        commit succeeded.  They are dropped in any case."""
+        entries = self.lookup_pending[:]
+        del self.lookup_pending[:]
+        super().commit()
+        self.lookup_cache.publish(entries)
+
+    def begin(self):
+        """Begins a (nested) unit of work."""
+        name = "vmm_unit_%d" % len(self._units)
+        self._execute("SAVEPOINT " + name)
+        self._units.append((name, len(self.lookup_pending)))
+
+    def end(self, success=True):
+        """Ends the innermost unit of work.  When the outermost unit ends
+        with *success*, the transaction will be committed.  Otherwise the
+        changes of the unit will be rolled back."""
+        name, mark = self._units[-1]
+        try:
+            if success:
+                if len(self._units) > 1:
+                    self._execute("RELEASE SAVEPOINT " + name)
+                else:
+                    self._commit()
+            elif len(self._units) > 1:
+                self._execute("ROLLBACK TO SAVEPOINT " + name)
+                self._execute("RELEASE SAVEPOINT " + name)
+                self._discard_pending(mark)
+            else:
+                super().rollback()
+                self._discard_pending(0)
+        finally:
+            self._units.pop()
+
+    def commit(self):
+        if self._units:
+            # deferred until the outermost unit of work ends
+            return
+        self._commit()
+
+    def rollback(self):
+        if self._units:
+            name, mark = self._units[-1]
+            self._execute("ROLLBACK TO SAVEPOINT " + name)
+            self._discard_pending(mark)
+            return
+        try:
+            super().rollback()
+        finally:
+            self._discard_pending(0)
+
+
+def lookup_cache(dbh):
+    """Returns the LookupCache of the connection *dbh*, or `None` if it is
+    a plain psycopg2 connection."""
+    return getattr(dbh, "lookup_cache", None)
+
+
+class ConnectionPool:
+    """A thread safe pool of database connections.
+
+    *connect* is called without arguments, in order to open a new
+    connection.  At most *max_size* connections will be open at the same
+    time; `getconn()` blocks until a connection is returned, when all of
+    them are in use.  Idle connections are closed after *idle_timeout*
+    seconds, but at least *min_size* connections are kept open.  Before a
+    connection, which has been idle for *health_check* seconds or longer,
+    is handed out, it is checked with a `SELECT 1`.  A *health_check* or
+    *idle_timeout* of 0 disables the check or the timeout.
+
+    The connections of the pool share one `LookupCache`."""
+
+    __slots__ = (
+        "_cond",
+        "_connect",
+        "_health_check",
+        "_idle",
+        "_idle_timeout",
+        "_max_size",
+        "_min_size",
+        "_size",
+        "lookup_cache",
+    )
+
+    def __init__(
+        self, connect, min_size=0, max_size=1, idle_timeout=300, health_check=30
+    ):
+        self._connect = connect
+        self._min_size = min_size
+        self._max_size = max(max_size, min_size, 1)
+        self._idle_timeout = idle_timeout
+        self._health_check = health_check
+        self._cond = threading.Condition()
+        # (connection, time of check in), the least recently used first
+        self._idle = []
+        # number of open connections, idle or checked out
+        self._size = 0
+        self.lookup_cache = LookupCache()
+        for _ in range(min_size):
+            self._size += 1
+            self._idle.append((self._open(), time.monotonic()))
+
+    def _open(self):
+        dbh = self._connect()
+        if hasattr(dbh, "lookup_cache"):
+            dbh.lookup_cache = self.lookup_cache
+        return dbh
+
+    def connect(self):
+        """Opens a new connection with the settings of the pool, which
+        is not managed by the pool."""
+        return self._connect()
+
+    def _close(self, dbh):
+        """Closes the connection *dbh* and frees its slot.  The caller has
+        to hold the lock."""
+        self._size -= 1
+        self._cond.notify()
+        try:
+            dbh.close()
+        except psycopg2.Error:
+            pass
+
+    def _prune(self):
+        """Closes the connections, which have been idle for too long.  The
+        caller has to hold the lock."""
+        if not self._idle_timeout:
+            return
+        expired = time.monotonic() - self._idle_timeout
+        while len(self._idle) > self._min_size and self._idle[0][1] < expired:
+            self._close(self._idle.pop(0)[0])
+
+    def _healthy(self, dbh, since):
+        if dbh.closed:
+            return False
+        if self._health_check and time.monotonic() - since >= self._health_check:
+            try:
+                dbc = dbh.cursor()
+                dbc.execute("SELECT 1")
+                dbc.close()
+                dbh.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def getconn(self):
+        """Checks a connection out of the pool."""
+        with self._cond:
+            while True:
+                self._prune()
+                if self._idle:
+                    dbh, since = self._idle.pop()
+                    break
+                if self._size < self._max_size:
+                    self._size += 1
+                    dbh = None
+                    break
+                self._cond.wait()
+        if dbh is not None:
+            if self._healthy(dbh, since):
+                return dbh
+            # the slot is reused for the new connection
+            try:
+                dbh.close()
+            except psycopg2.Error:
+                pass
+        try:
+            return self._open()
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, dbh, close=False):
+        """Checks the connection *dbh* back in.  An open transaction will
+        be rolled back.  Broken connections, or when *close* is `True`, are
+        closed."""
+        if not (close or dbh.closed):
+            status = dbh.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    dbh.rollback()
+                except psycopg2.Error:
+                    close = True
+        with self._cond:
+            if close or dbh.closed:
+                self._close(dbh)
+            else:
+                self._idle.append((dbh, time.monotonic()))
+                self._cond.notify()
+
+    def closeall(self):
+        """Closes all idle connections."""
+        with self._cond:
+            while self._idle:
+                self._close(self._idle.pop()[0])
+
+
+def get_pool(key, factory):
+    """Returns the pool registered under the hashable *key*.  When there is
+    no such pool, a new one will be created by calling *factory* and
+    registered.  So all Handlers with the same settings share one pool."""
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = factory()
+        return _pools[key]
+
+
+def replication_lag(dbh):
+    """Returns the number of seconds, by which the replica connected
+    through *dbh* lags behind its primary.  0 will be returned, when the
+    replica has replayed everything it received, or when *dbh* is
+    connected to a primary."""
+    # fmt: off
+    sql = (
+        "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+        "            THEN 0 "
+        "            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) "
+        "       END"
+    )
+    # fmt: on
+    dbc = dbh.cursor()
+    dbc.execute(sql)
+    lag = dbc.fetchone()[0]
+    dbc.close()
+    dbh.rollback()
+    return float(lag or 0)
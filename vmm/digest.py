@@ -0,0 +1,243 @@
+# -*- coding: UTF-8 -*-
+# Copyright (c) 2014, Pascal Volk
+# See COPYING for distribution information.
+"""
+    vmm.digest
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Pure Python implementations of the primitives, which are required by
+    some of Dovecot's password schemes, but are not (always) available in
+    hashlib:
+
+        md4 = MD4([data])
+        state = md5_compress(state, block)
+        cipher_text = des_encrypt(key, block)
+"""
+
+import struct
+from math import sin
+
+
+__all__ = ("MD4", "MD5_IV", "des_encrypt", "md5_compress")
+
+_MASK = 0xFFFFFFFF
+
+
+def _rotl(value, shift):
+    return ((value << shift) | (value >> (32 - shift))) & _MASK
+
+
+def _md4_f(x, y, z):
+    return (x & y) | (~x & z)
+
+
+def _md4_g(x, y, z):
+    return (x & y) | (x & z) | (y & z)
+
+
+class MD4:
+    """MD4 (RFC 1320) hash object, with the interface of hashlib's hash
+    objects.  OpenSSL 3 doesn't provide MD4 by default anymore."""
+
+    __slots__ = ("_buffer", "_length", "_state")
+
+    def __init__(self, data=b""):
+        self._state = (0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476)
+        self._buffer = b""
+        self._length = 0
+        self.update(data)
+
+    def update(self, data):
+        """Update the hash object with the bytes-like object *data*."""
+        self._length += len(data)
+        data = self._buffer + bytes(data)
+        offset = 0
+        while len(data) - offset >= 64:
+            self._state = self._compress(self._state, data[offset : offset + 64])
+            offset += 64
+        self._buffer = data[offset:]
+
+    def digest(self):
+        """Return the digest of the data passed to the update() method."""
+        bits = self._length * 8
+        padding = b"\x80" + bytes((55 - self._length) % 64)
+        data = self._buffer + padding + struct.pack("<Q", bits & (2**64 - 1))
+        state = self._state
+        for offset in range(0, len(data), 64):
+            state = self._compress(state, data[offset : offset + 64])
+        return struct.pack("<4I", *state)
+
+    def hexdigest(self):
+        """Like digest(), but the digest is returned as string of hex
+        digits."""
+        return self.digest().hex()
+
+    @staticmethod
+    def _compress(state, block):
+        x = struct.unpack("<16I", block)
+        a, b, c, d = state
+        for i in (0, 4, 8, 12):
+            a = _rotl((a + _md4_f(b, c, d) + x[i]) & _MASK, 3)
+            d = _rotl((d + _md4_f(a, b, c) + x[i + 1]) & _MASK, 7)
+            c = _rotl((c + _md4_f(d, a, b) + x[i + 2]) & _MASK, 11)
+            b = _rotl((b + _md4_f(c, d, a) + x[i + 3]) & _MASK, 19)
+        for i in (0, 1, 2, 3):
+            a = _rotl((a + _md4_g(b, c, d) + x[i] + 0x5A827999) & _MASK, 3)
+            d = _rotl((d + _md4_g(a, b, c) + x[i + 4] + 0x5A827999) & _MASK, 5)
+            c = _rotl((c + _md4_g(d, a, b) + x[i + 8] + 0x5A827999) & _MASK, 9)
+            b = _rotl((b + _md4_g(c, d, a) + x[i + 12] + 0x5A827999) & _MASK, 13)
+        for i in (0, 2, 1, 3):
+            a = _rotl((a + (b ^ c ^ d) + x[i] + 0x6ED9EBA1) & _MASK, 3)
+            d = _rotl((d + (a ^ b ^ c) + x[i + 8] + 0x6ED9EBA1) & _MASK, 9)
+            c = _rotl((c + (d ^ a ^ b) + x[i + 4] + 0x6ED9EBA1) & _MASK, 11)
+            b = _rotl((b + (c ^ d ^ a) + x[i + 12] + 0x6ED9EBA1) & _MASK, 15)
+        return tuple((v + w) & _MASK for v, w in zip(state, (a, b, c, d)))
+
+
+MD5_IV = (0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476)
+_MD5_K = tuple(int(abs(sin(i + 1)) * 2**32) & _MASK for i in range(64))
+_MD5_S = (
+    (7, 12, 17, 22) * 4 + (5, 9, 14, 20) * 4 + (4, 11, 16, 23) * 4 + (6, 10, 15, 21) * 4
+)
+
+
+def md5_compress(state, block):
+    """Applies the MD5 compression function to the 64 bytes *block* and
+    the (a, b, c, d) *state* tuple and returns the new state.
+
+    hashlib doesn't expose the intermediate state of a MD5 context, which
+    is stored by Dovecot's CRAM-MD5 scheme."""
+    x = struct.unpack("<16I", block)
+    a, b, c, d = state
+    for i in range(64):
+        if i < 16:
+            f = (b & c) | (~b & d)
+            g = i
+        elif i < 32:
+            f = (d & b) | (~d & c)
+            g = (5 * i + 1) % 16
+        elif i < 48:
+            f = b ^ c ^ d
+            g = (3 * i + 5) % 16
+        else:
+            f = c ^ (b | ~d)
+            g = (7 * i) % 16
+        f = (f + a + _MD5_K[i] + x[g]) & _MASK
+        a, d, c = d, c, b
+        b = (b + _rotl(f, _MD5_S[i])) & _MASK
+    return tuple((v + w) & _MASK for v, w in zip(state, (a, b, c, d)))
+
+
+# fmt: off
+_DES_PC1 = (
+    57, 49, 41, 33, 25, 17, 9, 1, 58, 50, 42, 34, 26, 18,
+    10, 2, 59, 51, 43, 35, 27, 19, 11, 3, 60, 52, 44, 36,
+    63, 55, 47, 39, 31, 23, 15, 7, 62, 54, 46, 38, 30, 22,
+    14, 6, 61, 53, 45, 37, 29, 21, 13, 5, 28, 20, 12, 4,
+)
+_DES_PC2 = (
+    14, 17, 11, 24, 1, 5, 3, 28, 15, 6, 21, 10,
+    23, 19, 12, 4, 26, 8, 16, 7, 27, 20, 13, 2,
+    41, 52, 31, 37, 47, 55, 30, 40, 51, 45, 33, 48,
+    44, 49, 39, 56, 34, 53, 46, 42, 50, 36, 29, 32,
+)
+_DES_SHIFTS = (1, 1, 2, 2, 2, 2, 2, 2, 1, 2, 2, 2, 2, 2, 2, 1)
+_DES_IP = (
+    58, 50, 42, 34, 26, 18, 10, 2, 60, 52, 44, 36, 28, 20, 12, 4,
+    62, 54, 46, 38, 30, 22, 14, 6, 64, 56, 48, 40, 32, 24, 16, 8,
+    57, 49, 41, 33, 25, 17, 9, 1, 59, 51, 43, 35, 27, 19, 11, 3,
+    61, 53, 45, 37, 29, 21, 13, 5, 63, 55, 47, 39, 31, 23, 15, 7,
+)
+_DES_FP = (
+    40, 8, 48, 16, 56, 24, 64, 32, 39, 7, 47, 15, 55, 23, 63, 31,
+    38, 6, 46, 14, 54, 22, 62, 30, 37, 5, 45, 13, 53, 21, 61, 29,
+    36, 4, 44, 12, 52, 20, 60, 28, 35, 3, 43, 11, 51, 19, 59, 27,
+    34, 2, 42, 10, 50, 18, 58, 26, 33, 1, 41, 9, 49, 17, 57, 25,
+)
+_DES_E = (
+    32, 1, 2, 3, 4, 5, 4, 5, 6, 7, 8, 9,
+    8, 9, 10, 11, 12, 13, 12, 13, 14, 15, 16, 17,
+    16, 17, 18, 19, 20, 21, 20, 21, 22, 23, 24, 25,
+    24, 25, 26, 27, 28, 29, 28, 29, 30, 31, 32, 1,
+)
+_DES_P = (
+    16, 7, 20, 21, 29, 12, 28, 17, 1, 15, 23, 26, 5, 18, 31, 10,
+    2, 8, 24, 14, 32, 27, 3, 9, 19, 13, 30, 6, 22, 11, 4, 25,
+)
+_DES_SBOX = (
+    (14, 4, 13, 1, 2, 15, 11, 8, 3, 10, 6, 12, 5, 9, 0, 7,
+     0, 15, 7, 4, 14, 2, 13, 1, 10, 6, 12, 11, 9, 5, 3, 8,
+     4, 1, 14, 8, 13, 6, 2, 11, 15, 12, 9, 7, 3, 10, 5, 0,
+     15, 12, 8, 2, 4, 9, 1, 7, 5, 11, 3, 14, 10, 0, 6, 13),
+    (15, 1, 8, 14, 6, 11, 3, 4, 9, 7, 2, 13, 12, 0, 5, 10,
+     3, 13, 4, 7, 15, 2, 8, 14, 12, 0, 1, 10, 6, 9, 11, 5,
+     0, 14, 7, 11, 10, 4, 13, 1, 5, 8, 12, 6, 9, 3, 2, 15,
+     13, 8, 10, 1, 3, 15, 4, 2, 11, 6, 7, 12, 0, 5, 14, 9),
+    (10, 0, 9, 14, 6, 3, 15, 5, 1, 13, 12, 7, 11, 4, 2, 8,
+     13, 7, 0, 9, 3, 4, 6, 10, 2, 8, 5, 14, 12, 11, 15, 1,
+     13, 6, 4, 9, 8, 15, 3, 0, 11, 1, 2, 12, 5, 10, 14, 7,
+     1, 10, 13, 0, 6, 9, 8, 7, 4, 15, 14, 3, 11, 5, 2, 12),
+    (7, 13, 14, 3, 0, 6, 9, 10, 1, 2, 8, 5, 11, 12, 4, 15,
+     13, 8, 11, 5, 6, 15, 0, 3, 4, 7, 2, 12, 1, 10, 14, 9,
+     10, 6, 9, 0, 12, 11, 7, 13, 15, 1, 3, 14, 5, 2, 8, 4,
+     3, 15, 0, 6, 10, 1, 13, 8, 9, 4, 5, 11, 12, 7, 2, 14),
+    (2, 12, 4, 1, 7, 10, 11, 6, 8, 5, 3, 15, 13, 0, 14, 9,
+     14, 11, 2, 12, 4, 7, 13, 1, 5, 0, 15, 10, 3, 9, 8, 6,
+     4, 2, 1, 11, 10, 13, 7, 8, 15, 9, 12, 5, 6, 3, 0, 14,
+     11, 8, 12, 7, 1, 14, 2, 13, 6, 15, 0, 9, 10, 4, 5, 3),
+    (12, 1, 10, 15, 9, 2, 6, 8, 0, 13, 3, 4, 14, 7, 5, 11,
+     10, 15, 4, 2, 7, 12, 9, 5, 6, 1, 13, 14, 0, 11, 3, 8,
+     9, 14, 15, 5, 2, 8, 12, 3, 7, 0, 4, 10, 1, 13, 11, 6,
+     4, 3, 2, 12, 9, 5, 15, 10, 11, 14, 1, 7, 6, 0, 8, 13),
+    (4, 11, 2, 14, 15, 0, 8, 13, 3, 12, 9, 7, 5, 10, 6, 1,
+     13, 0, 11, 7, 4, 9, 1, 10, 14, 3, 5, 12, 2, 15, 8, 6,
+     1, 4, 11, 13, 12, 3, 7, 14, 10, 15, 6, 8, 0, 5, 9, 2,
+     6, 11, 13, 8, 1, 4, 10, 7, 9, 5, 0, 15, 14, 2, 3, 12),
+    (13, 2, 8, 4, 6, 15, 11, 1, 10, 9, 3, 14, 5, 0, 12, 7,
+     1, 15, 13, 8, 10, 3, 7, 4, 12, 5, 6, 11, 0, 14, 9, 2,
+     7, 11, 4, 1, 9, 12, 14, 2, 0, 6, 10, 13, 15, 3, 5, 8,
+     2, 1, 14, 7, 4, 10, 8, 13, 15, 12, 9, 0, 3, 5, 6, 11),
+)
+# fmt: on
+
+
+def _permute(value, table, width):
+    """Returns the bits of the *width* bits wide *value* permuted by the
+    *table* (with 1-based bit positions, counted from the left)."""
+    result = 0
+    for position in table:
+        result = (result << 1) | ((value >> (width - position)) & 1)
+    return result
+
+
+def _des_subkeys(key):
+    """Returns the 16 round keys for the 8 bytes *key*."""
+    cd = _permute(int.from_bytes(key, "big"), _DES_PC1, 64)
+    c, d = cd >> 28, cd & 0xFFFFFFF
+    subkeys = []
+    for shift in _DES_SHIFTS:
+        c = ((c << shift) | (c >> (28 - shift))) & 0xFFFFFFF
+        d = ((d << shift) | (d >> (28 - shift))) & 0xFFFFFFF
+        subkeys.append(_permute((c << 28) | d, _DES_PC2, 56))
+    return subkeys
+
+
+def _des_feistel(right, subkey):
+    value = _permute(right, _DES_E, 32) ^ subkey
+    result = 0
+    for i, sbox in enumerate(_DES_SBOX):
+        chunk = (value >> (42 - 6 * i)) & 0x3F
+        row = ((chunk >> 4) & 2) | (chunk & 1)
+        result = (result << 4) | sbox[row * 16 + ((chunk >> 1) & 0xF)]
+    return _permute(result, _DES_P, 32)
+
+
+def des_encrypt(key, block):
+    """Encrypts the 8 bytes *block* with DES, using the 8 bytes *key*
+    (the parity bits are ignored).  Returns the 8 bytes cipher text."""
+    value = _permute(int.from_bytes(block, "big"), _DES_IP, 64)
+    left, right = value >> 32, value & _MASK
+    for subkey in _des_subkeys(key):
+        left, right = right, left ^ _des_feistel(right, subkey)
+    value = _permute((right << 32) | left, _DES_FP, 64)
+    return value.to_bytes(8, "big")
@@ -0,0 +1,351 @@
+# -*- coding: UTF-8 -*-
+# Copyright (c) 2014, Pascal Volk
+# See COPYING for distribution information.
+"""
+    vmm.diskusage
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Functions to summarize the disk usage of domain and account
+    directories, without forking du(1), and to keep the disk usage of
+    the accounts cached in the database.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2.extras import execute_values
+
+from vmm.maillocation import usage_source
+
+
+__all__ = (
+    "disk_usage",
+    "get_cached_usage",
+    "get_domain_usage",
+    "get_userquota",
+    "quota_usage",
+    "read_maildirsize",
+    "refresh_usage",
+    "scan_mtime",
+    "store_usage",
+    "subdir_disk_usage",
+)
+
+BLOCK_SIZE = 512  # unit of st_blocks, see stat(2)
+
+
+def _walk(directory):
+    """Summarizes the allocated space of all files and directories below
+    *directory* (including itself).
+
+    Returns a tuple (size, linked).  *size* is the sum of the allocated
+    bytes of all entries, except those of files with more than one link.
+    These are collected in the dict *linked*, indexed by (st_dev, st_ino),
+    so that the caller is able to count them only once."""
+    size = 0
+    linked = {}
+    try:
+        size = os.lstat(directory).st_blocks * BLOCK_SIZE
+    except OSError:
+        return size, linked
+    stack = [directory]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            # messages and folders may vanish while we are walking the tree
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    continue
+                if is_dir:
+                    stack.append(entry.path)
+                elif st.st_nlink > 1:
+                    linked[(st.st_dev, st.st_ino)] = st.st_blocks * BLOCK_SIZE
+                    continue
+                size += st.st_blocks * BLOCK_SIZE
+    return size, linked
+
+
+def subdir_disk_usage(directory, threads=1):
+    """Summarizes the disk usage of each subdirectory of *directory*.
+
+    The subdirectories are walked by a pool of *threads* threads.  Returns
+    a dict, indexed by the subdirectories' names, with their disk usage in
+    bytes.  The space allocated by *directory* itself and by the files
+    directly in it is stored with the key ''.  A file with multiple links
+    will be counted only once, so the sum of all values is the disk usage
+    of *directory*.
+
+    Arguments:
+
+    `directory` : str
+      The directory to summarize the disk usage for
+    `threads` : int
+      The number of threads, which will walk the subdirectories
+    """
+    subdirs = []
+    linked = {}
+    own_size = os.lstat(directory).st_blocks * BLOCK_SIZE
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if st.st_nlink > 1:
+                linked[(st.st_dev, st.st_ino)] = st.st_blocks * BLOCK_SIZE
+            else:
+                own_size += st.st_blocks * BLOCK_SIZE
+    subdirs.sort()
+    paths = [os.path.join(directory, name) for name in subdirs]
+    if threads > 1 and len(paths) > 1:
+        with ThreadPoolExecutor(max_workers=min(threads, len(paths))) as pool:
+            results = list(pool.map(_walk, paths))
+    else:
+        results = [_walk(path) for path in paths]
+
+    seen = set(linked)
+    usage = {"": own_size + sum(linked.values())}
+    for name, (size, sub_linked) in zip(subdirs, results):
+        for inode, blocks in sub_linked.items():
+            if inode not in seen:
+                seen.add(inode)
+                size += blocks
+        usage[name] = size
+    return usage
+
+
+def disk_usage(directory, threads=1):
+    """Returns the disk usage of *directory* in bytes.
+
+    Like du(1), the allocated space of all files and directories below
+    *directory* is summarized, symbolic links are not followed and files
+    with multiple links are counted only once.  The subdirectories are
+    walked in parallel by *threads* threads."""
+    return sum(subdir_disk_usage(directory, threads).values())
+
+
+def scan_mtime(home, maildir):
+    """Returns the latest modification time (in nanoseconds) of the
+    directories *home*, *maildir* and the new/ and cur/ directories below
+    *maildir*, or `None`, when *home* doesn't exist.
+
+    Delivered and expunged messages change the mtime of these directories.
+    As long as the value is the same, there is no need to walk the mail
+    directory again."""
+    mtimes = []
+    for path in (
+        home,
+        maildir,
+        os.path.join(maildir, "new"),
+        os.path.join(maildir, "cur"),
+    ):
+        try:
+            mtimes.append(os.lstat(path).st_mtime_ns)
+        except OSError:
+            if path == home:
+                return None
+    return max(mtimes)
+
+
+def get_cached_usage(dbh, uid):
+    """Returns the cached (bytes, mtime, scanned) tuple of the account with
+    the given *uid*, or `None` if the account has not been scanned yet."""
+    dbc = dbh.cursor()
+    dbc.execute("SELECT bytes, mtime, scanned FROM disk_usage WHERE uid = %s", (uid,))
+    usage = dbc.fetchone()
+    dbc.close()
+    return usage
+
+
+def get_domain_usage(dbh, gid):
+    """Summarizes the cached disk usage of all accounts of the domain with
+    the given *gid*.
+
+    Returns a tuple (bytes, oldest, missing).  *oldest* is the time of the
+    oldest scan, *missing* the number of accounts, which have not been
+    scanned yet."""
+    dbc = dbh.cursor()
+    # fmt: off
+    dbc.execute(
+        "SELECT coalesce(sum(bytes), 0), min(scanned), "
+        "       count(*) FILTER (WHERE du.uid IS NULL) "
+        "FROM users "
+        "LEFT JOIN disk_usage du USING (uid) "
+        "WHERE users.gid = %s",
+        (gid,),
+    )
+    # fmt: on
+    usage = dbc.fetchone()
+    dbc.close()
+    return usage
+
+
+def store_usage(dbh, rows):
+    """Stores the (uid, gid, bytes, mtime) *rows* in the cache table
+    disk_usage and commits the transaction."""
+    if not rows:
+        return
+    dbc = dbh.cursor()
+    # fmt: off
+    execute_values(
+        dbc,
+        "INSERT INTO disk_usage (uid, gid, bytes, mtime, scanned) "
+        "VALUES %s "
+        "ON CONFLICT (uid) DO UPDATE "
+        "SET gid = EXCLUDED.gid, bytes = EXCLUDED.bytes, "
+        "    mtime = EXCLUDED.mtime, scanned = EXCLUDED.scanned",
+        rows,
+        template="(%s, %s, %s, %s, now())",
+        page_size=1000,
+    )
+    # fmt: on
+    dbc.close()
+    dbh.commit()
+
+
+def read_maildirsize(maildir):
+    """Returns the size of all messages in the Maildir++ *maildir* in
+    bytes, as recorded by Dovecot in the file maildirsize.
+
+    `None` will be returned, when the file is missing or invalid, or when
+    it is stale, i.e. older than the new/ or cur/ directory."""
+    path = os.path.join(maildir, "maildirsize")
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        with open(path, "rb") as fobj:
+            lines = fobj.read().split(b"\n")
+    except OSError:
+        return None
+    for subdir in ("new", "cur"):
+        try:
+            if os.lstat(os.path.join(maildir, subdir)).st_mtime_ns > mtime:
+                return None
+        except OSError:
+            pass
+    if len(lines) < 2:
+        return None
+    size = 0
+    # The first line holds the quota definition, each following line the
+    # bytes and messages, which have been added (or removed, if negative).
+    # The last element is either empty or a line, which is being written.
+    for line in lines[1:-1]:
+        try:
+            size += int(line.split()[0])
+        except (IndexError, ValueError):
+            return None
+    return max(size, 0)
+
+
+def get_userquota(dbh, uid):
+    """Returns the bytes of the account with the given *uid* from the
+    userquota table, or `None` if Dovecot has not stored a value yet."""
+    dbc = dbh.cursor()
+    dbc.execute("SELECT bytes FROM userquota WHERE uid = %s", (uid,))
+    usage = dbc.fetchone()
+    dbc.close()
+    return usage[0] if usage else None
+
+
+def quota_usage(mbformat, maildir, userquota):
+    """Returns the size of a mailbox, as tracked by Dovecot, or `None` if
+    it is not available.
+
+    The usage source of the mailbox format *mbformat* decides, whether the
+    maildirsize file in *maildir* or the *userquota* bytes will be used."""
+    if usage_source(mbformat) == "maildirsize":
+        return read_maildirsize(maildir)
+    return userquota
+
+
+def _scan_account(account):
+    """Summarizes the disk usage of the mail directory of the *account*
+    tuple (uid, gid, home, maildir, mbformat, userquota, cached mtime,
+    source, full).
+
+    Returns a (uid, gid, bytes, mtime) row, or `None` if the cached disk
+    usage is still up to date or the home directory doesn't exist.  When
+    *source* is ``quota``, the size will be read from Dovecot's quota data,
+    the mail directory will only be walked, if they are missing or stale."""
+    uid, gid, home, maildir, mbformat, userquota, cached, source, full = account
+    mtime = scan_mtime(home, maildir)
+    if mtime is None or (mtime == cached and not full):
+        return None
+    size = None
+    if source == "quota":
+        size = quota_usage(mbformat, maildir, userquota)
+    if size is None:
+        size = disk_usage(maildir) if os.path.isdir(maildir) else 0
+    return uid, gid, size, mtime
+
+
+def refresh_usage(
+    dbh, threads=1, full=False, gid=None, source="filesystem", batch_size=1000
+):
+    """Refreshes the cached disk usage of all accounts, or only of the
+    accounts of the domain with the given *gid*.
+
+    Only the mail directories, whose mtime (see `scan_mtime()`) has been
+    changed since the last scan, will be summarized, unless *full* is
+    `True`.  With the *source* ``quota``, the size of the mailboxes will be
+    read from Dovecot's quota data, see `quota_usage()`.  The accounts are
+    scanned by a pool of *threads* threads.  The results are committed
+    every *batch_size* accounts, so an interrupted refresh doesn't lose
+    the work done so far.
+
+    Returns a tuple (scanned, total)."""
+    # fmt: off
+    sql = (
+        "SELECT uid, users.gid, domaindir || '/' || uid, directory, format, "
+        "       uq.bytes, du.mtime "
+        "FROM users "
+        "JOIN domain_data USING (gid) "
+        "JOIN maillocation USING (mid) "
+        "JOIN mailboxformat USING (fid) "
+        "LEFT JOIN userquota uq USING (uid) "
+        "LEFT JOIN disk_usage du USING (uid)"
+    )
+    # fmt: on
+    dbc = dbh.cursor()
+    if gid is None:
+        dbc.execute(sql)
+    else:
+        dbc.execute(sql + " WHERE users.gid = %s", (gid,))
+    accounts = [
+        (
+            uid,
+            ugid,
+            home,
+            os.path.join(home, directory),
+            mbformat,
+            userquota,
+            mtime,
+            source,
+            full,
+        )
+        for uid, ugid, home, directory, mbformat, userquota, mtime in dbc.fetchall()
+    ]
+    dbc.close()
+
+    scanned = 0
+    rows = []
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as pool:
+        for row in pool.map(_scan_account, accounts):
+            if row is None:
+                continue
+            rows.append(row)
+            if len(rows) >= batch_size:
+                store_usage(dbh, rows)
+                scanned += len(rows)
+                rows = []
+    store_usage(dbh, rows)
+    scanned += len(rows)
+    return scanned, len(accounts)
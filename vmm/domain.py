@@ -21,7 +21,7 @@ from vmm.constants import (
     DOMAIN_TOO_LONG,
     NO_SUCH_DOMAIN,
 )
-from vmm.common import validate_transport
+from vmm.common import named_cursor, validate_transport
 from vmm.errors import DomainError as DomErr
 from vmm.maillocation import MailLocation
 from vmm.quotalimit import QuotaLimit
@@ -39,6 +39,23 @@ RE_DOMAIN = re.compile(
 cfg_dget = lambda option: None
 
 
+# The columns of a domain and its default quota limit, service set and
+# transport, see Domain._set_row().  The tables are joined in DOMAIN_JOINS.
+DOMAIN_COLUMNS = (
+    "dd.gid", "dn.is_primary", "dd.domaindir", "dd.note",
+    "dq.qid", "dq.bytes", "dq.messages",
+    "ds.ssid", "ds.smtp", "ds.pop3", "ds.imap", "ds.sieve",
+    "dt.tid", "dt.transport",
+)  # fmt: skip
+DOMAIN_JOINS = (
+    "FROM domain_name dn "
+    "JOIN domain_data dd USING (gid) "
+    "JOIN quotalimit dq ON dq.qid = dd.qid "
+    "JOIN service_set ds ON ds.ssid = dd.ssid "
+    "JOIN transport dt ON dt.tid = dd.tid"
+)
+
+
 class Domain:
     """Class to manage e-mail domains."""
 
@@ -54,7 +71,7 @@ class Domain:
         "_new",
     )
 
-    def __init__(self, dbh, domainname):
+    def __init__(self, dbh, domainname, _row=None):
         """Creates a new Domain instance.
 
         Loads all relevant data from the database, if the domain could be
@@ -70,6 +87,8 @@ class Domain:
           a database connection for the database access
         `domainname` : basestring
           The name of the domain
+        `_row` : tuple
+          The DOMAIN_COLUMNS of the domain, already fetched by the caller
         """
         self._name = check_domainname(domainname)
         self._dbh = dbh
@@ -80,7 +99,10 @@ class Domain:
         self._directory = None
         self._note = None
         self._new = True
-        self._load()
+        if _row is None:
+            self._load()
+        else:
+            self._set_row(_row)
 
     def _load(self):
         """Load information from the database and checks if the domain name
@@ -90,28 +112,29 @@ class Domain:
         domain.
         """
         dbc = self._dbh.cursor()
-        # fmt: off
         dbc.execute(
-            "SELECT dd.gid, qid, ssid, tid, domaindir, is_primary, note "
-            "FROM domain_data dd, domain_name dn "
-            "WHERE domainname = %s AND dn.gid = dd.gid",
+            "SELECT %s %s WHERE domainname = %%s"
+            % (", ".join(DOMAIN_COLUMNS), DOMAIN_JOINS),
             (self._name,),
         )
-        # fmt: on
         result = dbc.fetchone()
         dbc.close()
         if result:
-            if not result[5]:
-                raise DomErr(
-                    _("The domain '%s' is an alias domain.") % self._name,
-                    DOMAIN_ALIAS_EXISTS,
-                )
-            self._gid, self._directory = result[0], result[4]
-            self._qlimit = QuotaLimit(self._dbh, qid=result[1])
-            self._services = ServiceSet(self._dbh, ssid=result[2])
-            self._transport = Transport(self._dbh, tid=result[3])
-            self._note = result[6]
-            self._new = False
+            self._set_row(result)
+
+    def _set_row(self, row):
+        """Sets the attributes from the DOMAIN_COLUMNS *row*, including the
+        default quota limit, service set and transport."""
+        if not row[1]:
+            raise DomErr(
+                _("The domain '%s' is an alias domain.") % self._name,
+                DOMAIN_ALIAS_EXISTS,
+            )
+        self._gid, self._directory, self._note = row[0], row[2], row[3]
+        self._qlimit = QuotaLimit._from_row(self._dbh, *row[4:7])
+        self._services = ServiceSet._from_row(self._dbh, *row[7:12])
+        self._transport = Transport._from_row(self._dbh, *row[12:14])
+        self._new = False
 
     def _set_gid(self):
         """Sets the ID of the domain - if not set yet."""
@@ -640,6 +663,30 @@ def get_gid(dbh, domainname):
     return 0
 
 
+def get_gids(dbh, domainnames):
+    """Returns a dict with the group ids of the domains *domainnames*,
+    indexed by the domain names, with a single query.
+
+    Domains, which couldn't be found in the database, are missing from the
+    dict.  The *domainnames* must have been checked by `check_domainname()`.
+    """
+    domainnames = list(set(domainnames))
+    if not domainnames:
+        return {}
+    dbc = dbh.cursor()
+    # fmt: off
+    dbc.execute(
+        "SELECT domainname, gid "
+        "FROM domain_name "
+        "WHERE domainname = ANY(%s)",
+        (domainnames,)
+    )
+    # fmt: on
+    gids = dict(dbc.fetchall())
+    dbc.close()
+    return gids
+
+
 def search(dbh, pattern=None, like=False):
     """'Search' for domains by *pattern* in the database.
 
@@ -702,4 +749,106 @@ def search(dbh, pattern=None, like=False):
     return gids, domains
 
 
+def _build_iter_domains_query(pattern, like, after=None, limit=None):
+    """Returns the SQL query and its arguments for `iter_domains()`."""
+    sqlargs = []
+    if not pattern:
+        where = "WHERE is_primary "
+        if after:
+            where += "AND domainname > %s "
+            sqlargs.append(after)
+        # fmt: off
+        sql = (
+            "SELECT gid, domainname, "
+            "   ARRAY(SELECT domainname FROM domain_name a "
+            "         WHERE a.gid = p.gid AND NOT is_primary "
+            "         ORDER BY domainname) "
+            "FROM domain_name p "
+            + where +
+            "ORDER BY domainname"
+        )
+        # fmt: on
+    else:
+        match = "LIKE" if like else "="
+        where = ""
+        sqlargs.extend((pattern,) * 4)
+        if after:
+            where = "WHERE sortkey > %s "
+            sqlargs.append(after)
+        # fmt: off
+        sql = (
+            f"SELECT gid, primary_name, aliases "
+            f"FROM ("
+            f"   SELECT gid, domainname AS primary_name, domainname AS sortkey, "
+            f"      ARRAY(SELECT domainname FROM domain_name a "
+            f"            WHERE a.gid = p.gid AND NOT is_primary "
+            f"            AND domainname {match} %s "
+            f"            ORDER BY domainname) AS aliases "
+            f"   FROM domain_name p "
+            f"   WHERE is_primary AND domainname {match} %s "
+            f"   UNION ALL "
+            f"   SELECT gid, NULL, min(domainname), "
+            f"      array_agg(domainname ORDER BY domainname) "
+            f"   FROM domain_name a "
+            f"   WHERE NOT is_primary AND domainname {match} %s "
+            f"   AND NOT EXISTS (SELECT 1 FROM domain_name p "
+            f"                   WHERE p.gid = a.gid AND p.is_primary "
+            f"                   AND p.domainname {match} %s) "
+            f"   GROUP BY gid"
+            f") d "
+            f"{where}"
+            f"ORDER BY sortkey"
+        )
+        # fmt: on
+    if limit:
+        sql += " LIMIT %s"
+        sqlargs.append(limit)
+    return sql, sqlargs
+
+
+def iter_domains(
+    dbh, pattern=None, like=False, after=None, limit=None, fetch_size=1000
+):
+    """Like `search()`, but the result is streamed through a server-side
+    cursor, which fetches *fetch_size* rows per round trip.
+
+    Returns an iterator, which yields a (gid, names) tuple per domain.  The first
+    element of the names list is the primary domain name or `None`, when
+    only alias domain names matched the *pattern*.  The elements [1:] are
+    the names of the alias domains.  The domains are sorted by their
+    primary domain name, or the first alias domain name.
+
+    Arguments:
+
+    `pattern` : basestring
+      a (partial) domain name (starting and/or ending with a "%" sign)
+    `like` : bool
+      should be `True` when *pattern* starts/ends with a "%" sign
+    `after` : basestring
+      the sort key of the last domain of the previous page, for keyset
+      pagination
+    `limit` : int
+      the maximum number of domains, which will be returned
+    `fetch_size` : int
+      the number of rows, which will be fetched per round trip
+    """
+    if pattern and not like:
+        pattern = check_domainname(pattern)
+    if after:
+        after = check_domainname(after)
+    sql, sqlargs = _build_iter_domains_query(pattern, like, after, limit)
+    return _iter_domains(dbh, sql, sqlargs, fetch_size)
+
+
+def _iter_domains(dbh, sql, sqlargs, fetch_size):
+    """Generator for `iter_domains()`, the *pattern* has been checked."""
+    dbc = named_cursor(dbh, fetch_size)
+    try:
+        dbc.execute(sql, sqlargs)
+        for gid, primary, aliases in dbc:
+            yield gid, [primary] + aliases
+    finally:
+        dbc.close()
+
+
 del cfg_dget
@@ -10,7 +10,7 @@
 import re
 from gettext import gettext as _
 
-from vmm.domain import check_domainname, get_gid
+from vmm.domain import check_domainname, get_gid, get_gids
 from vmm.constants import (
     DOMAIN_NO_NAME,
     INVALID_ADDRESS,
@@ -112,7 +112,8 @@ class DestinationEmailAddress(EmailAddress):
         `address`: string/unicode
           a e-mail address like user@example.com
         `dbh`: psycopg2._psycopg.connection
-          a database connection for the database access
+          a database connection for the database access, or None when the
+          domain will be resolved by the caller (see destination_addresses())
         """
         super(DestinationEmailAddress, self).__init__(address, _validate)
         self._localhost = False
@@ -126,15 +127,19 @@ class DestinationEmailAddress(EmailAddress):
                 else:
                     raise
         self._gid = 0
-        if not self._localhost:
-            self._find_domain(dbh)
-        else:
+        if self._localhost:
             self._localpart = self._localpart.lower()
+        elif dbh is not None:
+            self._find_domain(dbh)
 
     def _find_domain(self, dbh):
         """Checks if the domain is known"""
-        self._gid = get_gid(dbh, self._domainname)
-        if self._gid:
+        self._set_gid(get_gid(dbh, self._domainname))
+
+    def _set_gid(self, gid):
+        """Sets the domain's group ID, 0 if the domain is not known."""
+        self._gid = gid
+        if gid:
             self._localpart = self._localpart.lower()
 
     @property
@@ -148,6 +153,23 @@ class DestinationEmailAddress(EmailAddress):
         return self._gid
 
 
+def destination_addresses(addresses, dbh):
+    """Returns a list of DestinationEmailAddress instances for all
+    *addresses*.
+
+    Instead of one query per address, the group IDs of all destination
+    domains are looked up with a single query and shared by the addresses.
+    """
+    destinations = [DestinationEmailAddress(address, None) for address in addresses]
+    gids = get_gids(
+        dbh, (dest.domainname for dest in destinations if not dest.at_localhost)
+    )
+    for dest in destinations:
+        if not dest.at_localhost:
+            dest._set_gid(gids.get(dest.domainname, 0))
+    return destinations
+
+
 def check_localpart(localpart):
     """Returns the validated local-part `localpart`.
 
@@ -11,8 +11,13 @@
 
     postconf.read(parameter) -> value
     postconf.edit(parameter, value)
+
+    Parameters are read from main.cf in-process, postconf will only be
+    executed for parameters, which are neither set in main.cf nor listed
+    in DEFAULTS.
 """
 
+import os
 import re
 from gettext import gettext as _
 from subprocess import Popen, PIPE
@@ -20,6 +25,42 @@ from subprocess import Popen, PIPE
 from vmm.errors import VMMError
 from vmm.constants import VMM_ERROR
 
+DEFAULT_CONFIG_DIRECTORY = "/etc/postfix"
+# Postfix's default values of the parameters read by vmm
+DEFAULTS = {
+    "virtual_alias_expansion_limit": "1000",
+    "virtual_alias_recursion_limit": "1000",
+}
+
+# postconf binary: config_directory
+_config_directories = {}
+# path of main.cf: ((st_mtime_ns, st_size, st_ino), parameters, expanded)
+_main_cf_cache = {}
+
+
+def parse_main_cf(path):
+    """Parses the Postfix configuration file *path* and returns a dict with
+    the parameters and their unexpanded values.
+
+    Like Postfix, empty lines and comments are ignored and lines starting
+    with whitespace continue the previous logical line."""
+    lines = []
+    with open(path, errors="replace") as fobj:
+        for line in fobj:
+            stripped = line.strip()
+            if not stripped or stripped.startswith("#"):
+                continue
+            if line[0].isspace() and lines:
+                lines[-1] += " " + stripped
+            else:
+                lines.append(stripped)
+    parameters = {}
+    for line in lines:
+        name, sep, value = line.partition("=")
+        if sep:
+            parameters[name.strip()] = value.strip()
+    return parameters
+
 
 class Postconf:
     """Wrapper class for Postfix's postconf."""
@@ -27,6 +68,11 @@ class Postconf:
     __slots__ = ("_bin", "_val")
     _parameter_re = re.compile(r"^\w+$", re.ASCII)
     _variables_re = re.compile(r"\$\b\w+\b", re.ASCII)
+    # $name, ${name}, $(name), ${name?value}, ${name:value} or $$
+    _macro_re = re.compile(
+        r"\$(?:(\w+)|\{(\w+)(?:([?:])([^}]*))?\}|\((\w+)(?:([?:])([^)]*))?\)|\$)",
+        re.ASCII,
+    )
 
     def __init__(self, postconf_bin):
         """Creates a new Postconf instance.
@@ -73,6 +119,14 @@ class Postconf:
           indicates if variables should be expanded or not, default True
         """
         self._check_parameter(parameter)
+        main_cf = self._main_cf()
+        if main_cf and (parameter in main_cf[0] or parameter in DEFAULTS):
+            parameters, expanded = main_cf
+            if expand_vars:
+                self._val = self._lookup(parameter, parameters, expanded, ())
+            else:
+                self._val = parameters.get(parameter, DEFAULTS.get(parameter))
+            return self._val
         self._val = self._read(parameter)
         if expand_vars:
             self._expand_vars()
@@ -91,6 +145,84 @@ class Postconf:
                 VMM_ERROR,
             )
 
+    def _config_directory(self):
+        """Returns Postfix's configuration directory: $MAIL_CONFIG, the
+        default directory, if it contains a main.cf, or the
+        config_directory reported by postconf."""
+        directory = os.environ.get("MAIL_CONFIG")
+        if directory:
+            return directory
+        if self._bin not in _config_directories:
+            if os.path.isfile(os.path.join(DEFAULT_CONFIG_DIRECTORY, "main.cf")):
+                directory = DEFAULT_CONFIG_DIRECTORY
+            else:
+                directory = self._read("config_directory")
+            _config_directories[self._bin] = directory
+        return _config_directories[self._bin]
+
+    def _main_cf(self):
+        """Returns a tuple (parameters, expanded) with the unexpanded and
+        the already expanded values of main.cf, or `None` if the file is
+        not readable.
+
+        The parsed file is cached process-wide, until its mtime changes."""
+        path = os.path.join(self._config_directory(), "main.cf")
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        cached = _main_cf_cache.get(path)
+        if cached is None or cached[0] != key:
+            try:
+                cached = _main_cf_cache[path] = (key, parse_main_cf(path), {})
+            except OSError:
+                return None
+        return cached[1], cached[2]
+
+    def _lookup(self, parameter, parameters, expanded, nesting):
+        """Returns the expanded value of the *parameter*.
+
+        Values are taken from the *parameters* of main.cf, from DEFAULTS or,
+        as last resort, from postconf.  Expanded values are memoized in
+        *expanded*.  *nesting* holds the parameters, which are being
+        expanded, to detect recursive macros."""
+        if parameter in expanded:
+            return expanded[parameter]
+        if parameter in nesting:
+            raise VMMError(
+                _("Recursive Postfix configuration parameter: '%s'") % parameter,
+                VMM_ERROR,
+            )
+        if parameter in parameters:
+            value = parameters[parameter]
+        elif parameter in DEFAULTS:
+            value = DEFAULTS[parameter]
+        else:
+            value = self._read(parameter)
+        value = self._expand(value, parameters, expanded, nesting + (parameter,))
+        expanded[parameter] = value
+        return value
+
+    def _expand(self, value, parameters, expanded, nesting):
+        """Expands all macros in *value*, see `_lookup()`."""
+
+        def replace(match):
+            if match.group(0) == "$$":
+                return "$"
+            name = match.group(1) or match.group(2) or match.group(5)
+            operator = match.group(3) or match.group(6)
+            result = self._lookup(name, parameters, expanded, nesting)
+            if not operator:
+                return result
+            # ${name?value} if name is not empty, ${name:value} if it is
+            if (operator == "?") != bool(result):
+                return ""
+            arg = match.group(4) if match.group(2) else match.group(7)
+            return self._expand(arg, parameters, expanded, nesting)
+
+        return self.__class__._macro_re.sub(replace, value)
+
     def _expand_vars(self):
         """Expand the $variables in self._val to their values."""
         while True:
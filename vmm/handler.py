@@ -14,19 +14,23 @@
 
 import os
 import re
+import time
 
+from contextlib import contextmanager
+from functools import wraps
 from gettext import gettext as _
 from shutil import rmtree
 from stat import S_IRGRP, S_IROTH, S_IWGRP, S_IWOTH
-from subprocess import Popen, PIPE
 
 import psycopg2
 
-from vmm.account import Account
+from vmm.account import Account, save_accounts, update_passwords
 from vmm.alias import Alias
 from vmm.aliasdomain import AliasDomain
+from vmm.authd import AuthIndex, serve_auth
 from vmm.catchall import CatchallAlias
-from vmm.common import exec_ok, lisdir
+from vmm.changes import ChangeFeed, follow
+from vmm.common import classify_addresses, exec_ok, lisdir, size_in_bytes
 from vmm.config import Config as Cfg
 from vmm.constants import (
     MIN_GID,
@@ -47,6 +51,7 @@ from vmm.constants import (
     NO_SUCH_ALIAS,
     NO_SUCH_BINARY,
     NO_SUCH_DIRECTORY,
+    NO_SUCH_DOMAIN,
     NO_SUCH_RELOCATED,
     RELOCATED_EXISTS,
     UNKNOWN_SERVICE,
@@ -56,19 +61,50 @@ from vmm.constants import (
     TYPE_ALIAS,
     TYPE_RELOCATED,
 )
+from vmm.database import Connection, ConnectionPool, get_pool, replication_lag
+from vmm.diskusage import (
+    disk_usage,
+    get_cached_usage,
+    get_domain_usage,
+    get_userquota,
+    quota_usage,
+    refresh_usage,
+    scan_mtime,
+)
 from vmm.domain import Domain
-from vmm.emailaddress import DestinationEmailAddress, EmailAddress, RE_LOCALPART
+from vmm.emailaddress import (
+    DestinationEmailAddress,
+    EmailAddress,
+    RE_LOCALPART,
+    destination_addresses,
+)
 from vmm.errors import DomainError, NotRootError, PermissionError, VMMError
+from vmm.lookupd import LookupIndex, serve_lookups
 from vmm.mailbox import new as new_mailbox
-from vmm.password import extract_scheme, verify_scheme
+from vmm.maillocation import MailLocation
+from vmm.maps import export_maps
+from vmm.password import extract_scheme, pwhash_many, randompw, verify_scheme
 from vmm.quotalimit import QuotaLimit
 from vmm.relocated import Relocated
 from vmm.serviceset import ServiceSet, SERVICES
 from vmm.transport import Transport
+from vmm.trash import move_to_trash, reap
 
 CFG_FILE = "vmm.cfg"
 CFG_PATH = "/root:/usr/local/etc:/etc"
 RE_DOMAIN_SEARCH = re.compile(r"^[a-z0-9-.]+$")
+BULK_USER_FIELDS = (
+    "address",
+    "name",
+    "note",
+    "password",
+    "pwhash",
+    "quota",
+    "quota_messages",
+    "services",
+    "transport",
+)
+BULK_PASSWORD_FIELDS = ("address", "password", "pwhash")
 OTHER_TYPES = {
     TYPE_ACCOUNT: (_("an account"), ACCOUNT_EXISTS),
     TYPE_ALIAS: (_("an alias"), ALIAS_EXISTS),
@@ -76,18 +112,77 @@ OTHER_TYPES = {
 }
 
 
+def find_cfg_file():
+    """Search the CFG_FILE in CFG_PATH and return its name.
+    Raise a VMMError when no vmm.cfg could be found.
+    """
+    for path in CFG_PATH.split(":"):
+        tmp = os.path.join(path, CFG_FILE)
+        if os.path.isfile(tmp):
+            return tmp
+    raise VMMError(
+        _("Could not find '%(cfg_file)s' in: " "'%(cfg_path)s'")
+        % {"cfg_file": CFG_FILE, "cfg_path": CFG_PATH},
+        CONF_NOFILE,
+    )
+
+
+def _db_operation(method, read_only=False):
+    """Decorator for the methods of the Handler, which use the database.
+
+    The database connection is checked out of the pool on demand and
+    returned to the pool, when the outermost operation returns."""
+
+    @wraps(method)
+    def operation(self, *args, **kwargs):
+        self._db_enter(read_only)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._depth -= 1
+            self._db_release()
+
+    return operation
+
+
+def _db_read_operation(method):
+    """Like `_db_operation`, for methods which only read from the database.
+    They run on the replica, if one is configured, see Handler._db_connect()."""
+    return _db_operation(method, read_only=True)
+
+
 class Handler:
     """Wrapper class to simplify the access on all the stuff from vmm"""
 
-    __slots__ = ("_cfg", "_cfg_fname", "_dbh", "_warnings")
-
-    def __init__(self, skip_some_checks=False):
+    __slots__ = (
+        "_cfg",
+        "_cfg_fname",
+        "_dbh",
+        "_dbh_pool",
+        "_depth",
+        "_pool",
+        "_primary_until",
+        "_read_only",
+        "_replica",
+        "_replica_checked",
+        "_warnings",
+    )
+
+    def __init__(self, skip_some_checks=False, pool=None):
         """Creates a new Handler instance.
 
         ``skip_some_checks`` : bool
             When a derived class knows how to handle all checks this
             argument may be ``True``. By default it is ``False`` and
             all checks will be performed.
+        ``pool`` : object
+            The pool, from which the database connections will be checked
+            out, an object with the methods getconn() and putconn(), like
+            vmm.database.ConnectionPool or the pools of psycopg2.pool.
+            Its connections have to be vmm.database.Connection instances.
+            By default the Handler uses a ConnectionPool configured by the
+            database.pool_* settings, shared by all Handlers with the same
+            settings.
 
         Throws a NotRootError if your uid is greater 0.
         """
@@ -95,6 +190,13 @@ class Handler:
         self._warnings = []
         self._cfg = None
         self._dbh = None
+        self._dbh_pool = None
+        self._depth = 0
+        self._pool = pool
+        self._primary_until = 0.0
+        self._read_only = False
+        self._replica = None
+        self._replica_checked = 0.0
 
         if os.geteuid():
             raise NotRootError(_("You are not root.\n\tGood bye!\n"), CONF_NOPERM)
@@ -106,20 +208,8 @@ class Handler:
             self._chkenv()
 
     def _find_cfg_file(self):
-        """Search the CFG_FILE in CFG_PATH.
-        Raise a VMMError when no vmm.cfg could be found.
-        """
-        for path in CFG_PATH.split(":"):
-            tmp = os.path.join(path, CFG_FILE)
-            if os.path.isfile(tmp):
-                self._cfg_fname = tmp
-                break
-        if not self._cfg_fname:
-            raise VMMError(
-                _("Could not find '%(cfg_file)s' in: " "'%(cfg_path)s'")
-                % {"cfg_file": CFG_FILE, "cfg_path": CFG_PATH},
-                CONF_NOFILE,
-            )
+        """Search the CFG_FILE in CFG_PATH, see `find_cfg_file()`."""
+        self._cfg_fname = find_cfg_file()
 
     def _check_cfg_file(self):
         """Checks the configuration file, returns bool"""
@@ -178,26 +268,135 @@ class Handler:
                 else:
                     raise
 
+    def _db_pool(self, host=None, port=None):
+        """Return the ConnectionPool for the database settings.  *host* and
+        *port* override the database.host and database.port settings."""
+        params = {
+            "host": host or self._cfg.dget("database.host"),
+            "sslmode": self._cfg.dget("database.sslmode"),
+            "port": port or self._cfg.dget("database.port"),
+            "database": self._cfg.dget("database.name"),
+            "user": self._cfg.pget("database.user"),
+            "password": self._cfg.pget("database.pass"),
+            "connection_factory": Connection,
+            "client_encoding": "utf8",
+        }
+        timeout = self._cfg.dget("database.statement_timeout")
+        if timeout:
+            params["options"] = "-c statement_timeout=%d" % timeout
+        settings = {
+            "min_size": self._cfg.dget("database.pool_min_size"),
+            "max_size": self._cfg.dget("database.pool_max_size"),
+            "idle_timeout": self._cfg.dget("database.pool_idle_timeout"),
+            "health_check": self._cfg.dget("database.pool_health_check"),
+        }
+        return get_pool(
+            (tuple(sorted(params.items())), tuple(sorted(settings.items()))),
+            lambda: ConnectionPool(lambda: psycopg2.connect(**params), **settings),
+        )
+
     def _db_connect(self):
-        """Return a new psycopg2 connection object."""
-        if self._dbh is None or (
-            isinstance(self._dbh, psycopg2.extensions.connection) and self._dbh.closed
-        ):
+        """Check a database connection out of the pool, unless the Handler
+        holds an open connection already.  Read only operations use the
+        replica, when possible, see `_db_connect_replica()`."""
+        if self._dbh is not None:
+            if not self._dbh.closed:
+                return
+            self._dbh_pool.putconn(self._dbh)
+            self._dbh = None
+        if self._read_only and self._db_connect_replica():
+            return
+        try:
+            if self._pool is None:
+                self._pool = self._db_pool()
+            self._dbh = self._pool.getconn()
+        except psycopg2.DatabaseError as err:
+            raise VMMError(str(err), DATABASE_ERROR)
+        self._dbh_pool = self._pool
+
+    def _db_connect_replica(self):
+        """Check a connection out of the pool of the replica.
+
+        Returns `False`, when no database.replica_host is configured, the
+        replica can't be reached, or it lags more than database.replica_max_lag
+        seconds behind the primary.  The lag is checked at most once per
+        second.  For database.replica_max_lag seconds after a writing
+        operation of this Handler, the primary will be used, so that the
+        changes can be read back."""
+        host = self._cfg.dget("database.replica_host")
+        if not host or time.monotonic() < self._primary_until:
+            return False
+        max_lag = self._cfg.dget("database.replica_max_lag")
+        try:
+            if self._replica is None:
+                self._replica = self._db_pool(
+                    host, self._cfg.dget("database.replica_port")
+                )
+            dbh = self._replica.getconn()
+        except psycopg2.Error:
+            return False
+        if max_lag and time.monotonic() - self._replica_checked >= 1:
             try:
-                self._dbh = psycopg2.connect(
-                    host=self._cfg.dget("database.host"),
-                    sslmode=self._cfg.dget("database.sslmode"),
-                    port=self._cfg.dget("database.port"),
-                    database=self._cfg.dget("database.name"),
-                    user=self._cfg.pget("database.user"),
-                    password=self._cfg.pget("database.pass"),
+                lag = replication_lag(dbh)
+            except psycopg2.Error:
+                self._replica.putconn(dbh, close=True)
+                return False
+            if lag > max_lag:
+                self._replica.putconn(dbh)
+                return False
+            self._replica_checked = time.monotonic()
+        self._dbh, self._dbh_pool = dbh, self._replica
+        return True
+
+    def _on_replica(self):
+        """Check if the Handler's connection is connected to the replica."""
+        return self._dbh is not None and self._dbh_pool is self._replica
+
+    def _db_enter(self, read_only):
+        """Enter an operation, which only reads from the database, when
+        *read_only* is `True`.  A writing operation within a read only one,
+        e.g. while a stream is consumed, turns the outer operation into a
+        writing one, so that the primary will be used.  It is refused, when
+        the Handler holds a connection to the replica already."""
+        if not self._depth:
+            self._read_only = read_only
+        elif self._read_only and not read_only:
+            if self._on_replica():
+                raise VMMError(
+                    _(
+                        "Can't change the database, while the results of a "
+                        "read from the replica are still being used."
+                    ),
+                    VMM_ERROR,
                 )
-                self._dbh.set_client_encoding("utf8")
-                dbc = self._dbh.cursor()
-                dbc.execute("SET NAMES 'UTF8'")
-                dbc.close()
-            except psycopg2.DatabaseError as err:
-                raise VMMError(str(err), DATABASE_ERROR)
+            self._read_only = False
+        self._depth += 1
+
+    def _db_release(self):
+        """Return the database connection to the pool, unless it is still
+        used by an operation, a transaction or a stream."""
+        if self._depth or self._dbh is None:
+            return
+        if not self._read_only and self._cfg.dget("database.replica_host"):
+            self._primary_until = (
+                time.monotonic() + self._cfg.dget("database.replica_max_lag")
+            )
+        dbh, self._dbh = self._dbh, None
+        self._dbh_pool.putconn(dbh)
+
+    def _stream(self, rows):
+        """Return an iterator over *rows*, which are fetched through the
+        Handler's database connection.  The connection is held, until the
+        iterator has been exhausted or closed."""
+        self._depth += 1
+        return self._stream_rows(rows)
+
+    def _stream_rows(self, rows):
+        try:
+            yield from rows
+        finally:
+            self._depth -= 1
+            self._db_release()
 
     def _chk_other_address_types(self, address, exclude):
         """Checks if the EmailAddress *address* is known as `TYPE_ACCOUNT`,
@@ -208,19 +407,21 @@ class Handler:
         assert exclude in (TYPE_ACCOUNT, TYPE_ALIAS, TYPE_RELOCATED) and isinstance(
             address, EmailAddress
         )
-        if exclude is not TYPE_ACCOUNT:
-            account = Account(self._dbh, address)
-            if account:
-                return TYPE_ACCOUNT
-        if exclude is not TYPE_ALIAS:
-            alias = Alias(self._dbh, address)
-            if alias:
-                return TYPE_ALIAS
-        if exclude is not TYPE_RELOCATED:
-            relocated = Relocated(self._dbh, address)
-            if relocated:
-                return TYPE_RELOCATED
-        return 0
+        types = classify_addresses(self._dbh, (address,))[address] & ~exclude
+        # the lowest bit set: TYPE_ACCOUNT before TYPE_ALIAS before TYPE_RELOCATED
+        return types & -types
+
+    def _warn_unknown_destinations(self, destinations):
+        """Adds a warning for each of the *destinations* in a managed domain,
+        which is neither an account nor an alias."""
+        local = [destination for destination in destinations if destination.gid]
+        types = classify_addresses(self._dbh, local)
+        for destination in local:
+            if not types[destination] & (TYPE_ACCOUNT | TYPE_ALIAS):
+                self._warnings.append(
+                    _("The destination account/alias '%s' " "does not exist.")
+                    % destination
+                )
 
     def _is_other_address(self, address, exclude):
         """Checks if *address* is known for an Account (TYPE_ACCOUNT),
@@ -271,6 +472,7 @@ class Handler:
 
     def _get_disk_usage(self, directory):
         """Estimate file space usage for the given directory.
+        Returns the disk usage in bytes.
 
         Arguments:
 
@@ -278,16 +480,37 @@ class Handler:
           The directory to summarize recursively disk usage for
         """
         if lisdir(directory):
-            return (
-                Popen([self._cfg.dget("bin.du"), "-hs", directory], stdout=PIPE)
-                .communicate()[0]
-                .decode()
-                .split("\t")[0]
-            )
+            return disk_usage(directory, self._cfg.dget("misc.disk_usage_threads"))
         else:
             self._warnings.append(_("No such directory: %s") % directory)
             return 0
 
+    def _get_account_disk_usage(self, account):
+        """Returns a tuple (bytes, scanned) with the disk usage of the mail
+        directory of the given *account*.
+
+        With the account.disk_usage_source ``quota``, the size will be read
+        from Dovecot's quota data, if available.  Otherwise the cached disk
+        usage will be used, as long as the mail directory has not been
+        modified since it was scanned at *scanned*.  If it has been, the
+        directory will be summarized and *scanned* will be `None`.  The
+        cache is only updated by `disk_usage_refresh()`, so this stays a
+        read only operation."""
+        path = os.path.join(account.home, account.mail_location.directory)
+        if self._cfg.dget("account.disk_usage_source") == "quota":
+            size = quota_usage(
+                account.mail_location.mbformat,
+                path,
+                get_userquota(self._dbh, account.uid),
+            )
+            if size is not None:
+                return size, None
+        mtime = scan_mtime(account.home, path)
+        cached = get_cached_usage(self._dbh, account.uid)
+        if cached and mtime is not None and cached[1] == mtime:
+            return cached[0], cached[2]
+        return self._get_disk_usage(path), None
+
     def _make_domain_dir(self, domain):
         """Create a directory for the `domain` and its accounts."""
         cwd = os.getcwd()
@@ -382,7 +605,7 @@ class Handler:
                 _("Detected owner/group mismatch in home " "directory."),
                 MAILDIR_PERM_MISMATCH,
             )
-        rmtree(userdir, ignore_errors=True)
+        self._remove_directory(os.path.join(domdir, userdir))
 
     def _delete_domain_dir(self, domdir, gid):
         """Delete a domain's directory.
@@ -415,7 +638,65 @@ class Handler:
                 _("Detected group mismatch in domain directory: " "%s") % domdir,
                 DOMAINDIR_GROUP_MISMATCH,
             )
-        rmtree(domdir, ignore_errors=True)
+        self._remove_directory(domdir)
+
+    def _remove_directory(self, directory):
+        """Removes the *directory* recursively.  With misc.deferred_deletion
+        the directory will only be moved into the trash, see `reap()`."""
+        if self._cfg.dget("misc.deferred_deletion"):
+            try:
+                move_to_trash(directory, self._cfg.dget("misc.base_directory"))
+                return
+            except OSError as err:
+                self._warnings.append(
+                    _("Couldn't move '%(dir)s' into the trash: %(err)s")
+                    % {"dir": directory, "err": err.strerror}
+                )
+        rmtree(directory, ignore_errors=True)
+
+    def reap(self, workers=None, rate=None):
+        """Removes the directories, which have been moved into the trash
+        by the deferred deletion.  *workers* and *rate* default to the
+        settings misc.reap_workers and misc.reap_rate.
+
+        Returns a tuple (entries, removed), see vmm.trash.reap()."""
+        if workers is None:
+            workers = self._cfg.dget("misc.reap_workers")
+        if rate is None:
+            rate = self._cfg.dget("misc.reap_rate")
+        return reap(self._cfg.dget("misc.base_directory"), workers, rate)
+
+    def rollback(self):
+        """Discards all uncommitted changes of the current database
+        transaction."""
+        if self._dbh is not None and not self._dbh.closed:
+            self._dbh.rollback()
+
+    @contextmanager
+    def transaction(self):
+        """Runs all operations within the with block as one unit of work.
+
+        The commits of the single operations are deferred.  When the with
+        block has been left without an exception, all changes are committed
+        at once.  Otherwise all changes made within the block are rolled
+        back and the exception is re-raised.  Transactions may be nested;
+        a failed inner transaction is rolled back to its beginning only.
+
+        Changes in the file system, e.g. created or trashed directories,
+        are not undone by a rollback."""
+        self._db_enter(False)
+        try:
+            self._db_connect()
+            self._dbh.begin()
+            try:
+                yield self
+            except BaseException:
+                self._dbh.end(False)
+                raise
+            self._dbh.end(True)
+        finally:
+            self._depth -= 1
+            self._db_release()
 
     def has_warnings(self):
         """Checks if warnings are present, returns bool."""
@@ -447,6 +728,7 @@ class Handler:
         assert "cfg_dget" not in builtins.__dict__
         builtins.__dict__["cfg_dget"] = self._cfg.dget
 
+    @_db_operation
     def domain_add(self, domainname, transport=None, note=None):
         """Wrapper around Domain's set_quotalimit, set_transport and save."""
         dom = self._get_domain(domainname)
@@ -478,6 +760,7 @@ class Handler:
         dom.save()
         self._make_domain_dir(dom)
 
+    @_db_operation
     def domain_quotalimit(self, domainname, bytes_, messages=0, force=False):
         """Wrapper around Domain.update_quotalimit()."""
         if not all(isinstance(i, int) for i in (bytes_, messages)):
@@ -487,6 +770,7 @@ class Handler:
         quotalimit = QuotaLimit(self._dbh, bytes=bytes_, messages=messages)
         dom.update_quotalimit(quotalimit, force)
 
+    @_db_operation
     def domain_services(self, domainname, force=False, *services):
         """Wrapper around Domain.update_serviceset()."""
         assert isinstance(force, bool)
@@ -500,6 +784,7 @@ class Handler:
         serviceset = ServiceSet(self._dbh, **kwargs)
         dom.update_serviceset(serviceset, force)
 
+    @_db_operation
     def domain_transport(self, domainname, transport, force=False):
         """Wrapper around Domain.update_transport()"""
         assert isinstance(force, bool)
@@ -507,11 +792,13 @@ class Handler:
         trsp = Transport(self._dbh, transport=transport)
         dom.update_transport(trsp, force)
 
+    @_db_operation
     def domain_note(self, domainname, note):
         """Wrapper around Domain.update_note()"""
         dom = self._get_domain(domainname)
         dom.update_note(note)
 
+    @_db_operation
     def domain_delete(self, domainname, del_dir, force=False):
         """Wrapper around Domain.delete()"""
         if not isinstance(del_dir, bool):
@@ -528,6 +815,7 @@ class Handler:
         if del_dir or self._cfg.dget("domain.delete_directory"):
             self._delete_domain_dir(domdir, gid)
 
+    @_db_read_operation
     def domain_info(self, domainname, details=None):
         """Wrapper around Domain.get_info(), Domain.get_accounts(),
         Domain.get_aliase_names(), Domain.get_aliases() and
@@ -537,6 +825,7 @@ class Handler:
             "accounts",
             "aliasdomains",
             "aliases",
+            "du",
             "full",
             "relocated",
             "catchall",
@@ -552,6 +841,19 @@ class Handler:
             ).decode("idna")
         if details is None:
             return dominfo
+        elif details == "du":
+            size, scanned, missing = get_domain_usage(self._dbh, dom.gid)
+            if missing:
+                self._warnings.append(
+                    _(
+                        "The disk usage of %d account(s) has not been "
+                        "summarized yet, see subcommand durefresh."
+                    )
+                    % missing
+                )
+            dominfo["disk usage"] = size
+            dominfo["disk usage scanned"] = scanned
+            return dominfo
         elif details == "accounts":
             return (dominfo, dom.get_accounts())
         elif details == "aliasdomains":
@@ -572,6 +874,7 @@ class Handler:
                 dom.get_catchall(),
             )
 
+    @_db_operation
     def aliasdomain_add(self, aliasname, domainname):
         """Adds an alias domain to the domain.
 
@@ -587,6 +890,7 @@ class Handler:
         alias_dom.set_destination(dom)
         alias_dom.save()
 
+    @_db_read_operation
     def aliasdomain_info(self, aliasname):
         """Returns a dict (keys: "alias" and "domain") with the names of
         the alias domain and its primary domain."""
@@ -594,6 +898,7 @@ class Handler:
         alias_dom = AliasDomain(self._dbh, aliasname)
         return alias_dom.info()
 
+    @_db_operation
     def aliasdomain_switch(self, aliasname, domainname):
         """Modifies the target domain of an existing alias domain.
 
@@ -609,6 +914,7 @@ class Handler:
         alias_dom.set_destination(dom)
         alias_dom.switch()
 
+    @_db_operation
     def aliasdomain_delete(self, aliasname):
         """Deletes the given alias domain.
 
@@ -621,9 +927,87 @@ class Handler:
         alias_dom = AliasDomain(self._dbh, aliasname)
         alias_dom.delete()
 
-    def domain_list(self, pattern=None):
-        """Wrapper around function search() from module Domain."""
-        from vmm.domain import search
+    @_db_operation
+    def disk_usage_refresh(self, domainname=None, full=False):
+        """Refreshes the cached disk usage of all accounts, or of the
+        accounts of the given domain.  Only mail directories, which have been
+        modified since the last scan, will be summarized, unless *full* is
+        `True`.  Returns a tuple (scanned, total)."""
+        self._db_connect()
+        gid = None
+        if domainname:
+            dom = self._get_domain(domainname)
+            if not dom.gid:
+                raise VMMError(
+                    _("The domain '%s' does not exist.") % dom.name, NO_SUCH_DOMAIN
+                )
+            gid = dom.gid
+        return refresh_usage(
+            self._dbh,
+            self._cfg.dget("misc.disk_usage_threads"),
+            full,
+            gid,
+            self._cfg.dget("account.disk_usage_source"),
+        )
+
+    @_db_operation
+    def export_maps(self, force=False):
+        """Wrapper around function export_maps() from module vmm.maps.
+        Only the maps, whose tables have been changed, will be exported,
+        unless *force* is `True`.  Returns the list of the exported maps."""
+        self._db_connect()
+        return export_maps(
+            self._dbh,
+            self._cfg.dget("misc.map_directory"),
+            self._cfg.dget("misc.map_type"),
+            self._cfg.dget("bin.postmap"),
+            force,
+        )
+
+    def authd(self, path=None, group="dovecot"):
+        """Answers the passdb and userdb lookups of Dovecot on the Unix
+        socket *path* (default: misc.authd_socket) until the process is
+        terminated, see vmm.authd.serve_auth()."""
+        if self._pool is None:
+            self._pool = self._db_pool()
+        index = AuthIndex(
+            self._pool,
+            self._cfg.dget("misc.authd_cache_size"),
+            self._cfg.dget("misc.authd_cache_ttl"),
+        )
+        self._follow_changes(index)
+        serve_auth(index, path or self._cfg.dget("misc.authd_socket"), group)
+
+    def _follow_changes(self, *caches):
+        """Invalidates the *caches* on changes, when misc.listen_changes is
+        enabled, see vmm.changes.follow()."""
+        if self._cfg.dget("misc.listen_changes"):
+            follow(ChangeFeed(self._pool.connect), *caches)
+
+    def lookupd(self, path=None, group="postfix", tcp_table=None):
+        """Answers the lookups of Postfix on the Unix socket *path* (default:
+        misc.lookupd_socket) until the process is terminated, see
+        vmm.lookupd.serve_lookups()."""
+        if self._pool is None:
+            self._pool = self._db_pool()
+        index = LookupIndex(
+            self._pool,
+            self._cfg.dget("misc.lookupd_cache_size"),
+            self._cfg.dget("misc.lookupd_cache_ttl"),
+        )
+        self._follow_changes(index)
+        serve_lookups(
+            index, path or self._cfg.dget("misc.lookupd_socket"), group, tcp_table
+        )
+
+    @_db_read_operation
+    def domain_list(self, pattern=None, stream=False, after=None, limit=None):
+        """Wrapper around function search() from module Domain.
+
+        When *stream* is `True`, an iterator over (gid, names) tuples will
+        be returned, see function iter_domains() from module Domain.
+        *after* and *limit* select a page of the result, see iter_domains()."""
+        from vmm.domain import iter_domains, search
 
         like = False
         if pattern and (pattern.startswith("%") or pattern.endswith("%")):
@@ -634,12 +1018,39 @@ class Handler:
                     DOMAIN_INVALID,
                 )
         self._db_connect()
-        return search(self._dbh, pattern=pattern, like=like)
-
-    def address_list(self, typelimit, pattern=None):
-        """TODO"""
+        if not (stream or after or limit):
+            return search(self._dbh, pattern=pattern, like=like)
+        domains = iter_domains(
+            self._dbh,
+            pattern=pattern,
+            like=like,
+            after=after,
+            limit=limit,
+            fetch_size=self._cfg.dget("database.fetch_size"),
+        )
+        if stream:
+            return self._stream(domains)
+        domains = list(domains)
+        return [gid for gid, names in domains], dict(domains)
+
+    @_db_read_operation
+    def address_list(
+        self, typelimit, pattern=None, stream=False, after=None, limit=None
+    ):
+        """Search for addresses of the types in *typelimit* (a bitwise OR
+        of `TYPE_*` constants) by *pattern*.
+
+        Only addresses sorted after the address *after* will be returned,
+        at most *limit* addresses, when given.
+
+        Returns the result of the function search_addresses() from module
+        vmm.common, or, when *stream* is `True`, an iterator as returned by
+        vmm.common.iter_addresses()."""
         llike = dlike = False
         lpattern = dpattern = None
+        if after:
+            after = EmailAddress(after)
+            after = (after.localpart, after.domainname)
         if pattern:
             parts = pattern.split("@", 2)
             if len(parts) == 2:
@@ -669,8 +1080,22 @@ class Handler:
                     DOMAIN_INVALID,
                 )
         self._db_connect()
-        from vmm.common import search_addresses
-
+        from vmm.common import iter_addresses, search_addresses
+
+        if stream:
+            return self._stream(
+                iter_addresses(
+                    self._dbh,
+                    typelimit=typelimit,
+                    lpattern=lpattern,
+                    llike=llike,
+                    dpattern=dpattern,
+                    dlike=dlike,
+                    after=after,
+                    limit=limit,
+                    fetch_size=self._cfg.dget("database.fetch_size"),
+                )
+            )
         return search_addresses(
             self._dbh,
             typelimit=typelimit,
@@ -678,8 +1103,11 @@ class Handler:
             llike=llike,
             dpattern=dpattern,
             dlike=dlike,
+            after=after,
+            limit=limit,
         )
 
+    @_db_operation
     def user_add(self, emailaddress, password, note=None):
         """Wrapper around Account.set_password() and Account.save()."""
         acc = self._get_account(emailaddress)
@@ -694,29 +1122,354 @@ class Handler:
         acc.save()
         self._make_account_dirs(acc)
 
+    def _bulk_account(self, record, domains, lookups):
+        """Validates the *record* and returns a tuple with the new Account
+        and its generated password, or None if the record provides a
+        password (hash).
+
+        *domains* maps domain names to the already loaded Domains and
+        *lookups* caches the QuotaLimits, ServiceSets, Transports and the
+        MailLocation, which are shared by many records.
+        """
+        for key in record:
+            if key not in BULK_USER_FIELDS:
+                raise VMMError(_("Unknown field: '%s'") % key, INVALID_ARGUMENT)
+        for key in ("address", "name", "note", "password", "pwhash", "transport"):
+            if record.get(key) is not None and not isinstance(record[key], str):
+                raise VMMError(
+                    _("The value of the field '%s' is not a string.") % key,
+                    INVALID_ARGUMENT,
+                )
+        services = record.get("services")
+        if not (
+            services is None
+            or isinstance(services, str)
+            or isinstance(services, list)
+            and all(isinstance(service, str) for service in services)
+        ):
+            raise VMMError(
+                _("The value of the field 'services' is not a list of strings."),
+                INVALID_ARGUMENT,
+            )
+        if not record.get("address"):
+            raise VMMError(_("Missing e-mail address."), INVALID_ARGUMENT)
+        address = EmailAddress(record["address"].lower())
+        domain = domains.get(address.domainname)
+        if domain is None:
+            domain = domains[address.domainname] = Domain(
+                self._dbh, address.domainname
+            )
+        if not domain.gid:
+            raise VMMError(
+                _("The domain '%s' does not exist.") % address.domainname,
+                NO_SUCH_DOMAIN,
+            )
+        account = Account(self._dbh, address, domain)
+        if account:
+            raise VMMError(
+                _("The account '%s' already exists.") % address, ACCOUNT_EXISTS
+            )
+        password = None
+        if record.get("pwhash"):
+            scheme = extract_scheme(record["pwhash"])
+            if not scheme:
+                raise VMMError(
+                    _("Missing {SCHEME} prefix from password hash."), INVALID_ARGUMENT
+                )
+            verify_scheme(scheme)
+            account.set_pwhash(record["pwhash"])
+        elif record.get("password"):
+            account.set_password(record["password"])
+        elif self._cfg.dget("account.random_password"):
+            password = randompw(self._cfg.dget("account.password_length"))
+            account.set_password(password)
+        else:
+            raise VMMError(
+                _("No password set for account: '%s'") % address, INVALID_ARGUMENT
+            )
+        account.set_name(record.get("name") or None)
+        account.set_note(record.get("note") or None)
+
+        quota = record.get("quota")
+        messages = record.get("quota_messages")
+        if quota in (None, "", "domain") and messages in (None, ""):
+            account.set_quotalimit(None)
+        else:
+            try:
+                quota = 0 if quota in (None, "", "domain") else size_in_bytes(quota)
+                messages = int(messages) if messages not in (None, "") else 0
+            except (TypeError, ValueError) as err:
+                raise VMMError(str(err), INVALID_ARGUMENT)
+            key = ("quotalimit", quota, messages)
+            if key not in lookups:
+                lookups[key] = QuotaLimit(self._dbh, bytes=quota, messages=messages)
+            account.set_quotalimit(lookups[key])
+
+        if isinstance(services, str):
+            services = re.split(r"[\s,:]+", services.strip())
+        services = [s for s in services or () if s]
+        if not services or services == ["domain"]:
+            account.set_serviceset(None)
+        else:
+            kwargs = dict.fromkeys(SERVICES, False)
+            for service in services:
+                if service not in SERVICES:
+                    raise VMMError(
+                        _("Unknown service: '%s'") % service, UNKNOWN_SERVICE
+                    )
+                kwargs[service] = True
+            key = ("serviceset",) + tuple(kwargs[s] for s in SERVICES)
+            if key not in lookups:
+                lookups[key] = ServiceSet(self._dbh, **kwargs)
+            account.set_serviceset(lookups[key])
+
+        transport = record.get("transport")
+        if transport in (None, "", "domain"):
+            account.set_transport(None)
+        else:
+            key = ("transport", transport)
+            if key not in lookups:
+                lookups[key] = Transport(self._dbh, transport=transport)
+            account.set_transport(lookups[key])
+
+        # the checks of save_accounts(), so their errors are reported with
+        # the errors of the other records
+        key = ("maillocation",)
+        if key not in lookups:
+            lookups[key] = MailLocation(
+                self._dbh,
+                mbfmt=self._cfg.dget("mailbox.format"),
+                directory=self._cfg.dget("mailbox.root"),
+            )
+        account.prepare(lookups[key])
+        return account, password
+
+    @_db_operation
+    def bulk_user_add(self, records):
+        """Creates many new accounts at once.
+
+        Each record of *records* is a dict with the keys: 'address' and
+        optionally 'password' or 'pwhash', 'name', 'note', 'quota',
+        'quota_messages', 'services' and 'transport'.  'quota' accepts the
+        same values as `vmm.common.size_in_bytes()`, 'services' is a list
+        (or a string separated by whitespace, ',' or ':') of service names.
+        Empty values or 'domain' select the domain's defaults.
+
+        All records will be validated, before the first account is stored.
+        When one or more records are invalid, a VMMError, describing all
+        errors, will be raised and nothing will be stored.  The accounts
+        are inserted in a single transaction, the directories are created
+        afterwards.
+
+        Returns a list of (address, password) tuples for the accounts
+        without a password, if account.random_password is `True`.
+        """
+        # quota limits, service sets and transports, which are missing, are
+        # inserted while validating, so they are part of the transaction
+        with self.transaction():
+            accounts, generated = self._bulk_user_save(records)
+        for account in accounts:
+            try:
+                self._make_account_dirs(account)
+            except (OSError, VMMError) as err:
+                self._warnings.append(
+                    _(
+                        "Could not create the directories of the account "
+                        "'%(address)s': %(reason)s"
+                    )
+                    % {"address": account.address, "reason": err}
+                )
+        return generated
+
+    def _bulk_user_save(self, records):
+        """Validates the *records* and saves the new accounts, see
+        `bulk_user_add()`.  Returns a tuple with the list of the new
+        Accounts and the list of the generated passwords."""
+        accounts = []
+        errors = []
+        generated = []
+        seen = {}
+        domains = {}
+        lookups = {}
+        for num, record in enumerate(records, 1):
+            try:
+                account, password = self._bulk_account(record, domains, lookups)
+            except VMMError as err:
+                errors.append((num, record.get("address"), err.msg))
+                continue
+            if account.address in seen:
+                errors.append(
+                    (
+                        num,
+                        record.get("address"),
+                        _("Duplicate of record %d.") % seen[account.address],
+                    )
+                )
+                continue
+            seen[account.address] = num
+            accounts.append((num, account))
+            if password:
+                generated.append((account.address, password))
+
+        types = classify_addresses(
+            self._dbh, [account.address for num, account in accounts]
+        )
+        for num, account in accounts:
+            other = types[account.address] & ~TYPE_ACCOUNT
+            if other:
+                # the lowest bit set: TYPE_ALIAS before TYPE_RELOCATED
+                other &= -other
+                # TP: %(a_type)s will be one of: 'an account', 'an alias'
+                # or 'a relocated user'
+                msg = _(
+                    "There is already %(a_type)s with the address '%(address)s'."
+                ) % {"a_type": OTHER_TYPES[other][0], "address": account.address}
+                errors.append((num, str(account.address), msg))
+        if errors:
+            errors.sort(key=lambda error: error[0])
+            raise VMMError(
+                _("Invalid records, no account has been created:")
+                + "".join(
+                    "\n\t"
+                    + _("record %(num)d (%(address)s): %(reason)s")
+                    % {"num": num, "address": address, "reason": msg}
+                    for num, address, msg in errors
+                ),
+                INVALID_ARGUMENT,
+            )
+
+        accounts = [account for num, account in accounts]
+        save_accounts(self._dbh, accounts)
+        return accounts, generated
+
+    @_db_operation
+    def bulk_user_password(self, records, scheme=None):
+        """Updates the passwords of many accounts at once.
+
+        Each record of *records* is a dict with the keys: 'address' and
+        optionally 'password' or 'pwhash'.  The plain text passwords are
+        hashed using the *scheme*, or the configured misc.password_scheme,
+        by `vmm.password.pwhash_many()`.
+
+        All records will be validated, before the first password is
+        updated.  When one or more records are invalid, a VMMError,
+        describing all errors, will be raised and nothing will be changed.
+        All passwords are updated in a single transaction.
+
+        Returns a list of (address, password) tuples for the records
+        without a password, if account.random_password is `True`.
+        """
+        self._db_connect()
+        if scheme is not None:
+            verify_scheme(scheme)
+        errors = []
+        generated = []
+        seen = {}
+        domains = {}
+        hashes = []
+        plain = []
+        for num, record in enumerate(records, 1):
+            try:
+                for key in record:
+                    if key not in BULK_PASSWORD_FIELDS:
+                        raise VMMError(
+                            _("Unknown field: '%s'") % key, INVALID_ARGUMENT
+                        )
+                if not record.get("address"):
+                    raise VMMError(_("Missing e-mail address."), INVALID_ARGUMENT)
+                address = EmailAddress(record["address"].lower())
+                domain = domains.get(address.domainname)
+                if domain is None:
+                    domain = domains[address.domainname] = Domain(
+                        self._dbh, address.domainname
+                    )
+                if not domain.gid:
+                    raise VMMError(
+                        _("The domain '%s' does not exist.") % address.domainname,
+                        NO_SUCH_DOMAIN,
+                    )
+                account = Account(self._dbh, address, domain)
+                if not account:
+                    raise VMMError(
+                        _("The account '%s' does not exist.") % address,
+                        NO_SUCH_ACCOUNT,
+                    )
+                if record.get("pwhash"):
+                    pw_scheme = extract_scheme(record["pwhash"])
+                    if not pw_scheme:
+                        raise VMMError(
+                            _("Missing {SCHEME} prefix from password hash."),
+                            INVALID_ARGUMENT,
+                        )
+                    verify_scheme(pw_scheme)
+                    password = None
+                elif record.get("password"):
+                    password = record["password"]
+                elif self._cfg.dget("account.random_password"):
+                    password = randompw(self._cfg.dget("account.password_length"))
+                    generated.append((address, password))
+                else:
+                    raise VMMError(
+                        _("No password set for account: '%s'") % address,
+                        INVALID_ARGUMENT,
+                    )
+            except VMMError as err:
+                errors.append((num, record.get("address"), err.msg))
+                continue
+            if address in seen:
+                errors.append(
+                    (
+                        num,
+                        record.get("address"),
+                        _("Duplicate of record %d.") % seen[address],
+                    )
+                )
+                continue
+            seen[address] = num
+            if password is None:
+                hashes.append((account.uid, record["pwhash"]))
+            else:
+                plain.append((account, password))
+        if errors:
+            raise VMMError(
+                _("Invalid records, no password has been changed:")
+                + "".join(
+                    "\n\t"
+                    + _("record %(num)d (%(address)s): %(reason)s")
+                    % {"num": num, "address": address, "reason": msg}
+                    for num, address, msg in errors
+                ),
+                INVALID_ARGUMENT,
+            )
+
+        hashed = pwhash_many(
+            [password for account, password in plain],
+            scheme,
+            [account.address for account, password in plain],
+            self._cfg.dget("misc.password_hash_workers"),
+        )
+        hashes.extend(
+            (account.uid, pwhash) for (account, password), pwhash in zip(plain, hashed)
+        )
+        update_passwords(self._dbh, hashes)
+        return generated
+
+    @_db_operation
     def alias_add(self, aliasaddress, *targetaddresses):
         """Creates a new `Alias` entry for the given *aliasaddress* with
         the given *targetaddresses*."""
         alias = self._get_alias(aliasaddress)
         if not alias:
             self._is_other_address(alias.address, TYPE_ALIAS)
-        destinations = [
-            DestinationEmailAddress(addr, self._dbh) for addr in targetaddresses
-        ]
+        destinations = destination_addresses(targetaddresses, self._dbh)
         warnings = []
         destinations = alias.add_destinations(destinations, warnings)
         if warnings:
             self._warnings.append(_("Ignored destination addresses:"))
             self._warnings.extend(("  * %s" % w for w in warnings))
-        for destination in destinations:
-            if destination.gid and not self._chk_other_address_types(
-                destination, TYPE_RELOCATED
-            ):
-                self._warnings.append(
-                    _("The destination account/alias '%s' " "does not exist.")
-                    % destination
-                )
+        self._warn_unknown_destinations(destinations)
 
+    @_db_operation
     def user_delete(self, emailaddress, del_dir, force=False):
         """Wrapper around Account.delete(...)"""
         if not isinstance(del_dir, bool):
@@ -756,6 +1509,7 @@ The account has been successfully deleted from the database.
                 else:
                     raise
 
+    @_db_read_operation
     def alias_info(self, aliasaddress):
         """Returns an iterator object for all destinations (`EmailAddress`
         instances) for the `Alias` with the given *aliasaddress*."""
@@ -767,6 +1521,7 @@ The account has been successfully deleted from the database.
                 _("The alias '%s' does not exist.") % alias.address, NO_SUCH_ALIAS
             )
 
+    @_db_operation
     def alias_delete(self, aliasaddress, targetaddresses=None):
         """Deletes the `Alias` *aliasaddress* with all its destinations from
         the database. If *targetaddresses* is not ``None``, only the given
@@ -776,9 +1531,7 @@ The account has been successfully deleted from the database.
         if targetaddresses is None:
             alias.delete()
         else:
-            destinations = [
-                DestinationEmailAddress(addr, self._dbh) for addr in targetaddresses
-            ]
+            destinations = destination_addresses(targetaddresses, self._dbh)
             warnings = []
             try:
                 alias.del_destinations(destinations, warnings)
@@ -790,32 +1543,26 @@ The account has been successfully deleted from the database.
             if error:
                 raise error
 
+    @_db_operation
     def catchall_add(self, domain, *targetaddresses):
         """Creates a new `CatchallAlias` entry for the given *domain* with
         the given *targetaddresses*."""
         catchall = self._get_catchall(domain)
-        destinations = [
-            DestinationEmailAddress(addr, self._dbh) for addr in targetaddresses
-        ]
+        destinations = destination_addresses(targetaddresses, self._dbh)
         warnings = []
         destinations = catchall.add_destinations(destinations, warnings)
         if warnings:
             self._warnings.append(_("Ignored destination addresses:"))
             self._warnings.extend(("  * %s" % w for w in warnings))
-        for destination in destinations:
-            if destination.gid and not self._chk_other_address_types(
-                destination, TYPE_RELOCATED
-            ):
-                self._warnings.append(
-                    _("The destination account/alias '%s' " "does not exist.")
-                    % destination
-                )
+        self._warn_unknown_destinations(destinations)
 
+    @_db_read_operation
     def catchall_info(self, domain):
         """Returns an iterator object for all destinations (`EmailAddress`
         instances) for the `CatchallAlias` with the given *domain*."""
         return self._get_catchall(domain).get_destinations()
 
+    @_db_operation
     def catchall_delete(self, domain, targetaddresses=None):
         """Deletes the `CatchallAlias` for domain *domain* with all its
         destinations from the database.  If *targetaddresses* is not
@@ -825,9 +1572,7 @@ The account has been successfully deleted from the database.
         if targetaddresses is None:
             catchall.delete()
         else:
-            destinations = [
-                DestinationEmailAddress(addr, self._dbh) for addr in targetaddresses
-            ]
+            destinations = destination_addresses(targetaddresses, self._dbh)
             warnings = []
             try:
                 catchall.del_destinations(destinations, warnings)
@@ -839,6 +1584,7 @@ The account has been successfully deleted from the database.
             if error:
                 raise error
 
+    @_db_read_operation
     def user_info(self, emailaddress, details=None):
         """Wrapper around Account.get_info(...)"""
         if details not in (None, "du", "aliases", "full"):
@@ -851,14 +1597,15 @@ The account has been successfully deleted from the database.
                 )
         info = acc.get_info()
         if self._cfg.dget("account.disk_usage") or details in ("du", "full"):
-            path = os.path.join(acc.home, acc.mail_location.directory)
-            info["disk usage"] = self._get_disk_usage(path)
+            usage = self._get_account_disk_usage(acc)
+            info["disk usage"], info["disk usage scanned"] = usage
             if details in (None, "du"):
                 return info
         if details in ("aliases", "full"):
             return (info, acc.get_aliases())
         return info
 
+    @_db_read_operation
     def user_by_uid(self, uid):
         """Search for an Account by its *uid*.
         Returns a dict (address, uid and gid) if a user could be found."""
@@ -867,6 +1614,7 @@ The account has been successfully deleted from the database.
         self._db_connect()
         return get_account_by_uid(uid, self._dbh)
 
+    @_db_operation
     def user_password(self, emailaddress, password, scheme=None):
         """Wrapper for Account.update_password(...)."""
         if not isinstance(password, str) or not password:
@@ -880,6 +1628,7 @@ The account has been successfully deleted from the database.
             )
         acc.update_password(password, scheme)
 
+    @_db_operation
     def user_pwhash(self, emailaddress, pwhash):
         """Wrapper for Account.modify('pwhash', ...)"""
         scheme = extract_scheme(pwhash)
@@ -896,6 +1645,7 @@ The account has been successfully deleted from the database.
             )
         acc.modify("pwhash", pwhash)
 
+    @_db_operation
     def user_name(self, emailaddress, name):
         """Wrapper for Account.modify('name', ...)."""
         acc = self._get_account(emailaddress)
@@ -905,6 +1655,7 @@ The account has been successfully deleted from the database.
             )
         acc.modify("name", name)
 
+    @_db_operation
     def user_note(self, emailaddress, note):
         """Wrapper for Account.modify('note', ...)."""
         acc = self._get_account(emailaddress)
@@ -914,6 +1665,7 @@ The account has been successfully deleted from the database.
             )
         acc.modify("note", note)
 
+    @_db_operation
     def user_quotalimit(self, emailaddress, bytes_, messages=0):
         """Wrapper for Account.update_quotalimit(QuotaLimit)."""
         acc = self._get_account(emailaddress)
@@ -931,6 +1683,7 @@ The account has been successfully deleted from the database.
             quotalimit = QuotaLimit(self._dbh, bytes=bytes_, messages=messages)
         acc.update_quotalimit(quotalimit)
 
+    @_db_operation
     def user_transport(self, emailaddress, transport):
         """Wrapper for Account.update_transport(Transport)."""
         if not isinstance(transport, str) or not transport:
@@ -947,6 +1700,7 @@ The account has been successfully deleted from the database.
         )
         acc.update_transport(transport)
 
+    @_db_operation
     def user_services(self, emailaddress, *services):
         """Wrapper around Account.update_serviceset()."""
         acc = self._get_account(emailaddress)
@@ -967,6 +1721,7 @@ The account has been successfully deleted from the database.
             serviceset = ServiceSet(self._dbh, **kwargs)
         acc.update_serviceset(serviceset)
 
+    @_db_operation
     def relocated_add(self, emailaddress, targetaddress):
         """Creates a new `Relocated` entry in the database. If there is
         already a relocated user with the given *emailaddress*, only the
@@ -976,13 +1731,9 @@ The account has been successfully deleted from the database.
             self._is_other_address(relocated.address, TYPE_RELOCATED)
         destination = DestinationEmailAddress(targetaddress, self._dbh)
         relocated.set_destination(destination)
-        if destination.gid and not self._chk_other_address_types(
-            destination, TYPE_RELOCATED
-        ):
-            self._warnings.append(
-                _("The destination account/alias '%s' " "does not exist.") % destination
-            )
+        self._warn_unknown_destinations((destination,))
 
+    @_db_read_operation
     def relocated_info(self, emailaddress):
         """Returns the target address of the relocated user with the given
         *emailaddress*."""
@@ -995,6 +1746,7 @@ The account has been successfully deleted from the database.
                 NO_SUCH_RELOCATED,
             )
 
+    @_db_operation
     def relocated_delete(self, emailaddress):
         """Deletes the relocated user with the given *emailaddress* from
         the database."""
@@ -0,0 +1,348 @@
+# -*- coding: UTF-8 -*-
+# Copyright (c) 2014, Pascal Volk
+# See COPYING for distribution information.
+"""
+    vmm.lookupd
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    A lookup daemon for Postfix, which speaks the socketmap (or tcp_table)
+    protocol on a Unix socket.  The lookups are answered from a cache of
+    the domains and addresses in memory, with the same results as the
+    postfix_*_map() functions from create_tables.pgsql.
+"""
+
+import socketserver
+import string
+import threading
+import time
+from urllib.parse import quote, unquote
+
+import psycopg2
+
+from vmm.daemon import TTLCache, fetch, serve
+from vmm.maps import interpolate_destination
+
+
+__all__ = ("MAP_NAMES", "LookupIndex", "serve_lookups")
+
+# map name: LookupIndex method
+MAP_NAMES = {
+    "gid": "_gid_map",
+    "relocated": "_relocated",
+    "sender_login": "_sender_login",
+    "transport": "_transport",
+    "uid": "_uid",
+    "virtual_alias": "_virtual_alias",
+    "virtual_mailbox": "_virtual_mailbox",
+}
+# the longest request accepted (a map name and an address)
+MAX_REQUEST = 1024
+# characters, which are not %XX encoded in tcp_table replies
+_TCP_SAFE = "".join(char for char in string.punctuation if char != "%")
+
+
+class DomainData:
+    """The rows of a domain (and its alias domains), which are needed to
+    answer the lookups of all its addresses."""
+
+    __slots__ = ("catchall", "domaindir", "gid", "names", "transport")
+
+    def __init__(self, gid):
+        self.gid = gid
+        self.names = []
+        self.domaindir = None
+        self.transport = None
+        self.catchall = []
+
+
+class AddressData:
+    """The rows of a local part of a domain, needed to answer the lookups
+    of its address."""
+
+    __slots__ = ("aliases", "relocated", "user")
+
+    def __init__(self):
+        # (uid, directory, transport or None) of an account, or None
+        self.user = None
+        # [destination, ...]
+        self.aliases = []
+        # destination of a relocated user, or None
+        self.relocated = None
+
+
+class LookupIndex:
+    """Answers the lookups from memory.
+
+    The domain names are loaded completely.  The rows of a domain and the
+    rows of an address are loaded on the first lookup of the address.  At
+    most *max_size* domains and *max_size* addresses are kept, the least
+    recently used are dropped.  The names, domains and addresses are
+    reloaded *ttl* seconds after they have been loaded, so changes are
+    visible after *ttl* seconds at the latest.
+
+    The connections are checked out of the *pool* per query."""
+
+    __slots__ = (
+        "_addresses",
+        "_domains",
+        "_lock",
+        "_names",
+        "_names_generation",
+        "_names_loaded",
+        "_pool",
+        "_ttl",
+    )
+
+    def __init__(self, pool, max_size=100000, ttl=60):
+        self._pool = pool
+        self._ttl = ttl
+        self._domains = TTLCache(max_size, ttl)
+        self._addresses = TTLCache(max_size, ttl)
+        self._lock = threading.Lock()
+        self._names = {}
+        # incremented, when the names have to be reloaded
+        self._names_generation = 0
+        self._names_loaded = None
+
+    def _gid(self, domainname):
+        """Returns the gid of the domain *domainname* or `None`."""
+        with self._lock:
+            loaded = self._names_loaded
+            names = self._names
+            generation = self._names_generation
+        if loaded is None or (self._ttl and time.monotonic() - loaded >= self._ttl):
+            # the other lookups are answered meanwhile
+            now = time.monotonic()
+            names = dict(fetch(self._pool, "SELECT domainname, gid FROM domain_name"))
+            with self._lock:
+                if generation == self._names_generation:
+                    self._names = names
+                    self._names_loaded = now
+        return names.get(domainname)
+
+    def _load_domain(self, gid):
+        """Loads the DomainData of the domain with the *gid*."""
+        # fmt: off
+        sql = (
+            "SELECT 'n', domainname, NULL "
+            "FROM domain_name "
+            "WHERE gid = %(gid)s "
+            "UNION ALL "
+            "SELECT 'd', domaindir, transport "
+            "FROM domain_data "
+            "JOIN transport USING (tid) "
+            "WHERE gid = %(gid)s "
+            "UNION ALL "
+            "SELECT 'c', NULL, destination "
+            "FROM catchall "
+            "WHERE gid = %(gid)s"
+        )
+        # fmt: on
+        dom = DomainData(gid)
+        for kind, name, value in fetch(self._pool, sql, {"gid": gid}):
+            if kind == "n":
+                dom.names.append(name)
+            elif kind == "d":
+                dom.domaindir, dom.transport = name, value
+            else:
+                dom.catchall.append(value)
+        dom.names.sort()
+        return dom
+
+    def _load_address(self, key):
+        """Loads the AddressData of the *key* (gid, local part)."""
+        # fmt: off
+        sql = (
+            "SELECT 'u', uid::text, directory, transport "
+            "FROM users "
+            "JOIN maillocation USING (mid) "
+            "LEFT JOIN transport USING (tid) "
+            "WHERE gid = %(gid)s AND local_part = %(local_part)s "
+            "UNION ALL "
+            "SELECT 'a', destination, NULL, NULL "
+            "FROM alias "
+            "WHERE gid = %(gid)s AND address = %(local_part)s "
+            "UNION ALL "
+            "SELECT 'r', destination, NULL, NULL "
+            "FROM relocated "
+            "WHERE gid = %(gid)s AND address = %(local_part)s"
+        )
+        # fmt: on
+        gid, local_part = key
+        addr = AddressData()
+        params = {"gid": gid, "local_part": local_part}
+        for kind, value, directory, transport in fetch(self._pool, sql, params):
+            if kind == "u":
+                addr.user = (value, directory, transport)
+            elif kind == "a":
+                addr.aliases.append(value)
+            else:
+                addr.relocated = value
+        return addr
+
+    def lookup(self, map_name, key):
+        """Returns the list of results of the lookup of *key* (an address,
+        or a domain name for the map ``gid``) in the map *map_name*, see
+        `MAP_NAMES`.  Raises a KeyError for unknown maps."""
+        method = getattr(self, MAP_NAMES[map_name])
+        localpart, _, domainname = key.lower().rpartition("@")
+        if map_name == "gid":
+            return method(domainname)
+        if not localpart:
+            # postfix suppresses queries with %u, when the key has no localpart
+            return []
+        gid = self._gid(domainname)
+        if gid is None:
+            return []
+        dom = self._domains.get(gid, self._load_domain)
+        addr = self._addresses.get((gid, localpart), self._load_address)
+        return method(dom, addr, localpart, domainname)
+
+    def invalidate(self, gid=None, table=None, local_part=None):
+        """Forgets the address *local_part* of the domain with the *gid*,
+        the domain, when *local_part* is `None`, or everything, when *gid*
+        is `None`.  The domain names will be reloaded by the next lookup,
+        when the *table* domain_name has been changed, or *gid* is `None`,
+        see `vmm.changes.Change`."""
+        if gid is None or table == "domain_name":
+            with self._lock:
+                self._names_generation += 1
+                self._names_loaded = None
+        if gid is None:
+            self._domains.clear()
+            self._addresses.clear()
+        elif local_part is None:
+            self._domains.discard(gid)
+        else:
+            self._addresses.discard((gid, local_part))
+
+    def _gid_map(self, domainname):
+        gid = self._gid(domainname)
+        return [] if gid is None else [str(gid)]
+
+    def _relocated(self, dom, addr, localpart, domainname):
+        return [] if addr.relocated is None else [addr.relocated]
+
+    def _sender_login(self, dom, addr, localpart, domainname):
+        if addr.user is not None:
+            return ["%s@%s" % (localpart, name) for name in dom.names]
+        # DISTINCT
+        return list(dict.fromkeys(addr.aliases))
+
+    def _transport(self, dom, addr, localpart, domainname):
+        if addr.user is not None and addr.user[2] is not None:
+            return [addr.user[2]]
+        return [dom.transport]
+
+    def _uid(self, dom, addr, localpart, domainname):
+        return [] if addr.user is None else [addr.user[0]]
+
+    def _virtual_alias(self, dom, addr, localpart, domainname):
+        if addr.aliases:
+            return [
+                interpolate_destination(dest, localpart, domainname)
+                for dest in addr.aliases
+            ]
+        if not dom.catchall:
+            return []
+        if addr.user is not None or addr.relocated is not None:
+            # the catch-all doesn't take precedence over accounts and
+            # relocated users
+            return ["%s@%s" % (localpart, domainname)]
+        return [
+            interpolate_destination(dest, localpart, domainname)
+            for dest in dom.catchall
+        ]
+
+    def _virtual_mailbox(self, dom, addr, localpart, domainname):
+        if addr.user is None:
+            return []
+        return ["%s/%s/%s/" % (dom.domaindir, addr.user[0], addr.user[1])]
+
+
+def _answer(index, map_name, key):
+    """Returns a tuple (status, data): ``OK``, ``NOTFOUND``, ``TEMP`` or
+    ``PERM`` and the results separated by commas or the reason."""
+    try:
+        results = index.lookup(map_name, key)
+    except KeyError:
+        return "PERM", "unknown map: %s" % map_name
+    except psycopg2.Error:
+        return "TEMP", "database error"
+    if not results:
+        return "NOTFOUND", ""
+    return "OK", ",".join(results)
+
+
+def _read_netstring(rfile):
+    """Reads a netstring from *rfile*.  Returns `None` at the end of the
+    stream.  Raises a ValueError if the data is not a netstring."""
+    length = b""
+    while True:
+        char = rfile.read(1)
+        if not char and not length:
+            return None
+        if char == b":":
+            break
+        if not char.isdigit() or len(length) > len(str(MAX_REQUEST)):
+            raise ValueError("invalid netstring length")
+        length += char
+    length = int(length)
+    if length > MAX_REQUEST:
+        raise ValueError("request too long")
+    data = rfile.read(length + 1)
+    if len(data) != length + 1 or data[-1:] != b",":
+        raise ValueError("invalid netstring")
+    return data[:-1].decode("utf-8", "replace")
+
+
+class SocketmapHandler(socketserver.StreamRequestHandler):
+    """Answers the requests of a Postfix socketmap client, see
+    socketmap_table(5)."""
+
+    def handle(self):
+        while True:
+            try:
+                request = _read_netstring(self.rfile)
+            except ValueError:
+                return
+            if request is None:
+                return
+            map_name, _, key = request.partition(" ")
+            status, data = _answer(self.server.index, map_name, key)
+            reply = ("%s %s" % (status, data)).encode("utf-8")
+            self.wfile.write(b"%d:%s," % (len(reply), reply))
+            self.wfile.flush()
+
+
+class TCPTableHandler(socketserver.StreamRequestHandler):
+    """Answers the requests of a Postfix tcp_table client for the map
+    `self.server.map_name`, see tcp_table(5)."""
+
+    codes = {"OK": 200, "NOTFOUND": 500, "PERM": 500, "TEMP": 400}
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_REQUEST + 1)
+            if not line:
+                return
+            command, _, key = line.decode("utf-8", "replace").strip().partition(" ")
+            if command.lower() != "get":
+                reply = "500 %s" % quote("unsupported command", safe=_TCP_SAFE)
+            else:
+                status, data = _answer(
+                    self.server.index, self.server.map_name, unquote(key)
+                )
+                reply = "%d %s" % (self.codes[status], quote(data, safe=_TCP_SAFE))
+            self.wfile.write(reply.encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+def serve_lookups(index, path, group=None, tcp_table=None):
+    """Answers lookups from the LookupIndex *index* on the Unix socket
+    *path*, accessible by the *group*.  The socketmap protocol will be
+    spoken, unless the name of a map is given by *tcp_table*."""
+    if tcp_table is None:
+        serve(path, SocketmapHandler, group, index=index)
+    else:
+        serve(path, TCPTableHandler, group, index=index, map_name=tcp_table)
@@ -13,15 +13,20 @@
 from gettext import gettext as _
 
 from vmm.constants import MAILLOCATION_INIT
+from vmm.database import lookup_cache
 from vmm.errors import MailLocationError as MLErr
 
 
-__all__ = ("MailLocation", "known_format")
+__all__ = ("MailLocation", "known_format", "usage_source")
 
+# usage_source: where Dovecot keeps track of the mailbox size, see
+# usage_source()
 _format_info = {
-    "maildir": dict(dovecot_version=0x10000F00, postfix=True),
-    "mdbox": dict(dovecot_version=0x20000B05, postfix=False),
-    "sdbox": dict(dovecot_version=0x20000C03, postfix=False),
+    "maildir": dict(
+        dovecot_version=0x10000F00, postfix=True, usage_source="maildirsize"
+    ),
+    "mdbox": dict(dovecot_version=0x20000B05, postfix=False, usage_source="userquota"),
+    "sdbox": dict(dovecot_version=0x20000C03, postfix=False, usage_source="userquota"),
 }
 
 
@@ -80,6 +85,17 @@ class MailLocation:
                 )
             self._load_by_names(args[0].lower(), directory)
 
+    @classmethod
+    def _from_row(cls, dbh, mid, mbfmt, directory):
+        """Creates a MailLocation from the already fetched mid, format and
+        directory, without a query."""
+        maillocation = cls.__new__(cls)
+        maillocation._dbh = dbh
+        maillocation._mid = mid
+        maillocation._mbfmt = mbfmt
+        maillocation._directory = directory
+        return maillocation
+
     def __str__(self):
         return "%s:~/%s" % (self._mbfmt, self._directory)
 
@@ -98,6 +114,11 @@ class MailLocation:
         """`True` if Postfix supports this mailbox format, else `False`."""
         return _format_info[self._mbfmt]["postfix"]
 
+    @property
+    def usage_source(self):
+        """The source of the mailbox size, see function usage_source()."""
+        return usage_source(self._mbfmt)
+
     @property
     def mbformat(self):
         """The mail_location's mailbox format."""
@@ -115,17 +136,21 @@ class MailLocation:
 
     def _load_by_mid(self, mid):
         """Load mail_location relevant information by *mid*"""
-        dbc = self._dbh.cursor()
-        # fmt: off
-        dbc.execute(
-            "SELECT format, directory "
-            "FROM mailboxformat, maillocation "
-            "WHERE mid = %s AND maillocation.fid = mailboxformat.fid",
-            (mid,)
-        )
-        # fmt: on
-        result = dbc.fetchone()
-        dbc.close()
+        cache = lookup_cache(self._dbh)
+        if cache is not None:
+            result = cache.get(self._dbh, "maillocation", mid)
+        else:
+            dbc = self._dbh.cursor()
+            # fmt: off
+            dbc.execute(
+                "SELECT format, directory "
+                "FROM mailboxformat, maillocation "
+                "WHERE mid = %s AND maillocation.fid = mailboxformat.fid",
+                (mid,)
+            )
+            # fmt: on
+            result = dbc.fetchone()
+            dbc.close()
         if not result:
             raise ValueError("Unknown mail_location id specified: %r" % mid)
         self._mid = mid
@@ -134,24 +159,29 @@ class MailLocation:
     def _load_by_names(self, mbfmt, directory):
         """Try to load mail_location relevant information by *mbfmt* and
         *directory* name. If it fails goto _save()."""
-        dbc = self._dbh.cursor()
-        # fmt: off
-        dbc.execute(
-            "SELECT mid "
-            "FROM maillocation "
-            "WHERE ("
-            "   fid = (SELECT fid FROM mailboxformat WHERE format = %s) "
-            "   AND directory = %s"
-            ")",
-            (mbfmt, directory),
-        )
-        # fmt: on
-        result = dbc.fetchone()
-        dbc.close()
-        if not result:
+        cache = lookup_cache(self._dbh)
+        if cache is not None:
+            mid = cache.find(self._dbh, "maillocation", (mbfmt, directory))
+        else:
+            dbc = self._dbh.cursor()
+            # fmt: off
+            dbc.execute(
+                "SELECT mid "
+                "FROM maillocation "
+                "WHERE ("
+                "   fid = (SELECT fid FROM mailboxformat WHERE format = %s) "
+                "   AND directory = %s"
+                ")",
+                (mbfmt, directory),
+            )
+            # fmt: on
+            result = dbc.fetchone()
+            dbc.close()
+            mid = result[0] if result else None
+        if not mid:
             self._save(mbfmt, directory)
         else:
-            self._mid = result[0]
+            self._mid = mid
             self._mbfmt = mbfmt
             self._directory = directory
 
@@ -171,6 +201,9 @@ class MailLocation:
             (mbfmt, mid, directory),
         )
         # fmt: on
+        cache = lookup_cache(self._dbh)
+        if cache is not None:
+            cache.add(self._dbh, "maillocation", mid, (mbfmt, directory))
         self._dbh.commit()
         dbc.close()
         self._mid = mid
@@ -181,3 +214,13 @@ class MailLocation:
 def known_format(mbfmt):
     """Checks if the mailbox format *mbfmt* is known, returns bool."""
     return mbfmt.lower() in _format_info
+
+
+def usage_source(mbfmt):
+    """Returns the source, from which the size of a mailbox in the format
+    *mbfmt* can be read, without walking the mail directory.
+
+    ``maildirsize`` for Maildir++ (the maildirsize file in the Maildir),
+    ``userquota`` for the dbox formats (the userquota table, which is
+    maintained by Dovecot's quota dict)."""
+    return _format_info[mbfmt.lower()]["usage_source"]
@@ -0,0 +1,319 @@
+# -*- coding: UTF-8 -*-
+# Copyright (c) 2014, Pascal Volk
+# See COPYING for distribution information.
+"""
+    vmm.maps
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Export of Postfix's lookup tables into static maps.
+
+    The maps contain the same results as the postfix_*_map() functions
+    from create_tables.pgsql, so the pgsql: lookups of the postfix/*.cf
+    files can be replaced by e.g. hash: or cdb: lookups.  Catch-all
+    destinations, which depend on the localpart of the recipient (%n or
+    %=), are written into an additional pcre: map.
+"""
+
+import json
+import os
+import re
+from gettext import gettext as _
+from subprocess import Popen, PIPE
+
+from vmm.constants import MAP_EXPORT_ERROR
+from vmm.errors import VMMError
+
+
+__all__ = ("MAPS", "MAP_TYPES", "export_maps", "interpolate_destination")
+
+# map: tables, which the results of the map depend on
+MAPS = {
+    "relocated_maps": ("domain_name", "relocated"),
+    "smtpd_sender_login_maps": ("alias", "domain_name", "users"),
+    "transport_maps": ("domain_data", "domain_name", "transport", "users"),
+    "virtual_alias_maps": ("alias", "catchall", "domain_name", "relocated", "users"),
+    "virtual_mailbox_maps": ("domain_data", "domain_name", "maillocation", "users"),
+}
+# map type: suffix of the file created by postmap
+MAP_TYPES = {
+    "btree": ".db",
+    "cdb": ".cdb",
+    "hash": ".db",
+    "lmdb": ".lmdb",
+    "texthash": None,
+}
+PCRE_SUFFIX = ".pcre"
+STATE_FILE = ".vmm-maps.json"
+
+
+def interpolate_destination(destination, localpart, domainname):
+    """Same as the SQL function _interpolate_destination()."""
+    if "%" not in destination:
+        return destination
+    result = destination.replace("%n", localpart)
+    result = result.replace("%d", domainname)
+    return result.replace("%=", localpart + "=" + domainname)
+
+
+def _domain_names(dbh):
+    """Returns a dict gid: [domainname, ...]."""
+    dbc = dbh.cursor()
+    dbc.execute("SELECT gid, domainname FROM domain_name ORDER BY domainname")
+    names = {}
+    for gid, name in dbc.fetchall():
+        names.setdefault(gid, []).append(name)
+    dbc.close()
+    return names
+
+
+def _fetch(dbh, sql):
+    dbc = dbh.cursor()
+    dbc.execute(sql)
+    rows = dbc.fetchall()
+    dbc.close()
+    return rows
+
+
+def _relocated_maps(dbh):
+    # fmt: off
+    rows = _fetch(
+        dbh,
+        "SELECT address, domainname, destination "
+        "FROM relocated "
+        "JOIN domain_name USING (gid)"
+    )
+    # fmt: on
+    return {"%s@%s" % (address, name): [dest] for address, name, dest in rows}, None
+
+
+def _smtpd_sender_login_maps(dbh):
+    names = _domain_names(dbh)
+    entries = {}
+    for local_part, gid in _fetch(dbh, "SELECT local_part, gid FROM users"):
+        logins = ["%s@%s" % (local_part, name) for name in names.get(gid, ())]
+        for login in logins:
+            entries[login] = logins
+    # fmt: off
+    rows = _fetch(
+        dbh,
+        "SELECT DISTINCT address, domainname, destination "
+        "FROM alias "
+        "JOIN domain_name USING (gid)"
+    )
+    # fmt: on
+    aliases = {}
+    for address, name, dest in rows:
+        sender = "%s@%s" % (address, name)
+        if sender not in entries:
+            aliases.setdefault(sender, []).append(dest)
+    entries.update(aliases)
+    return entries, None
+
+
+def _transport_maps(dbh):
+    # fmt: off
+    domains = _fetch(
+        dbh,
+        "SELECT domainname, transport "
+        "FROM domain_name "
+        "JOIN domain_data USING (gid) "
+        "JOIN transport USING (tid)"
+    )
+    users = _fetch(
+        dbh,
+        "SELECT local_part, domainname, transport "
+        "FROM users "
+        "JOIN domain_name USING (gid) "
+        "JOIN transport ON transport.tid = users.tid"
+    )
+    # fmt: on
+    entries = {name: [transport] for name, transport in domains}
+    for local_part, name, transport in users:
+        entries["%s@%s" % (local_part, name)] = [transport]
+    return entries, None
+
+
+def _virtual_alias_maps(dbh):
+    # fmt: off
+    aliases = _fetch(
+        dbh,
+        "SELECT address, domainname, destination "
+        "FROM alias "
+        "JOIN domain_name USING (gid)"
+    )
+    catchalls = _fetch(
+        dbh,
+        "SELECT domainname, destination "
+        "FROM catchall "
+        "JOIN domain_name USING (gid)"
+    )
+    # the catch-all must not take precedence over accounts and relocated
+    # users, so they are mapped to themselves in domains with a catch-all
+    identities = _fetch(
+        dbh,
+        "SELECT local_part, domainname "
+        "FROM users "
+        "JOIN domain_name USING (gid) "
+        "WHERE gid IN (SELECT gid FROM catchall) "
+        "UNION "
+        "SELECT address, domainname "
+        "FROM relocated "
+        "JOIN domain_name USING (gid) "
+        "WHERE gid IN (SELECT gid FROM catchall)"
+    )
+    # fmt: on
+    entries = {}
+    for address, name, dest in aliases:
+        entries.setdefault("%s@%s" % (address, name), []).append(
+            interpolate_destination(dest, address, name)
+        )
+    for local_part, name in identities:
+        recipient = "%s@%s" % (local_part, name)
+        entries.setdefault(recipient, [recipient])
+    catchall = {}
+    for name, dest in catchalls:
+        catchall.setdefault(name, []).append(dest)
+    patterns = []
+    for name, dests in sorted(catchall.items()):
+        if any("%n" in dest or "%=" in dest for dest in dests):
+            # the localpart is only known to a regular expression
+            dests = [interpolate_destination(dest, "${1}", name) for dest in dests]
+            patterns.append("/^(.+)@%s$/ %s" % (re.escape(name), ", ".join(dests)))
+        else:
+            entries["@" + name] = [
+                interpolate_destination(dest, "", name) for dest in dests
+            ]
+    return entries, patterns
+
+
+def _virtual_mailbox_maps(dbh):
+    # fmt: off
+    rows = _fetch(
+        dbh,
+        "SELECT local_part, domainname, "
+        "       domaindir || '/' || uid || '/' || directory || '/' "
+        "FROM users "
+        "JOIN domain_name USING (gid) "
+        "JOIN domain_data USING (gid) "
+        "JOIN maillocation USING (mid)"
+    )
+    # fmt: on
+    return {"%s@%s" % (lpart, name): [mdir] for lpart, name, mdir in rows}, None
+
+
+_GENERATORS = {
+    "relocated_maps": _relocated_maps,
+    "smtpd_sender_login_maps": _smtpd_sender_login_maps,
+    "transport_maps": _transport_maps,
+    "virtual_alias_maps": _virtual_alias_maps,
+    "virtual_mailbox_maps": _virtual_mailbox_maps,
+}
+
+
+def _table_signatures(dbh):
+    """Returns a dict table: signature of the rows of the table.
+
+    The signature consists of the number of rows and the sum of their
+    xmin, the id of the transaction, which has inserted or updated the
+    row.  So it changes with each committed INSERT, UPDATE or DELETE, also
+    on a standby server."""
+    tables = sorted({table for tables in MAPS.values() for table in tables})
+    sql = " UNION ALL ".join(
+        "SELECT '%s', count(*) || ':' || COALESCE(sum(xmin::text::bigint), 0) "
+        "FROM %s" % (table, table)
+        for table in tables
+    )
+    dbc = dbh.cursor()
+    dbc.execute(sql)
+    signatures = dict(dbc.fetchall())
+    dbc.close()
+    return signatures
+
+
+def _read_state(path):
+    try:
+        with open(path, encoding="utf-8") as fobj:
+            return json.load(fobj)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_file(path, lines):
+    """Writes the *lines* into the temporary file for *path* and returns
+    the name of the temporary file."""
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w", encoding="utf-8") as fobj:
+        fobj.writelines(line + "\n" for line in lines)
+        fobj.flush()
+        os.fsync(fobj.fileno())
+    return tmp
+
+
+def _postmap(postmap, map_type, source):
+    cmd = [postmap, "%s:%s" % (map_type, source)]
+    process = Popen(cmd, stderr=PIPE)
+    stderr = process.communicate()[1]
+    if process.returncode:
+        raise VMMError(stderr.strip().decode(), MAP_EXPORT_ERROR)
+
+
+def _install_map(path, entries, map_type, postmap):
+    """Writes the *entries* as postmap(1) source file *path* and builds the
+    indexed file.  Both files are replaced atomically, the indexed one
+    first, so that it is never older than its source file."""
+    suffix = MAP_TYPES[map_type] or ""
+    lines = (
+        "%s %s" % (key, ", ".join(values)) for key, values in sorted(entries.items())
+    )
+    tmp = _write_file(path, lines)
+    try:
+        if suffix:
+            _postmap(postmap, map_type, tmp)
+            os.replace(tmp + suffix, path + suffix)
+        os.replace(tmp, path)
+    except BaseException:
+        for name in (tmp, tmp + suffix):
+            if os.path.exists(name):
+                os.unlink(name)
+        raise
+
+
+def _install_patterns(path, patterns):
+    tmp = _write_file(path, patterns)
+    os.replace(tmp, path)
+
+
+def export_maps(dbh, directory, map_type="hash", postmap="postmap", force=False):
+    """Exports the maps from `MAPS` into the *directory*.
+
+    Each map is written as postmap(1) source file and indexed by *postmap*
+    as *map_type* database, see `MAP_TYPES`.  The catch-all patterns of
+    virtual_alias_maps are written to the file virtual_alias_maps.pcre.
+
+    A map is only rewritten, when the rows of one of its tables have
+    changed since the last export, see `_table_signatures()`, unless
+    *force* is `True`.  Returns the list of the rewritten maps."""
+    if map_type not in MAP_TYPES:
+        raise VMMError(_("Unsupported map type: '%s'") % map_type, MAP_EXPORT_ERROR)
+    os.makedirs(directory, 0o755, exist_ok=True)
+    state_file = os.path.join(directory, STATE_FILE)
+    state = _read_state(state_file)
+    signatures = _table_signatures(dbh)
+    exported = []
+    for name, tables in sorted(MAPS.items()):
+        path = os.path.join(directory, name)
+        signature = {table: signatures[table] for table in tables}
+        signature["type"] = map_type
+        if not force and state.get(name) == signature and os.path.exists(path):
+            continue
+        entries, patterns = _GENERATORS[name](dbh)
+        _install_map(path, entries, map_type, postmap)
+        if patterns is not None:
+            _install_patterns(path + PCRE_SUFFIX, patterns)
+        state[name] = signature
+        exported.append(name)
+    dbh.rollback()
+    if exported:
+        tmp = _write_file(state_file, [json.dumps(state, sort_keys=True)])
+        os.replace(tmp, state_file)
+    return exported
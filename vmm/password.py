@@ -10,18 +10,24 @@
     functions:
 
         hashed_password = pwhash(password[, scheme][, user])
+        hashed_passwords = pwhash_many(passwords[, scheme][, users])
         random_password = randompw()
         scheme, encoding = verify_scheme(scheme)
         schemes, encodings = list_schemes()
         scheme = extract_scheme(hashed_password)
 """
 
+import builtins
 import hashlib
+import hmac
+import json
+import os
 import re
+import struct
 
 from base64 import b64encode
 from binascii import b2a_hex
-from crypt import crypt
+from concurrent.futures import ProcessPoolExecutor
 from random import SystemRandom
 from subprocess import Popen, PIPE
 from gettext import gettext as _
@@ -30,6 +36,7 @@ from vmm import ENCODING
 from vmm.emailaddress import EmailAddress
 from vmm.common import get_unicode, version_str
 from vmm.constants import VMM_ERROR
+from vmm.digest import MD4, MD5_IV, des_encrypt, md5_compress
 from vmm.errors import VMMError
 
 SALTCHARS = "./0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
@@ -50,6 +57,19 @@ CRYPT_SHA2_ROUNDS_MIN = 1000
 CRYPT_SHA2_ROUNDS_MAX = 999999999
 CRYPT_SHA2_SALT_LEN = 16
 SALTED_ALGO_SALT_LEN = 4
+LANMAN_MAGIC = b"KGS!@#$%"
+SCRAM_ITERATIONS = 4096
+SCRAM_SALT_LEN = 16
+# configuration options, used by pwhash(), passed to the pwhash_many() workers
+PWHASH_OPTIONS = (
+    "bin.doveadm",
+    "misc.crypt_blowfish_rounds",
+    "misc.crypt_cache_file",
+    "misc.crypt_sha256_rounds",
+    "misc.crypt_sha512_rounds",
+    "misc.dovecot_version",
+    "misc.password_scheme",
+)
 
 
 cfg_dget = lambda option: None
@@ -89,14 +109,14 @@ def _doveadmpw(password, scheme, encoding):
 
 
 def _md4_new():
-    """Returns an new MD4-hash object if supported by the hashlib -
-    otherwise `None`.
+    """Returns an new MD4-hash object from the hashlib if supported -
+    otherwise the pure Python implementation from vmm.digest.
     """
     try:
         return hashlib.new("md4")
     except ValueError as err:
         if err.args[0].startswith("unsupported hash type"):
-            return None
+            return MD4()
         else:
             raise
 
@@ -163,6 +183,8 @@ def _crypt_hash(password, scheme, encoding):
         salt = _get_crypt_sha2_salt(CRYPT_ID_SHA256)
     else:
         salt = _get_crypt_sha2_salt(CRYPT_ID_SHA512)
+    from crypt import crypt
+
     encrypted = crypt(password.decode(ENCODING), salt)
     if encoding:
         if encoding == "HEX":
@@ -175,14 +197,12 @@ def _crypt_hash(password, scheme, encoding):
 def _md4_hash(password, scheme, encoding):
     """Generates encoded PLAIN-MD4 hashes."""
     md4 = _md4_new()
-    if md4:
-        md4.update(password)
-        if encoding in DEFAULT_HEX:
-            digest = md4.hexdigest()
-        else:
-            digest = b64encode(md4.digest()).decode()
-        return _format_digest(digest, scheme, encoding)
-    return _doveadmpw(password, scheme, encoding)
+    md4.update(password)
+    if encoding in DEFAULT_HEX:
+        digest = md4.hexdigest()
+    else:
+        digest = b64encode(md4.digest()).decode()
+    return _format_digest(digest, scheme, encoding)
 
 
 def _md5_hash(password, scheme, encoding, user=None):
@@ -203,15 +223,83 @@ def _md5_hash(password, scheme, encoding, user=None):
 def _ntlm_hash(password, scheme, encoding):
     """Generates NTLM hashes."""
     md4 = _md4_new()
-    if md4:
-        password = b"".join(bytes(x) for x in zip(password, bytes(len(password))))
-        md4.update(password)
-        if encoding in DEFAULT_HEX:
-            digest = md4.hexdigest()
+    password = b"".join(bytes(x) for x in zip(password, bytes(len(password))))
+    md4.update(password)
+    if encoding in DEFAULT_HEX:
+        digest = md4.hexdigest()
+    else:
+        digest = b64encode(md4.digest()).decode()
+    return _format_digest(digest, scheme, encoding)
+
+
+def _cram_md5_hash(password, scheme, encoding):
+    """Generates CRAM-MD5 aka HMAC-MD5 hashes.
+
+    Like Dovecot, the MD5 states of the HMAC's outer and inner context,
+    after processing the padded key, are stored (RFC 2195).
+    """
+    if len(password) > 64:
+        password = hashlib.md5(password).digest()
+    key = password.ljust(64, b"\0")
+    outer = md5_compress(MD5_IV, bytes(x ^ 0x5C for x in key))
+    inner = md5_compress(MD5_IV, bytes(x ^ 0x36 for x in key))
+    context = struct.pack("<8I", *(outer + inner))
+    if encoding in DEFAULT_HEX:
+        digest = b2a_hex(context).decode()
+    else:
+        digest = b64encode(context).decode()
+    return _format_digest(digest, scheme, encoding)
+
+
+def _lanman_des_key(key):
+    """Expands the 7 bytes *key* to a 8 bytes DES key."""
+    bits = int.from_bytes(key, "big")
+    return bytes(((bits >> (49 - 7 * i)) & 0x7F) << 1 for i in range(8))
+
+
+def _lanman_hash(password, scheme, encoding):
+    """Generates LANMAN hashes."""
+    # only ASCII characters will be converted to upper case, like Dovecot does
+    password = password.upper()[:14].ljust(14, b"\0")
+    lm_hash = des_encrypt(_lanman_des_key(password[:7]), LANMAN_MAGIC)
+    lm_hash += des_encrypt(_lanman_des_key(password[7:]), LANMAN_MAGIC)
+    if encoding in DEFAULT_HEX:
+        digest = b2a_hex(lm_hash).decode()
+    else:
+        digest = b64encode(lm_hash).decode()
+    return _format_digest(digest, scheme, encoding)
+
+
+def _rpa_hash(password, scheme, encoding):
+    """Generates RPA hashes."""
+    # Dovecot expands each byte of the password to a UCS-2BE character
+    md5 = hashlib.md5(b"".join(b"\0" + bytes((x,)) for x in password))
+    if encoding in DEFAULT_HEX:
+        digest = md5.hexdigest()
+    else:
+        digest = b64encode(md5.digest()).decode()
+    return _format_digest(digest, scheme, encoding)
+
+
+def _scram_sha1_hash(password, scheme, encoding):
+    """Generates SCRAM-SHA-1 hashes: iterations,salt,stored_key,server_key
+    (RFC 5802)."""
+    salt = _sys_rand.randbytes(SCRAM_SALT_LEN)
+    salted = hashlib.pbkdf2_hmac("sha1", password, salt, SCRAM_ITERATIONS)
+    client_key = hmac.new(salted, b"Client Key", hashlib.sha1).digest()
+    server_key = hmac.new(salted, b"Server Key", hashlib.sha1).digest()
+    digest = "%d,%s,%s,%s" % (
+        SCRAM_ITERATIONS,
+        b64encode(salt).decode(),
+        b64encode(hashlib.sha1(client_key).digest()).decode(),
+        b64encode(server_key).decode(),
+    )
+    if encoding:
+        if encoding == "HEX":
+            digest = b2a_hex(digest.encode()).decode()
         else:
-            digest = b64encode(md4.digest()).decode()
-        return _format_digest(digest, scheme, encoding)
-    return _doveadmpw(password, scheme, encoding)
+            digest = b64encode(digest.encode()).decode()
+    return _format_digest(digest, scheme, encoding)
 
 
 def _create_hashlib_hash(algorithm, with_salt=False):
@@ -240,11 +328,11 @@ _ssha512_hash = _create_hashlib_hash(hashlib.sha512, with_salt=True)
 _scheme_info = {
     "CLEAR": (_clear_hash, 0x2010DF00),
     "CLEARTEXT": (_clear_hash, 0x10000F00),
-    "CRAM-MD5": (_doveadmpw, 0x10000F00),
+    "CRAM-MD5": (_cram_md5_hash, 0x10000F00),
     "CRYPT": (_crypt_hash, 0x10000F00),
     "DIGEST-MD5": (_md5_hash, 0x10000F00),
-    "HMAC-MD5": (_doveadmpw, 0x10000F00),
-    "LANMAN": (_doveadmpw, 0x10000F00),
+    "HMAC-MD5": (_cram_md5_hash, 0x10000F00),
+    "LANMAN": (_lanman_hash, 0x10000F00),
     "LDAP-MD5": (_md5_hash, 0x10000F00),
     "MD5": (_crypt_hash, 0x10000F00),
     "MD5-CRYPT": (_crypt_hash, 0x10000F00),
@@ -253,8 +341,8 @@ _scheme_info = {
     "PLAIN": (_clear_hash, 0x10000F00),
     "PLAIN-MD4": (_md4_hash, 0x10000F00),
     "PLAIN-MD5": (_md5_hash, 0x10000F00),
-    "RPA": (_doveadmpw, 0x10000F00),
-    "SCRAM-SHA-1": (_doveadmpw, 0x20200A01),
+    "RPA": (_rpa_hash, 0x10000F00),
+    "SCRAM-SHA-1": (_scram_sha1_hash, 0x20200A01),
     "SHA": (_sha1_hash, 0x10000F00),
     "SHA1": (_sha1_hash, 0x10000F00),
     "SHA256": (_sha256_hash, 0x10100A01),
@@ -267,6 +355,110 @@ _scheme_info = {
 }
 
 
+# Schemes, which depend on the features of the libc's crypt(3):
+# scheme: (Dovecot version, salt, crypt("08/15!test~4711", salt))
+_crypt_probes = {
+    "BLF-CRYPT": (
+        0x20000B06,
+        "$2a$04$0123456789abcdefABCDEF$",
+        "$2a$04$0123456789abcdefABCDE.N.drYX5yIAL1LkTaaZotW3yI0hQhZru",
+    ),
+    "SHA256-CRYPT": (
+        0x20000B06,
+        "$5$rounds=1000$0123456789abcdef$",
+        "$5$rounds=1000$0123456789abcdef$K/DksR0DT01hGc8g/kt9McEgrbFMKi9qrb1jehe7hn4",
+    ),
+    "SHA512-CRYPT": (
+        0x20000B06,
+        "$6$rounds=1000$0123456789abcdef$",
+        "$6$rounds=1000$0123456789abcdef$ZIAd5WqfyLkpvsVCVUU1GrvqaZTqvhJoouxdSqJO71l9"
+        "Ld3tVrfOatEjarhghvEYADkq//LpDnTeO90tcbtHR1",
+    ),
+}
+_crypt_probed = False
+
+
+def _crypt_library_id():
+    """Returns a list, which identifies the C library and the crypt
+    library, that are used by crypt.crypt().  When one of them has been
+    updated, the probed crypt schemes are outdated."""
+    import _crypt
+
+    ident = [getattr(_crypt, "__file__", None)]
+    try:
+        ident.append(os.confstr("CS_GNU_LIBC_VERSION"))
+    except (ValueError, OSError):
+        pass
+    try:
+        with open("/proc/self/maps") as maps:
+            libs = {
+                fields[5].strip()
+                for fields in (line.split(None, 5) for line in maps)
+                if len(fields) > 5 and "/libcrypt.so" in fields[5]
+            }
+    except OSError:
+        libs = ()
+    for lib in sorted(libs):
+        try:
+            st = os.stat(lib)
+        except OSError:
+            continue
+        ident.append([lib, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns])
+    return ident
+
+
+def _probe_crypt_schemes():
+    """Returns a list of the schemes from `_crypt_probes`, supported by
+    crypt.crypt().
+
+    The result is cached in the misc.crypt_cache_file, so the probe hashes
+    have to be generated only once per libc/libcrypt version."""
+    try:
+        from crypt import crypt
+
+        ident = _crypt_library_id()
+    except ImportError:
+        return []
+    cache_file = cfg_dget("misc.crypt_cache_file")
+    try:
+        with open(cache_file) as fobj:
+            cache = json.load(fobj)
+        if cache["id"] == ident:
+            return [scheme for scheme in cache["schemes"] if scheme in _crypt_probes]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    schemes = [
+        scheme
+        for scheme, (version, salt, expected) in _crypt_probes.items()
+        if crypt("08/15!test~4711", salt) == expected
+    ]
+    if not cache_file:
+        return schemes
+    tmp = "%s.%d" % (cache_file, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(tmp, "w") as fobj:
+            json.dump({"id": ident, "schemes": schemes}, fobj)
+        os.replace(tmp, cache_file)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+    return schemes
+
+
+def _load_crypt_schemes():
+    """Adds the crypt(3) schemes, supported by the libc, to the
+    `_scheme_info`.  The probe runs only once."""
+    global _crypt_probed
+    if _crypt_probed:
+        return
+    for scheme in _probe_crypt_schemes():
+        _scheme_info[scheme] = (_crypt_hash, _crypt_probes[scheme][0])
+    _crypt_probed = True
+
+
 def extract_scheme(password_hash):
     """Returns the extracted password scheme from *password_hash*.
 
@@ -285,6 +477,7 @@ def list_schemes():
     the used Dovecot version and features of the libc).
     `encodings` is a tuple with all usable encoding suffixes.
     """
+    _load_crypt_schemes()
     dcv = cfg_dget("misc.dovecot_version")
     schemes = (k for (k, v) in _scheme_info.items() if v[1] <= dcv)
     encodings = (".B64", ".BASE64", ".HEX")
@@ -309,6 +502,8 @@ def verify_scheme(scheme):
     assert isinstance(scheme, str), "Not a str: {!r}".format(scheme)
     scheme_encoding = scheme.upper().split(".")
     scheme = scheme_encoding[0]
+    if scheme in _crypt_probes:
+        _load_crypt_schemes()
     if scheme not in _scheme_info:
         raise VMMError(_("Unsupported password scheme: '%s'") % scheme, VMM_ERROR)
     if cfg_dget("misc.dovecot_version") < _scheme_info[scheme][1]:
@@ -349,6 +544,53 @@ def pwhash(password, scheme=None, user=None):
     return _scheme_info[scheme][0](password, scheme, encoding)
 
 
+def _init_pwhash_worker(options):
+    """Installs the *options* dict as ``cfg_dget`` into the built-in
+    namespace of a pwhash_many() worker process, unless the worker has
+    inherited the handler's cfg_dget (fork)."""
+    if "cfg_dget" not in builtins.__dict__:
+        builtins.__dict__["cfg_dget"] = options.get
+
+
+def _pwhash_star(args):
+    return pwhash(*args)
+
+
+def pwhash_many(passwords, scheme=None, users=None, workers=None):
+    """Generates the password hashes for all plain text *passwords*.
+
+    Returns a list with the hashes, in the order of *passwords*.  The
+    *scheme* is the same for all passwords.  When 'DIGEST-MD5' is used,
+    *users* must be a sequence with an EmailAddress for each password.
+
+    The crypt(3) based schemes, SCRAM-SHA-1 and the schemes, which need
+    Dovecot's doveadm, are expensive by design.  Their hashes will be
+    generated by a pool of *workers* processes, by default one per CPU.
+    """
+    passwords = list(passwords)
+    if users is None:
+        users = [None] * len(passwords)
+    elif len(users) != len(passwords):
+        raise ValueError("Number of users doesn't match the number of passwords.")
+    if scheme is None:
+        scheme = cfg_dget("misc.password_scheme")
+    # raise errors in the calling process, not in one of the workers
+    hash_func = _scheme_info[verify_scheme(scheme)[0]][0]
+    if workers is None or workers < 1:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(passwords))
+    args = [(password, scheme, user) for password, user in zip(passwords, users)]
+    if workers < 2 or hash_func not in (_crypt_hash, _scram_sha1_hash, _doveadmpw):
+        return [_pwhash_star(arg) for arg in args]
+    options = {option: cfg_dget(option) for option in PWHASH_OPTIONS}
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_pwhash_worker, initargs=(options,)
+    ) as pool:
+        return list(
+            pool.map(_pwhash_star, args, chunksize=max(len(args) // (workers * 4), 1))
+        )
+
+
 def randompw(pw_len):
     """Generates a plain text random password.
 
@@ -360,21 +602,4 @@ def randompw(pw_len):
     return "".join(_sys_rand.sample(PASSWDCHARS, pw_len))
 
 
-# Check for Blowfish/SHA-256/SHA-512 support in crypt.crypt()
-if "$2a$04$0123456789abcdefABCDE.N.drYX5yIAL1LkTaaZotW3yI0hQhZru" == crypt(
-    "08/15!test~4711", "$2a$04$0123456789abcdefABCDEF$"
-):
-    _scheme_info["BLF-CRYPT"] = (_crypt_hash, 0x20000B06)
-if (
-    "$5$rounds=1000$0123456789abcdef$K/DksR0DT01hGc8g/kt9McEgrbFMKi9qrb1jehe7hn4"
-    == crypt("08/15!test~4711", "$5$rounds=1000$0123456789abcdef$")
-):
-    _scheme_info["SHA256-CRYPT"] = (_crypt_hash, 0x20000B06)
-if (
-    "$6$rounds=1000$0123456789abcdef$ZIAd5WqfyLkpvsVCVUU1GrvqaZTqvhJoouxdSqJO71l9Ld3"
-    "tVrfOatEjarhghvEYADkq//LpDnTeO90tcbtHR1"
-    == crypt("08/15!test~4711", "$6$rounds=1000$0123456789abcdef$")
-):
-    _scheme_info["SHA512-CRYPT"] = (_crypt_hash, 0x20000B06)
-
 del cfg_dget
@@ -9,6 +9,8 @@
     for domains and accounts.
 """
 
+from vmm.database import lookup_cache
+
 
 class QuotaLimit:
     """Class to handle quota limit specific data."""
@@ -55,6 +57,17 @@ class QuotaLimit:
             self._messages = -msgs if msgs < 0 else msgs
             self._load_by_limit()
 
+    @classmethod
+    def _from_row(cls, dbh, qid, bytes_, messages):
+        """Creates a QuotaLimit from the already fetched columns of its
+        quotalimit row, without a query."""
+        qlimit = cls.__new__(cls)
+        qlimit._dbh = dbh
+        qlimit._qid = qid
+        qlimit._bytes = bytes_
+        qlimit._messages = messages
+        return qlimit
+
     @property
     def bytes(self):
         """Quota limit in bytes."""
@@ -82,35 +95,44 @@ class QuotaLimit:
 
     def _load_by_limit(self):
         """Load the quota limit by limit values from the database."""
-        dbc = self._dbh.cursor()
-        # fmt: off
-        dbc.execute(
-            "SELECT qid "
-            "FROM quotalimit "
-            "WHERE bytes = %s AND messages = %s",
-            (self._bytes, self._messages),
-        )
-        # fmt: on
-        res = dbc.fetchone()
-        dbc.close()
-        if res:
-            self._qid = res[0]
+        cache = lookup_cache(self._dbh)
+        if cache is not None:
+            qid = cache.find(self._dbh, "quotalimit", (self._bytes, self._messages))
+        else:
+            dbc = self._dbh.cursor()
+            # fmt: off
+            dbc.execute(
+                "SELECT qid "
+                "FROM quotalimit "
+                "WHERE bytes = %s AND messages = %s",
+                (self._bytes, self._messages),
+            )
+            # fmt: on
+            res = dbc.fetchone()
+            dbc.close()
+            qid = res[0] if res else None
+        if qid:
+            self._qid = qid
         else:
             self._save()
 
     def _load_by_qid(self, qid):
         """Load the quota limit by its unique ID from the database."""
-        dbc = self._dbh.cursor()
-        # fmt: off
-        dbc.execute(
-            "SELECT bytes, messages "
-            "FROM quotalimit "
-            "WHERE qid = %s",
-            (qid,)
-        )
-        # fmt: on
-        res = dbc.fetchone()
-        dbc.close()
+        cache = lookup_cache(self._dbh)
+        if cache is not None:
+            res = cache.get(self._dbh, "quotalimit", qid)
+        else:
+            dbc = self._dbh.cursor()
+            # fmt: off
+            dbc.execute(
+                "SELECT bytes, messages "
+                "FROM quotalimit "
+                "WHERE qid = %s",
+                (qid,)
+            )
+            # fmt: on
+            res = dbc.fetchone()
+            dbc.close()
         if not res:
             raise ValueError("Unknown quota limit id specified: %r" % qid)
         self._qid = qid
@@ -128,5 +150,8 @@ class QuotaLimit:
             (self._qid, self._bytes, self._messages),
         )
         # fmt: on
+        cache = lookup_cache(self._dbh)
+        if cache is not None:
+            cache.add(self._dbh, "quotalimit", self._qid, (self._bytes, self._messages))
         self._dbh.commit()
         dbc.close()
@@ -9,6 +9,8 @@
     to the service_set table.
 """
 
+from vmm.database import lookup_cache
+
 SERVICES = ("smtp", "pop3", "imap", "sieve")
 
 
@@ -78,6 +80,16 @@ class ServiceSet:
         if not self._ssid:
             self._load_by_services()
 
+    @classmethod
+    def _from_row(cls, dbh, ssid, *services):
+        """Creates a ServiceSet from the already fetched columns of its
+        service_set row (ssid, smtp, pop3, imap, sieve), without a query."""
+        serviceset = cls.__new__(cls)
+        serviceset._dbh = dbh
+        serviceset._ssid = ssid
+        serviceset._services = dict(zip(SERVICES, services))
+        return serviceset
+
     def __eq__(self, other):
         if isinstance(other, self.__class__):
             return self._ssid == other._ssid
@@ -107,38 +119,50 @@ class ServiceSet:
 
     def _load_by_services(self):
         """Try to load the service_set by it's service combination."""
-        dbc = self._dbh.cursor()
-        # TODO PY3PORT: possible SQL injection?
-        service_queries = " AND ".join(
-            f"{k} = {str(v).upper()}" for k, v in self._services.items()
-        )
-        # fmt: off
-        dbc.execute(
-            f"SELECT ssid "
-            f"FROM service_set "
-            f"WHERE {service_queries}"
-        )
-        # fmt: on
-        result = dbc.fetchone()
-        dbc.close()
-        if result:
-            self._ssid = result[0]
+        cache = lookup_cache(self._dbh)
+        if cache is not None:
+            ssid = cache.find(
+                self._dbh, "service_set", tuple(self._services[s] for s in SERVICES)
+            )
+        else:
+            dbc = self._dbh.cursor()
+            # TODO PY3PORT: possible SQL injection?
+            service_queries = " AND ".join(
+                f"{k} = {str(v).upper()}" for k, v in self._services.items()
+            )
+            # fmt: off
+            dbc.execute(
+                f"SELECT ssid "
+                f"FROM service_set "
+                f"WHERE {service_queries}"
+            )
+            # fmt: on
+            result = dbc.fetchone()
+            dbc.close()
+            ssid = result[0] if result else None
+        if ssid:
+            self._ssid = ssid
         else:
             self._save()
 
     def _load_by_ssid(self, ssid):
         """Try to load the service_set by it's primary key."""
-        dbc = self._dbh.cursor()
-        # fmt: off
-        dbc.execute(
-            "SELECT ssid, smtp, pop3, imap, sieve "
-            "FROM service_set "
-            "WHERE ssid = %s",
-            (ssid,),
-        )
-        # fmt: on
-        result = dbc.fetchone()
-        dbc.close()
+        cache = lookup_cache(self._dbh)
+        if cache is not None:
+            services = cache.get(self._dbh, "service_set", ssid)
+            result = None if services is None else (ssid,) + services
+        else:
+            dbc = self._dbh.cursor()
+            # fmt: off
+            dbc.execute(
+                "SELECT ssid, smtp, pop3, imap, sieve "
+                "FROM service_set "
+                "WHERE ssid = %s",
+                (ssid,),
+            )
+            # fmt: on
+            result = dbc.fetchone()
+            dbc.close()
         if not result:
             raise ValueError("Unknown service_set id specified: %r" % ssid)
         self._ssid = result[0]
@@ -157,6 +181,14 @@ class ServiceSet:
         values.update(self._services)
         dbc = self._dbh.cursor()
         dbc.execute(sql, values)
+        cache = lookup_cache(self._dbh)
+        if cache is not None:
+            cache.add(
+                self._dbh,
+                "service_set",
+                self._ssid,
+                tuple(self._services[s] for s in SERVICES),
+            )
         self._dbh.commit()
         dbc.close()
 
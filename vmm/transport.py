@@ -9,6 +9,8 @@
     domains and accounts.
 """
 
+from vmm.database import lookup_cache
+
 
 class Transport:
     """A wrapper class that provides access to the transport table"""
@@ -38,6 +40,16 @@ class Transport:
             self._transport = transport
             self._load_by_name()
 
+    @classmethod
+    def _from_row(cls, dbh, tid, transport):
+        """Creates a Transport from the already fetched columns of its
+        transport row, without a query."""
+        trsp = cls.__new__(cls)
+        trsp._dbh = dbh
+        trsp._tid = tid
+        trsp._transport = transport
+        return trsp
+
     @property
     def tid(self):
         """The transport's unique ID."""
@@ -63,17 +75,21 @@ class Transport:
 
     def _load_by_id(self, tid):
         """load a transport by its id from the database"""
-        dbc = self._dbh.cursor()
-        # fmt: off
-        dbc.execute(
-            "SELECT transport "
-            "FROM transport "
-            "WHERE tid = %s",
-            (tid,)
-        )
-        # fmt: on
-        result = dbc.fetchone()
-        dbc.close()
+        cache = lookup_cache(self._dbh)
+        if cache is not None:
+            result = cache.get(self._dbh, "transport", tid)
+        else:
+            dbc = self._dbh.cursor()
+            # fmt: off
+            dbc.execute(
+                "SELECT transport "
+                "FROM transport "
+                "WHERE tid = %s",
+                (tid,)
+            )
+            # fmt: on
+            result = dbc.fetchone()
+            dbc.close()
         if not result:
             raise ValueError("Unknown transport id specified: %r" % tid)
         self._transport = result[0]
@@ -81,19 +97,24 @@ class Transport:
 
     def _load_by_name(self):
         """Load a transport by its transport name from the database."""
-        dbc = self._dbh.cursor()
-        # fmt: off
-        dbc.execute(
-            "SELECT tid "
-            "FROM transport "
-            "WHERE transport = %s",
-            (self._transport,)
-        )
-        # fmt: on
-        result = dbc.fetchone()
-        dbc.close()
-        if result:
-            self._tid = result[0]
+        cache = lookup_cache(self._dbh)
+        if cache is not None:
+            tid = cache.find(self._dbh, "transport", (self._transport,))
+        else:
+            dbc = self._dbh.cursor()
+            # fmt: off
+            dbc.execute(
+                "SELECT tid "
+                "FROM transport "
+                "WHERE transport = %s",
+                (self._transport,)
+            )
+            # fmt: on
+            result = dbc.fetchone()
+            dbc.close()
+            tid = result[0] if result else None
+        if tid:
+            self._tid = tid
         else:
             self._save()
 
@@ -109,5 +130,8 @@ class Transport:
             (self._tid, self._transport),
         )
         # fmt: on
+        cache = lookup_cache(self._dbh)
+        if cache is not None:
+            cache.add(self._dbh, "transport", self._tid, (self._transport,))
         self._dbh.commit()
         dbc.close()
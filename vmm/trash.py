@@ -0,0 +1,142 @@
+# -*- coding: UTF-8 -*-
+# Copyright (c) 2014, Pascal Volk
+# See COPYING for distribution information.
+"""
+    vmm.trash
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Deferred deletion of domain and home directories.  The directories
+    are renamed into the trash directory below the base directory and
+    removed later by the reaper (vmm reap).
+"""
+
+import fcntl
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from gettext import gettext as _
+
+from vmm.constants import REAPER_RUNNING
+from vmm.errors import VMMError
+
+
+__all__ = ("TRASH_DIRECTORY", "move_to_trash", "reap", "trash_directory")
+
+TRASH_DIRECTORY = ".trash"
+
+
+def trash_directory(base_directory):
+    """Returns the path of the trash directory below *base_directory*.
+    The directory will be created, if it doesn't exist."""
+    trash = os.path.join(base_directory, TRASH_DIRECTORY)
+    try:
+        os.mkdir(trash, 0o700)
+    except FileExistsError:
+        pass
+    return trash
+
+
+def move_to_trash(directory, base_directory):
+    """Moves the *directory* atomically into the trash directory of the
+    *base_directory* and returns the new path.
+
+    The *directory* has to be on the same file system as the
+    *base_directory*, otherwise an OSError will be raised."""
+    trash = trash_directory(base_directory)
+    # unique and sorted by the time of deletion
+    name = "%d.%d.%s" % (time.time_ns(), os.getpid(), os.path.basename(directory))
+    target = os.path.join(trash, name)
+    os.rename(directory, target)
+    return target
+
+
+class _RateLimit:
+    """A token bucket, shared by the reaper threads, which limits the
+    number of unlink operations per second."""
+
+    __slots__ = ("_allowance", "_last", "_lock", "_rate")
+
+    def __init__(self, rate):
+        self._rate = rate
+        self._allowance = float(rate)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until the next operation is allowed."""
+        if not self._rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(
+                self._rate, self._allowance + (now - self._last) * self._rate
+            )
+            self._last = now
+            if self._allowance < 1:
+                time.sleep((1 - self._allowance) / self._rate)
+                self._last = time.monotonic()
+                self._allowance = 0.0
+            else:
+                self._allowance -= 1
+
+
+def _remove_tree(path, limit):
+    """Removes the directory tree *path* bottom up.  Each unlink/rmdir has
+    to be allowed by the _RateLimit *limit*.  Returns the number of
+    removed entries."""
+    removed = 0
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        for name in filenames:
+            limit.acquire()
+            try:
+                os.unlink(os.path.join(dirpath, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        for name in dirnames:
+            limit.acquire()
+            subdir = os.path.join(dirpath, name)
+            try:
+                if os.path.islink(subdir):
+                    os.unlink(subdir)
+                else:
+                    os.rmdir(subdir)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    os.rmdir(path)
+    return removed + 1
+
+
+def reap(base_directory, workers=1, rate=0):
+    """Removes all entries of the trash directory below *base_directory*.
+
+    The entries are removed by *workers* threads in parallel.  When *rate*
+    is greater than 0, the number of removed files and directories per
+    second will be limited to *rate*, in order to leave enough I/O capacity
+    for the mail services.
+
+    Returns a tuple (entries, removed), the number of removed trash
+    entries and the number of removed files and directories.  A VMMError
+    will be raised, when another reaper is already running."""
+    trash = trash_directory(base_directory)
+    fd = os.open(trash, os.O_RDONLY)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise VMMError(
+                _("Another reaper is already running for: %s") % trash, REAPER_RUNNING
+            )
+        entries = sorted(
+            os.path.join(trash, name)
+            for name in os.listdir(trash)
+            if os.path.isdir(os.path.join(trash, name))
+        )
+        limit = _RateLimit(rate)
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            removed = sum(pool.map(lambda path: _remove_tree(path, limit), entries))
+    finally:
+        os.close(fd)
+    return len(entries), removed